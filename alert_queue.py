@@ -0,0 +1,250 @@
+"""A background queue for sending alerts to hipchat.
+
+Sending to hipchat means a network round-trip per message, and our
+scripts used to block on each one (and sometimes sleep, just to keep
+messages in order).  Instead, callers can put their messages on an
+AlertQueue, and a background thread sends them:
+
+* in order: messages to the same room arrive in the order they were
+  queued.
+* coalesced: if several messages for the same room show up at about
+  the same time (within coalesce_sec of each other), and they have
+  the same sender/color/etc, we send them as a single message.
+* with retries: if sending fails, we retry with exponential backoff,
+  and give up (logging an error) after max_tries attempts.
+
+At exit, we wait up to flush_timeout_sec for queued messages to be
+sent, so a script can exit right after queueing its last alert.
+
+Most callers just want send_to_hipchat(), which uses a shared,
+lazily-created queue, and flush() if something else (like alertlib)
+is about to send to the same room and should come after us.
+"""
+
+import atexit
+import collections
+import logging
+import Queue
+import threading
+import time
+import urllib
+import urllib2
+
+
+# Everything but the text of a message.  Only messages whose
+# HipchatMessageKeys are equal can be coalesced into one.
+HipchatMessageKey = collections.namedtuple(
+    'HipchatMessageKey',
+    ('room_name', 'sender', 'severity', 'color', 'html', 'notify'))
+
+
+# We talk to the hipchat API ourselves, rather than via alertlib,
+# because alertlib logs and swallows errors, and we want to retry.
+hipchat_base_url = 'https://api.hipchat.com'
+
+# The colors alertlib uses for each severity, when none is given.
+_SEVERITY_TO_COLOR = {
+    logging.CRITICAL: 'red',
+    logging.ERROR: 'red',
+    logging.WARNING: 'yellow',
+    logging.INFO: 'purple',
+    logging.DEBUG: 'gray',
+}
+
+# In test mode (e.g. --dry-run), we log messages instead of sending them.
+_TEST_MODE = False
+
+
+def enter_test_mode():
+    """Log hipchat messages instead of sending them, like alertlib's."""
+    global _TEST_MODE
+    _TEST_MODE = True
+
+
+def _hipchat_token():
+    """Return the auth token alertlib uses, from secrets.py."""
+    # This requires having secrets.py (or ka_secrets.py) on your
+    # PYTHONPATH!
+    try:
+        import secrets
+    except ImportError:
+        import ka_secrets as secrets
+    return secrets.hipchat_alertlib_token
+
+
+def _hipchat_send(key, text):
+    """Send text to hipchat, as described by key.
+
+    Raises an exception (e.g. urllib2.HTTPError) if hipchat doesn't
+    accept the message.
+    """
+    if _TEST_MODE:
+        logging.info('alert_queue: would send to hipchat room %s: %s'
+                     % (key.room_name, text))
+        return
+    params = {'room_id': key.room_name,
+              'from': key.sender,
+              'message': text,
+              'message_format': 'html' if key.html else 'text',
+              'color': key.color or _SEVERITY_TO_COLOR.get(key.severity,
+                                                           'yellow'),
+              'notify': int(bool(key.notify)),
+              'auth_token': _hipchat_token(),
+              }
+    if isinstance(params['message'], unicode):
+        params['message'] = params['message'].encode('utf-8')
+    # urlopen raises on an HTTP error status.
+    urllib2.urlopen('%s/v1/rooms/message' % hipchat_base_url,
+                    urllib.urlencode(params), timeout=60).read()
+
+
+def _coalesce(items):
+    """Given a list of (key, text) pairs, merge same-key runs per room.
+
+    Returns a list of (key, text) pairs.  Messages for a given room
+    stay in the same order, but a message is merged into the previous
+    message for its room when their keys match.
+    """
+    retval = []
+    last_index_for_room = {}
+    for (key, text) in items:
+        i = last_index_for_room.get(key.room_name)
+        if i is not None and retval[i][0] == key:
+            separator = '<br>\n' if key.html else '\n'
+            retval[i] = (key, retval[i][1] + separator + text)
+        else:
+            last_index_for_room[key.room_name] = len(retval)
+            retval.append((key, text))
+    return retval
+
+
+class AlertQueue(object):
+    """Send hipchat messages from a background thread; see module docstring.
+
+    send_fn(key, text) does the actual sending, and must raise on
+    failure, or we won't retry.  key is a HipchatMessageKey.
+    """
+    def __init__(self, send_fn=_hipchat_send, coalesce_sec=1.0,
+                 max_tries=5, backoff_sec=1.0):
+        self.send_fn = send_fn
+        self.coalesce_sec = coalesce_sec
+        self.max_tries = max_tries
+        self.backoff_sec = backoff_sec
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+                                        name='alert-queue')
+        # We don't want an unsent message to keep the process alive
+        # forever; close() is how we wait (a bounded time) for them.
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, room_name, text, sender, severity=logging.INFO,
+            color=None, html=False, notify=False):
+        """Queue text to be sent to room_name.  Returns immediately."""
+        key = HipchatMessageKey(room_name, sender, severity, color, html,
+                                notify)
+        self._queue.put((key, text))
+
+    def _send_with_retries(self, key, text):
+        for i in xrange(self.max_tries):
+            try:
+                self.send_fn(key, text)
+                return
+            except Exception, why:
+                if i == self.max_tries - 1:
+                    logging.error('Giving up sending to hipchat room %s '
+                                  '(%s: %s): %s'
+                                  % (key.room_name, why.__class__.__name__,
+                                     why, text))
+                else:
+                    logging.warning('Sending to hipchat room %s failed '
+                                    '(%s: %s), retrying...'
+                                    % (key.room_name,
+                                       why.__class__.__name__, why))
+                    time.sleep(self.backoff_sec * (2 ** i))
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            # Wait a bit to see if anything else shows up, so we can
+            # send it all together.
+            deadline = time.time() + self.coalesce_sec
+            while True:
+                timeout = deadline - time.time()
+                try:
+                    if timeout <= 0:
+                        items.append(self._queue.get_nowait())
+                    else:
+                        items.append(self._queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+
+            for (key, text) in _coalesce(items):
+                self._send_with_retries(key, text)
+
+            for _ in items:
+                self._queue.task_done()
+
+    def flush(self, timeout_sec=None):
+        """Wait until every queued message is sent, or until timeout_sec.
+
+        Returns True if everything was sent, False if we timed out.
+        """
+        # Queue.join() doesn't take a timeout, so we do it ourselves.
+        deadline = None if timeout_sec is None else time.time() + timeout_sec
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if deadline is None:
+                    self._queue.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._queue.all_tasks_done.wait(remaining)
+        return True
+
+
+_DEFAULT_QUEUE = None
+_DEFAULT_QUEUE_LOCK = threading.Lock()
+
+# How long we wait, at exit, for queued messages to be sent.
+flush_timeout_sec = 60
+
+
+def _flush_default_queue():
+    if _DEFAULT_QUEUE is not None:
+        if not _DEFAULT_QUEUE.flush(flush_timeout_sec):
+            logging.error('Timed out sending hipchat messages; '
+                          'some were not sent')
+
+
+def default_queue():
+    """Return the shared AlertQueue, creating it if need be."""
+    global _DEFAULT_QUEUE
+    with _DEFAULT_QUEUE_LOCK:
+        if _DEFAULT_QUEUE is None:
+            _DEFAULT_QUEUE = AlertQueue()
+            atexit.register(_flush_default_queue)
+        return _DEFAULT_QUEUE
+
+
+def flush(timeout_sec=None):
+    """Wait until the shared queue has sent everything queued so far.
+
+    This is for when something else is about to send to the same
+    room behind our back, and we want our messages to come first.
+    Waits at most timeout_sec (default flush_timeout_sec), and
+    returns False if we timed out.
+    """
+    if timeout_sec is None:
+        timeout_sec = flush_timeout_sec
+    if _DEFAULT_QUEUE is None:
+        return True
+    return _DEFAULT_QUEUE.flush(timeout_sec)
+
+
+def send_to_hipchat(room_name, text, sender, severity=logging.INFO,
+                    color=None, html=False, notify=False):
+    """Queue text to be sent to room_name by the shared AlertQueue."""
+    default_queue().put(room_name, text, sender, severity=severity,
+                        color=color, html=html, notify=notify)
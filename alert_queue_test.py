@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""Tests for alert_queue.py"""
+
+import BaseHTTPServer
+import logging
+import threading
+import unittest
+import urlparse
+
+import alert_queue
+
+
+class FakeHipchatServer(BaseHTTPServer.HTTPServer):
+    """Speaks just enough of the hipchat v1 API to receive messages.
+
+    Every message posted to /v1/rooms/message is appended to
+    self.messages, as a dict of the form params.  The first
+    self.num_failures requests get a 500 instead.
+    """
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           _FakeHipchatHandler)
+        self.messages = []
+        self.num_requests = 0
+        self.num_failures = 0
+
+    @property
+    def url(self):
+        return 'http://localhost:%s' % self.server_port
+
+
+class _FakeHipchatHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.num_requests += 1
+        if self.server.num_failures > 0:
+            self.server.num_failures -= 1
+            self.send_error(500)
+            return
+        assert urlparse.urlparse(self.path).path == '/v1/rooms/message'
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.messages.append(dict(urlparse.parse_qsl(body)))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('{"status": "sent"}')
+
+    def log_message(self, *args):
+        pass
+
+
+class AlertQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHipchatServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        # Send to our fake hipchat, via the real send function.
+        self.orig_base_url = alert_queue.hipchat_base_url
+        self.orig_token_fn = alert_queue._hipchat_token
+        alert_queue.hipchat_base_url = self.server.url
+        alert_queue._hipchat_token = lambda: 's3cret'
+
+    def tearDown(self):
+        alert_queue.hipchat_base_url = self.orig_base_url
+        alert_queue._hipchat_token = self.orig_token_fn
+        alert_queue._TEST_MODE = False
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def _queue(self, **kwargs):
+        kwargs.setdefault('coalesce_sec', 0.1)
+        kwargs.setdefault('backoff_sec', 0.01)
+        return alert_queue.AlertQueue(**kwargs)
+
+    def test_send(self):
+        q = self._queue()
+        q.put('room', 'hello', 'Testybot', color='green')
+        self.assertTrue(q.flush(5))
+        self.assertEqual([{'room_id': 'room', 'from': 'Testybot',
+                           'message': 'hello', 'message_format': 'text',
+                           'color': 'green', 'notify': '0',
+                           'auth_token': 's3cret'}],
+                         self.server.messages)
+
+    def test_color_from_severity(self):
+        q = self._queue()
+        q.put('room', 'uh oh', 'Testybot', severity=logging.ERROR,
+              html=True, notify=True)
+        self.assertTrue(q.flush(5))
+        self.assertEqual([('red', 'html', '1')],
+                         [(m['color'], m['message_format'], m['notify'])
+                          for m in self.server.messages])
+
+    def test_test_mode(self):
+        alert_queue.enter_test_mode()
+        q = self._queue()
+        q.put('room', 'hello', 'Testybot')
+        self.assertTrue(q.flush(5))
+        self.assertEqual(0, self.server.num_requests)
+
+    def test_coalesce(self):
+        q = self._queue(coalesce_sec=0.5)
+        q.put('room', 'one', 'Testybot')
+        q.put('other room', 'two', 'Testybot')
+        q.put('room', 'three', 'Testybot')
+        q.put('room', '<b>four</b>', 'Testybot', html=True)
+        self.assertTrue(q.flush(5))
+        self.assertEqual([('room', 'one\nthree'),
+                          ('other room', 'two'),
+                          ('room', '<b>four</b>')],
+                         [(m['room_id'], m['message'])
+                          for m in self.server.messages])
+
+    def test_order_is_preserved(self):
+        q = self._queue(coalesce_sec=0)
+        for i in xrange(20):
+            q.put('room', str(i), 'Testybot', severity=i)
+        self.assertTrue(q.flush(5))
+        self.assertEqual([str(i) for i in xrange(20)],
+                         [m['message'] for m in self.server.messages])
+
+    def test_retry(self):
+        self.server.num_failures = 2
+        q = self._queue()
+        q.put('room', 'hello', 'Testybot')
+        self.assertTrue(q.flush(5))
+        self.assertEqual(3, self.server.num_requests)
+        self.assertEqual(['hello'],
+                         [m['message'] for m in self.server.messages])
+
+    def test_give_up(self):
+        self.server.num_failures = 100
+        q = self._queue(max_tries=3)
+        q.put('room', 'hello', 'Testybot')
+        q.put('room', 'hello', 'Testybot', color='red')
+        self.assertTrue(q.flush(5))
+        self.assertEqual(6, self.server.num_requests)
+        self.assertEqual([], self.server.messages)
+
+    def test_flush_timeout(self):
+        event = threading.Event()
+        q = alert_queue.AlertQueue(lambda key, text: event.wait(),
+                                   coalesce_sec=0)
+        q.put('room', 'hello', 'Testybot')
+        self.assertFalse(q.flush(0.1))
+        event.set()
+        self.assertTrue(q.flush(5))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.ERROR)
+    unittest.main()
@@ -54,20 +54,49 @@ LINT OUTPUT
 -----------
 The linter outputs one line per error, with that line indicating where
 the error is.  Easy peasy.
+
+TEST TIMINGS
+------------
+If asked (via --timing_json or --timing_baseline), we also use the
+time= attributes in the xml test output to log the slowest tests and
+suites, and to alert on the tests that have gotten slower since a
+previous run.  We collect the times while looking for failures, so
+this doesn't cost another pass over the files.  This is
+informational: it doesn't count towards the error count.
+
+With --balance_shards, we instead use the timings from the last few
+builds to split the test classes into shards that should each take
+about the same time to run; see balance_shards().
 """
 
 import argparse
+import cgi
+import collections
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import lxml.etree
+import multiprocessing
 import os
 import re
+import SocketServer
+import sqlite3
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 
 # This requires having secrets.py (or ka_secrets.py) on your PYTHONPATH!
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)),
                              'alertlib'))
 import alertlib
 
+import alert_queue
+
 
 # We can run tests in a mode where a python tests runs jstests or lint
 # checks in a subshell.  This maps the python test name to a regexp
@@ -81,8 +110,36 @@ _ALTERNATE_TESTS = {
          re.compile('AssertionError: JSTEST ERRORS:\s*(.*)', re.DOTALL)),
 }
 
-# Maps 'lint' to the alternate-test lint output.
-_ALTERNATE_TESTS_VALUES = {}
+# In --serve mode, the handler thread for each request sets .texts to
+# a list, and _alert() appends every alert it sends to it.
+_captured_alerts = threading.local()
+
+# The summary line at the end of the jstest output.
+_JSTEST_SUMMARY_RE = re.compile(r'Finished running \d+ tests, '
+                                r'with \d+ passes and (\d+) failures.')
+
+# The keys of the records main() writes to json_out.
+_JSON_RECORD_KEYS = ('type', 'id', 'message', 'link', 'source', 'duration',
+                     'fingerprint')
+
+# What we keep around for each failing testcase.  message is the
+# 'message' attribute of the <failure> or <error> node, time is the
+# testcase's time attribute (in seconds, or None if it doesn't have
+# one), and filename is the xml file the testcase is in.  fingerprint
+# and summary are as returned by _fingerprint().
+TestcaseFailure = collections.namedtuple(
+    'TestcaseFailure', ('classname', 'name', 'message', 'time', 'filename',
+                        'fingerprint', 'summary'))
+
+# Bits of failure messages and tracebacks that differ from run to run
+# (or test to test) even when the failures have the same cause.
+_FINGERPRINT_NORMALIZERS = (
+    (re.compile(r'0x[0-9a-fA-F]+'), '0x?'),                   # addresses
+    (re.compile(r'(?:/private)?/(?:tmp|var/folders)/[^\s\'",:)]*'),
+     '<tmp>'),                                                # temp paths
+    (re.compile(r'\bline \d+'), 'line ?'),                    # line numbers
+    (re.compile(r'(\.py[co]?):\d+'), r'\1:?'),                 # file.py:12
+)
 
 
 def _alert(hipchat_room, failures, test_type, truncate=10, num_errors=None):
@@ -110,12 +167,25 @@ def _alert(hipchat_room, failures, test_type, truncate=10, num_errors=None):
     if len(failures) > truncate:
         alert_lines.append('...')
 
-    alert = alertlib.Alert('<br>\n'.join(alert_lines),
-                           severity=logging.ERROR,
+    _send_alert(hipchat_room, '<br>\n'.join(alert_lines))
+
+
+def _send_alert(hipchat_room, alert_text, severity=logging.ERROR):
+    """Send the given html to the logs, and to hipchat_room if set."""
+    # When running as a server, we send the alert text back to the client.
+    captured_alerts = getattr(_captured_alerts, 'texts', None)
+    if captured_alerts is not None:
+        captured_alerts.append(alert_text)
+
+    alert = alertlib.Alert(alert_text,
+                           severity=severity,
                            html=True)
     alert.send_to_logs()
     if hipchat_room:
-        alert.send_to_hipchat(hipchat_room, sender='Jenny Jenkins')
+        # This is sent in the background, so we don't wait on hipchat.
+        alert_queue.send_to_hipchat(hipchat_room, alert_text,
+                                    sender='Jenny Jenkins',
+                                    severity=severity, html=True)
 
 
 def _find(rootdir):
@@ -125,52 +195,489 @@ def _find(rootdir):
             yield os.path.join(root, f)
 
 
-def find_bad_testcases(test_reports_dir):
-    """Yield each failure or error testcase as lxml.etree.Element
+def _failure_node(testcase):
+    """Return the testcase's failure or error child, or None if it passed."""
+    bad_node = testcase.find('failure')
+    if bad_node is None:
+        bad_node = testcase.find('error')
+    return bad_node
 
-    See the xUnit XML format described in the module docstring to see the
-    testcase element tree in context.
+
+def _float_or_none(s):
+    """float(s), or None if s is None or not a number."""
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return None
+
+
+def _fingerprint(bad_node):
+    """Return (fingerprint, summary) for a <failure> or <error> node.
+
+    Failures with the same root cause -- 400 tests that all die on
+    the same broken import, say -- get the same fingerprint, even if
+    their tracebacks differ in memory addresses, line numbers, or temp
+    paths.  summary is a short description of the failure, usually
+    the last line of the traceback ('ImportError: No module named x').
     """
-    for filename in _find(test_reports_dir):
-        doc = lxml.etree.parse(filename)
+    parts = []
+    for text in (bad_node.get('type'), bad_node.get('message'),
+                 bad_node.text):
+        text = text or ''
+        for (regexp, replacement) in _FINGERPRINT_NORMALIZERS:
+            text = regexp.sub(replacement, text)
+        parts.append(text)
 
-        for testcase in doc.xpath("/testsuite/testcase"):
-            if testcase.get("classname") in _ALTERNATE_TESTS:
-                (type, _) = _ALTERNATE_TESTS[testcase.get("classname")]
-                _ALTERNATE_TESTS_VALUES[type] = ""
+    fingerprint_input = '\n'.join(parts)
+    if isinstance(fingerprint_input, unicode):
+        fingerprint_input = fingerprint_input.encode('utf-8')
+    fingerprint = hashlib.sha1(fingerprint_input).hexdigest()[:12]
 
-        for bad_testcase in doc.xpath("/testsuite/testcase[failure or error]"):
-            if bad_testcase.get("classname") not in _ALTERNATE_TESTS:
-                yield bad_testcase
-            else:
+    traceback_lines = [l.strip() for l in parts[2].splitlines() if l.strip()]
+    summary = (traceback_lines[-1] if traceback_lines
+               else parts[1] or parts[0] or 'unknown failure')
+    if len(summary) > 200:
+        summary = summary[:197] + '...'
+    return (fingerprint, summary)
+
+
+def _parse_report(filename, fileobj=None):
+    """Return (failures, alternate_values, timings) for one xUnit xml file.
+
+    If fileobj is not None, we read the xml from it rather than from
+    filename (which is then just used to say where failures came from).
+
+    failures is a list of TestcaseFailure tuples, and alternate_values
+    maps alternate-test type (e.g. 'lint') to its output, as described
+    in _ALTERNATE_TESTS.  Failures win over successes within a file.
+    timings is a list of [kind, name, seconds], one for each suite and
+    testcase with a (parseable) time attribute.  kind is 'suite' or
+    'test'; for suites, name is the testsuite's name attribute, and
+    for tests, it's the testcase_id().
+
+    We stream the file with iterparse rather than building the whole
+    tree, since <system-out> can be megabytes per suite.  Each testcase
+    is looked at exactly once, and is cleared as soon as we're done
+    with it, so memory stays flat no matter how big the file is.
+
+    This only returns plain tuples and dicts (no lxml elements), so it
+    is safe to run in a worker process.
+    """
+    failures = []
+    alternate_values = {}
+    timings = []
+
+    # huge_tree lets us get past libxml2's 10M limit on text nodes,
+    # which a chatty <system-out> can hit.
+    context = lxml.etree.iterparse(
+        fileobj if fileobj is not None else filename, events=('end',),
+        tag=('testsuite', 'testcase', 'system-out', 'system-err'),
+        huge_tree=True)
+    for (_, elt) in context:
+        if elt.tag == 'testsuite':
+            # Its testcases are gone by now, so this is cheap.
+            seconds = _float_or_none(elt.get('time'))
+            if seconds is not None:
+                timings.append(['suite', elt.get('name'), seconds])
+            continue
+
+        if elt.tag != 'testcase':
+            # Suite-level output: nobody needs it, so drop the text
+            # now.  (testcase-level output goes away with the
+            # testcase, below.)
+            if elt.getparent() is not None and (
+                    elt.getparent().tag == 'testsuite'):
+                elt.clear()
+            continue
+
+        if elt.getparent() is None or elt.getparent().tag != 'testsuite':
+            continue
+
+        classname = elt.get("classname")
+        seconds = _float_or_none(elt.get("time"))
+        if seconds is not None:
+            timings.append(['test', '%s.%s' % (classname, elt.get("name")),
+                            seconds])
+        bad_node = _failure_node(elt)
+        if classname not in _ALTERNATE_TESTS:
+            if bad_node is not None:
+                (fingerprint, summary) = _fingerprint(bad_node)
+                failures.append(TestcaseFailure(
+                    classname, elt.get("name"), bad_node.get("message"),
+                    seconds, filename,
+                    fingerprint, summary))
+        else:
+            (type, regex) = _ALTERNATE_TESTS[classname]
+            if bad_node is not None:
                 # If we're an alternate test (we're the test that runs
                 # the linter, say), instead of reporting the error
-                # here, we store its value in a global, and report the
-                # error along with the lint failures.
-                error_text = bad_testcase.getchildren()[0].text.rstrip()
-                (type, regex) = _ALTERNATE_TESTS[bad_testcase.get("classname")]
+                # here, we store its value, and report the error
+                # along with the lint failures.
+                error_text = bad_node.text.rstrip()
                 m = regex.search(error_text)
                 assert m, error_text
-                _ALTERNATE_TESTS_VALUES[type] = m.group(1)
+                alternate_values[type] = m.group(1)
+            else:
+                alternate_values.setdefault(type, "")
+
+        # Free the testcase, and any siblings we've already seen.
+        elt.clear()
+        while elt.getprevious() is not None:
+            del elt.getparent()[0]
+    del context
+
+    return (failures, alternate_values, timings)
+
+
+class ReportCache(object):
+    """An on-disk cache of _parse_report() results, one entry per file.
+
+    An entry is reused as long as the file's size and mtime (and,
+    if check_contents is set, the sha1 of its contents) are the same
+    as when we parsed it.  Entries for files that no longer exist are
+    dropped when we save.  hits and misses count lookups this run.
+    """
+    # Bump this whenever the format of the cache entries changes.
+    _VERSION = 4
+
+    def __init__(self, cache_file, check_contents=False):
+        self.cache_file = cache_file
+        self.check_contents = check_contents
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        # Maps filename to the key we computed in lookup(), so
+        # store() records what the file looked like *before* we
+        # parsed it.  If it changes under us, we'll re-parse next time.
+        self._pending_keys = {}
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (IOError, OSError):     # probably 'file does not exist'
+            return
+        except ValueError, why:
+            logging.warning('Ignoring corrupt report cache %s: %s'
+                            % (self.cache_file, why))
+            return
+        if data.get('version') == self._VERSION:
+            self._entries = data['entries']
+
+    def save(self):
+        # Evict entries for files that have gone away.
+        for filename in self._entries.keys():
+            if not os.path.exists(filename):
+                del self._entries[filename]
+
+        # Write-then-rename so a crash never leaves a partial cache.
+        # The cache is just an optimization, so failing to write it
+        # shouldn't fail the run.
+        tmpfile = None
+        try:
+            (fd, tmpfile) = tempfile.mkstemp(
+                prefix=os.path.basename(self.cache_file) + '.',
+                dir=os.path.dirname(os.path.abspath(self.cache_file)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': self._VERSION,
+                           'entries': self._entries},
+                          f)
+            os.rename(tmpfile, self.cache_file)
+        except (IOError, OSError), why:
+            logging.warning('Could not write report cache %s: %s'
+                            % (self.cache_file, why))
+            if tmpfile is not None and os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            return
+        logging.info('Report cache %s: %s hits, %s misses'
+                     % (self.cache_file, self.hits, self.misses))
+
+    def _key(self, filename):
+        st = os.stat(filename)
+        key = {'size': st.st_size, 'mtime': st.st_mtime}
+        if self.check_contents:
+            sha1 = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), ''):
+                    sha1.update(block)
+            key['sha1'] = sha1.hexdigest()
+        return key
+
+    def lookup(self, filename):
+        """Return the cached _parse_report() result for filename, or None."""
+        filename = os.path.abspath(filename)
+        key = self._key(filename)
+        entry = self._entries.get(filename)
+        if entry is not None and entry['key'] == key:
+            self.hits += 1
+            failures = [TestcaseFailure(*f) for f in entry['failures']]
+            return (failures, entry['alternate_values'], entry['timings'])
+        self.misses += 1
+        self._pending_keys[filename] = key
+        return None
+
+    def store(self, filename, result):
+        """Cache the _parse_report() result for a file we lookup()-ed."""
+        filename = os.path.abspath(filename)
+        (failures, alternate_values, timings) = result
+        self._entries[filename] = {
+            'key': self._pending_keys.pop(filename),
+            'failures': [list(f) for f in failures],
+            'alternate_values': alternate_values,
+            'timings': timings,
+        }
+
+
+def find_bad_testcases(test_reports_dir, jobs=1, cache=None,
+                       alternate_values=None, timings=None):
+    """Yield each failure or error testcase as a TestcaseFailure.
+
+    See the xUnit XML format described in the module docstring to see the
+    testcase element tree in context.
+
+    If jobs > 1, we parse the files in a pool of that many processes.
+    Results are merged in the same order as the serial path, so the
+    output is identical either way.
+
+    If cache is a ReportCache, files that haven't changed since it
+    last saw them are not parsed at all.
+
+    If alternate_values is not None, it should be a dict; we fill it
+    with a map from alternate-test type (e.g. 'lint') to the output
+    of that test, for every alternate test we see.  See _ALTERNATE_TESTS.
+
+    If timings is not None, it should be a list; we extend it with the
+    timings of every suite and testcase we see, as [kind, name,
+    seconds] (see _parse_report()).  This way timing reports don't
+    need a second pass over the files.
+    """
+    filenames = list(_find(test_reports_dir))
+    cached_results = {}
+    if cache is not None:
+        for filename in filenames:
+            result = cache.lookup(filename)
+            if result is not None:
+                cached_results[filename] = result
+    to_parse = [f for f in filenames if f not in cached_results]
+
+    if jobs > 1 and len(to_parse) > 1:
+        pool = multiprocessing.Pool(jobs)
+        # Big-ish chunks to keep the ipc overhead down, but small
+        # enough that one slow file doesn't hold up a whole worker.
+        chunksize = max(1, len(to_parse) // (jobs * 4))
+        parsed_results = pool.imap(_parse_report, to_parse, chunksize)
+    else:
+        pool = None
+        parsed_results = itertools.imap(_parse_report, to_parse)
+
+    try:
+        for filename in filenames:
+            if filename in cached_results:
+                result = cached_results[filename]
+            else:
+                # parsed_results is in the same order as to_parse.
+                result = next(parsed_results)
+                if cache is not None:
+                    cache.store(filename, result)
+            (failures, file_alternate_values, file_timings) = result
+            for failure in failures:
+                yield failure
+            # Later files win over earlier ones.
+            if alternate_values is not None:
+                alternate_values.update(file_alternate_values)
+            if timings is not None:
+                timings.extend(file_timings)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+class FailureHistory(object):
+    """A sqlite database of which testcases failed in which builds.
+
+    We record every run, even ones with no failures, so we can tell
+    "failed in 3 of the last 20 builds" from "has only run 3 times."
+    Testcases are identified by their testcase_id().
+    """
+    def __init__(self, db_file):
+        self._db = sqlite3.connect(db_file)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                build_url TEXT,
+                timestamp INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS failures (
+                run_id INTEGER NOT NULL,
+                test_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS failures_by_test
+                ON failures (test_id, run_id);
+        """)
+
+    def close(self):
+        self._db.close()
+
+    def record(self, build_url, test_ids):
+        """Record a run of build_url in which test_ids failed."""
+        with self._db:      # a transaction
+            cursor = self._db.execute(
+                'INSERT INTO runs (build_url, timestamp) VALUES (?, ?)',
+                (build_url, int(time.time())))
+            self._db.executemany(
+                'INSERT INTO failures (run_id, test_id) VALUES (?, ?)',
+                ((cursor.lastrowid, test_id) for test_id in test_ids))
+
+    def classify(self, test_ids, num_builds=20, flaky_threshold=1):
+        """Say how each of test_ids has fared in the last num_builds runs.
+
+        Returns a map from test-id to (status, num_failures), where
+        num_failures is how many of the last num_builds recorded
+        runs the test failed in, and status is one of:
+           'new': it didn't fail in any of them
+           'recurring': it has failed in every run since it first
+               failed (within the window), i.e. it's just broken
+           'flaky': it failed in at least flaky_threshold of them,
+               but passed in between
+        A test that failed fewer than flaky_threshold times, with
+        passes in between, is also 'new'.
+        """
+        run_ids = [row[0] for row in self._db.execute(
+            'SELECT id FROM runs ORDER BY id DESC LIMIT ?', (num_builds,))]
+        retval = dict((test_id, ('new', 0)) for test_id in test_ids)
+        if not run_ids:
+            return retval
+
+        test_ids = list(test_ids)
+        # sqlite limits how many parameters a query can take.
+        for i in xrange(0, len(test_ids), 500):
+            chunk = test_ids[i:i + 500]
+            rows = self._db.execute(
+                'SELECT test_id, COUNT(*), MIN(run_id) FROM failures '
+                'WHERE run_id >= ? AND test_id IN (%s) GROUP BY test_id'
+                % ','.join('?' * len(chunk)),
+                [run_ids[-1]] + chunk)
+            for (test_id, num_failures, first_failed_run_id) in rows:
+                runs_since_first_failure = len(
+                    [r for r in run_ids if r >= first_failed_run_id])
+                if num_failures == runs_since_first_failure:
+                    status = 'recurring'
+                elif num_failures >= flaky_threshold:
+                    status = 'flaky'
+                else:
+                    status = 'new'
+                retval[test_id] = (status, num_failures)
+        return retval
+
+
+def testcase_id(testcase):
+    """Return 'module.of.TestCase.test_name' for a TestcaseFailure."""
+    return "%s.%s" % (testcase.classname, testcase.name)
+
+
+def _testcase_url(build_url, testcase):
+    """The url of the testcase result in the Jenkins build at build_url."""
+    # the "classname" attribute is actually "module.of.TestCase"
+    module, classname = testcase.classname.rsplit(".", 1)
+    return '%s/testReport/junit/%s/%s/%s/' % (
+        build_url, module, classname, testcase.name)
 
 
 def add_links(build_url, testcase):
     """Return '<a href="...">module.of.TestCase.test_name</a>'
 
     Links to the testcase result in the Jenkins build at build_url.
+    testcase is a TestcaseFailure.
     """
-    display_name = "%s.%s" % (testcase.get("classname"),
-                              testcase.get("name"))
-    # the "classname" attribute is actually "module.of.TestCase"
-    module, classname = testcase.get("classname").rsplit(".", 1)
-    return '<a href="%s/testReport/junit/%s/%s/%s/">%s</a>' % (
-        build_url, module, classname, testcase.get("name"), display_name)
+    return '<a href="%s">%s</a>' % (_testcase_url(build_url, testcase),
+                                    testcase_id(testcase))
+
+
+def _failure_record(build_url, testcase):
+    """The dict that main() writes to json_out for a TestcaseFailure."""
+    return {'type': 'python',
+            'id': testcase_id(testcase),
+            'message': testcase.message,
+            'link': _testcase_url(build_url, testcase),
+            'source': testcase.filename,
+            'duration': testcase.time,
+            'fingerprint': testcase.fingerprint}
+
+
+def _test_failure_lines(build_url, testcases, notes=None,
+                        min_cluster_size=2):
+    """Return the lines to alert with for the given TestcaseFailures.
+
+    Testcases that failed in the same way (that have the same
+    fingerprint), if there are at least min_cluster_size of them, are
+    collapsed into one line: 'N tests failed with <summary>'.  Those
+    come first, biggest first; then the rest, one link per testcase.
+    notes, if not None, maps testcase_id() to a note to add after
+    that testcase's link.
+    """
+    notes = notes or {}
+
+    def link(testcase):
+        retval = add_links(build_url, testcase)
+        if testcase_id(testcase) in notes:
+            retval += ' ' + notes[testcase_id(testcase)]
+        return retval
+
+    by_fingerprint = collections.defaultdict(list)
+    for testcase in testcases:
+        by_fingerprint[testcase.fingerprint].append(testcase)
+
+    clusters = []
+    singletons = []
+    for group in by_fingerprint.itervalues():
+        if len(group) >= min_cluster_size:
+            group.sort(key=testcase_id)
+            clusters.append((-len(group), group[0].summary, group[0]))
+        else:
+            singletons.extend(group)
+
+    retval = ['%s tests failed with <code>%s</code>, e.g. %s'
+              % (-negative_size, cgi.escape(summary), link(example))
+              for (negative_size, summary, example) in sorted(clusters)]
+    # Sort output so it is easy to compare across runs.
+    retval.extend(sorted(link(t) for t in singletons))
+    return retval
+
+
+def _history_note(status, num_failures, num_builds):
+    """A human-readable version of what FailureHistory.classify() said."""
+    if status == 'recurring':
+        return ('(recurring: also failed the last %s build%s)'
+                % (num_failures, 's' if num_failures != 1 else ''))
+    elif status == 'flaky':
+        return ('(flaky: failed %s of the last %s builds)'
+                % (num_failures, num_builds))
+    return '(new)'
 
 
 def report_test_failures(test_reports_dir, jenkins_build_url,
-                         hipchat_room):
+                         hipchat_room, jobs=1, cache=None,
+                         alternate_values=None, history=None,
+                         history_builds=20, flaky_threshold=1,
+                         on_failure=None, timings=None):
     """Alert for test (as opposed to jstest or lint) failures.
 
+    jobs is the number of processes to use to parse the test reports.
+    cache, if not None, is a ReportCache to use to avoid re-parsing them.
+    alternate_values and timings are filled in as described in
+    find_bad_testcases().
+
+    If history is a FailureHistory, we record this run's failures in
+    it, and mark each failure as new, recurring, or flaky based on
+    the last history_builds runs (see FailureHistory.classify()).
+
+    If on_failure is not None, we call it with a dict describing each
+    failure (see main()) as soon as we find it.
+
+    Failures with the same cause are grouped together in the alert;
+    see _test_failure_lines().
+
     Returns the number of errors seen.
     """
     if not os.path.exists(test_reports_dir):
@@ -178,88 +685,650 @@ def report_test_failures(test_reports_dir, jenkins_build_url,
 
     jenkins_build_url = jenkins_build_url.rstrip("/")
 
-    # Sort output so it is easy to compare across runs.
-    failures = []
-    for bad_testcase in find_bad_testcases(test_reports_dir):
-        failures.append(add_links(jenkins_build_url, bad_testcase))
-    failures.sort()
-    _alert(hipchat_room, failures, 'Python test')
-    return len(failures)
+    bad_testcases = []
+    for bad_testcase in find_bad_testcases(test_reports_dir, jobs, cache,
+                                           alternate_values, timings):
+        bad_testcases.append(bad_testcase)
+        if on_failure is not None:
+            on_failure(_failure_record(jenkins_build_url, bad_testcase))
 
+    notes = {}
+    if history is not None:
+        test_ids = [testcase_id(t) for t in bad_testcases]
+        statuses = history.classify(test_ids, history_builds,
+                                    flaky_threshold)
+        history.record(jenkins_build_url, test_ids)
+        for (test_id, (status, num_failures)) in statuses.iteritems():
+            notes[test_id] = _history_note(status, num_failures,
+                                           history_builds)
+
+    failures = _test_failure_lines(jenkins_build_url, bad_testcases, notes)
+    _alert(hipchat_room, failures, 'Python test',
+           num_errors=len(bad_testcases))
+    return len(bad_testcases)
 
-def report_jstest_failures(jstest_reports_file, hipchat_room):
-    """Alert for jstest (as opposed to python-test or lint) failures."""
-    if not os.path.exists(jstest_reports_file):
-        return 0
 
+def report_jstest_failures(lines, hipchat_room, truncate=10,
+                           on_failure=None):
+    """Alert for jstest (as opposed to python-test or lint) failures.
+
+    lines is an iterator over the lines of the jstest output: a file,
+    a list, a generator, etc.  We only hold on to the first truncate
+    failure-lines (plus one, so _alert knows there were more), so
+    memory use doesn't depend on how big the output is.  But we call
+    on_failure, if not None, with a dict for every failure-line.
+    """
     failures = []
     num_errors = 0
-    with open(jstest_reports_file, 'rU') as infile:
-        for line in infile.readlines():
-            if line.startswith('\t'):
+    for line in lines:
+        if line.startswith('\t'):
+            if len(failures) <= truncate:
                 failures.append(line[1:])  # trim first \t
-            elif line.startswith('Finished running '):
-                m = re.match('Finished running \d+ tests, '
-                             'with \d+ passes and (\d+) failures.', line)
-                assert m, line
-                num_errors += int(m.group(1))
-            elif line.startswith('Timeout: tests did not start'):
+            if on_failure is not None:
+                on_failure({'type': 'jstest', 'message': line.strip()})
+        elif line.startswith('Finished running '):
+            m = _JSTEST_SUMMARY_RE.match(line)
+            assert m, line
+            num_errors += int(m.group(1))
+        elif line.startswith('Timeout: tests did not start'):
+            if len(failures) <= truncate:
                 failures.append(line)
-                # Timeouts are ignored in the "Finished running x tests"
-                # reports, so we have to count these errors manually.
-                num_errors += 1
-            elif line.startswith('PhantomJS has crashed.'):
+            if on_failure is not None:
+                on_failure({'type': 'jstest', 'message': line.strip()})
+            # Timeouts are ignored in the "Finished running x tests"
+            # reports, so we have to count these errors manually.
+            num_errors += 1
+        elif line.startswith('PhantomJS has crashed.'):
+            if len(failures) <= truncate:
                 failures.append(line)
-                # Crashes are ignored in the "Finished running x tests"
-                # reports, so we have to count these errors manually.
-                num_errors += 1
-    _alert(hipchat_room, failures, 'JavaScript test', num_errors=num_errors)
+            if on_failure is not None:
+                on_failure({'type': 'jstest', 'message': line.strip()})
+            # Crashes are ignored in the "Finished running x tests"
+            # reports, so we have to count these errors manually.
+            num_errors += 1
+    _alert(hipchat_room, failures, 'JavaScript test', truncate=truncate,
+           num_errors=num_errors)
     return num_errors
 
 
-def report_lint_failures(lint_reports_file, hipchat_room):
-    """Alert for lint (as opposed to python-test or jstest) failures."""
-    if not os.path.exists(lint_reports_file):
+def report_lint_failures(lines, hipchat_room, truncate=10,
+                         on_failure=None):
+    """Alert for lint (as opposed to python-test or jstest) failures.
+
+    lines is an iterator over the lines of the lint output.  As with
+    report_jstest_failures, we only keep the first few lines around,
+    and call on_failure, if not None, for every one.
+    """
+    failures = []
+    num_errors = 0
+    for line in lines:
+        if len(failures) <= truncate:
+            failures.append(line)
+        if on_failure is not None:
+            # Lint lines look like 'path/to/file.py:12:3: E302 ...'.
+            on_failure({'type': 'lint',
+                        'id': line.split(' ', 1)[0].rstrip(':'),
+                        'message': line.strip()})
+        num_errors += 1
+    _alert(hipchat_room, failures, 'Lint check', truncate=truncate,
+           num_errors=num_errors)
+    return num_errors
+
+
+def _keep_largest(heap, n, item):
+    """Keep the n largest items seen so far in heap, a min-heap."""
+    if len(heap) < n:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def report_test_timings(timings, hipchat_room, top_n=10,
+                        baseline=None, slower_pct=50.0, slower_min_sec=1.0):
+    """Report the slowest tests and suites, and tests that got slower.
+
+    timings is an iterable of [kind, name, seconds], as collected by
+    find_bad_testcases().
+
+    baseline, if not None, is a map from testcase_id() to how long
+    that test took in some previous run (the 'test_times' from a
+    previous call, say).  We flag every test that is more than
+    slower_pct percent slower than its baseline, ignoring tests that
+    took less than slower_min_sec (since tiny tests are noisy).  We
+    only alert if some test got slower; the slowest tests and suites
+    just go to the logs.
+
+    Returns a dict suitable for json-ing, with keys
+       slowest_tests: [[test_id, seconds], ...], slowest first
+       slowest_suites: [[suite_name, seconds], ...], slowest first
+       slower_than_baseline: [[test_id, seconds, baseline_seconds], ...]
+       test_times: {test_id: seconds}, for use as a future baseline
+    """
+    # Min-heaps of (seconds, name).
+    slowest_tests = []
+    slowest_suites = []
+    slower_tests = []
+    test_times = {}
+    for (kind, name, seconds) in timings:
+        if kind == 'suite':
+            _keep_largest(slowest_suites, top_n, (seconds, name))
+            continue
+        _keep_largest(slowest_tests, top_n, (seconds, name))
+        test_times[name] = seconds
+        if baseline and seconds >= slower_min_sec:
+            old_seconds = baseline.get(name)
+            if old_seconds is not None and (
+                    seconds > old_seconds * (1 + slower_pct / 100.0)):
+                slower_tests.append([name, seconds, old_seconds])
+
+    retval = {
+        'slowest_tests': [[name, seconds] for (seconds, name)
+                          in sorted(slowest_tests, reverse=True)],
+        'slowest_suites': [[name, seconds] for (seconds, name)
+                           in sorted(slowest_suites, reverse=True)],
+        # Biggest slowdowns first.
+        'slower_than_baseline': sorted(slower_tests,
+                                       key=lambda t: t[1] - t[2],
+                                       reverse=True),
+        'test_times': test_times,
+    }
+
+    log_lines = ['Slowest %s tests:' % len(retval['slowest_tests'])]
+    log_lines.extend('%.1fs %s' % (seconds, name)
+                     for (name, seconds) in retval['slowest_tests'])
+    log_lines.append('Slowest %s suites:' % len(retval['slowest_suites']))
+    log_lines.extend('%.1fs %s' % (seconds, name)
+                     for (name, seconds) in retval['slowest_suites'])
+    logging.info('\n'.join(log_lines))
+
+    if slower_tests:
+        alert_lines = ['%s tests got more than %s%% slower:'
+                       % (len(slower_tests), slower_pct)]
+        alert_lines.extend(
+            '%s (%.1fs -> %.1fs)' % (name, old_seconds, seconds)
+            for (name, seconds, old_seconds)
+            in retval['slower_than_baseline'][:top_n])
+        if len(slower_tests) > top_n:
+            alert_lines.append('...')
+        _send_alert(hipchat_room, '<br>\n'.join(alert_lines),
+                    logging.WARNING)
+
+    return retval
+
+
+def _class_times(source):
+    """Return a map from test class to how long its tests took in source.
+
+    source is either a directory of xml test reports, or a
+    --timing_json file.  The test class is 'module.of.TestCase'.
+    """
+    if os.path.isdir(source):
+        test_times = ((name, seconds)
+                      for filename in _find(source)
+                      for (kind, name, seconds) in _parse_report(filename)[2]
+                      if kind == 'test')
+    else:
+        with open(source) as f:
+            test_times = json.load(f)['test_times'].iteritems()
+
+    retval = collections.defaultdict(float)
+    for (test_id, seconds) in test_times:
+        retval[test_id.rsplit('.', 1)[0]] += seconds
+    return retval
+
+
+def decayed_class_times(sources, decay=0.5):
+    """Return a map from test class to its decayed-average duration.
+
+    sources is a list of report-dirs or --timing_json files, one per
+    build, oldest first.  Each build moves a class's average decay of
+    the way towards that build's time, so recent builds count most.
+    Classes missing from a build keep their old average.
+    """
+    retval = {}
+    for source in sources:
+        for (classname, seconds) in _class_times(source).iteritems():
+            if classname in retval:
+                retval[classname] += decay * (seconds - retval[classname])
+            else:
+                retval[classname] = seconds
+    return retval
+
+
+def balance_shards(class_times, num_shards):
+    """Split test classes into num_shards shards of about equal run-time.
+
+    We use the greedy longest-processing-time-first rule: go through
+    the classes from slowest to fastest, putting each in whichever
+    shard has the least work so far.  Returns a list of
+    (estimated_seconds, [classname, ...]), one per shard.
+    """
+    # A min-heap of (total_seconds, shard_index).
+    heap = [(0.0, i) for i in xrange(num_shards)]
+    shards = [[] for _ in xrange(num_shards)]
+    totals = [0.0] * num_shards
+    # Break ties by name so the output is stable from run to run.
+    for (classname, seconds) in sorted(class_times.iteritems(),
+                                       key=lambda (c, s): (-s, c)):
+        (total, shard) = heapq.heappop(heap)
+        shards[shard].append(classname)
+        totals[shard] = total + seconds
+        heapq.heappush(heap, (totals[shard], shard))
+    return [(totals[i], sorted(shards[i])) for i in xrange(num_shards)]
+
+
+def write_shard_file(shards, shard_file):
+    """Write the output of balance_shards() for build-make-target.sh.
+
+    Each line is '<shard-index> <test class>'.  There are also
+    comment lines, starting with #, with the estimated time per shard.
+    Test classes that aren't listed (because they're new, say) are
+    up to the test runner; build-make-target.sh doesn't see them.
+    """
+    with open(shard_file, 'w') as f:
+        for (i, (seconds, classnames)) in enumerate(shards):
+            print >>f, ('# shard %s: %s classes, about %.0f seconds'
+                        % (i, len(classnames), seconds))
+        for (i, (_, classnames)) in enumerate(shards):
+            for classname in classnames:
+                print >>f, '%s %s' % (i, classname)
+
+
+def _is_tarball(path):
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
+
+def _worker_report_files(root, jstest_basename, lint_basename):
+    """Yield (kind, name, fileobj) for every report file in root.
+
+    root is one worker's genfiles directory, or a tarball of it.
+    kind is 'xml' for the xml test reports (any .xml file under a
+    test-reports directory), 'jstest' for a file named jstest_basename,
+    and 'lint' for a file named lint_basename.  Other files are
+    ignored.  name is a human-readable name for the file.
+
+    Tarballs are read in stream mode, without unpacking anything to
+    disk, so each fileobj must be used up before asking for the next.
+    """
+    def kind_of(path):
+        parts = path.replace(os.sep, '/').split('/')
+        if parts[-1] == jstest_basename:
+            return 'jstest'
+        elif parts[-1] == lint_basename:
+            return 'lint'
+        elif 'test-reports' in parts[:-1] and parts[-1].endswith('.xml'):
+            return 'xml'
+        return None
+
+    if _is_tarball(root):
+        # 'r|*' is a stream: we can't seek, but we never hold more
+        # than the current member.
+        with contextlib.closing(tarfile.open(root, 'r|*')) as tar:
+            for member in tar:
+                if member.isfile() and kind_of(member.name):
+                    yield (kind_of(member.name),
+                           '%s:%s' % (root, member.name),
+                           tar.extractfile(member))
+    else:
+        for filename in sorted(_find(root)):
+            kind = kind_of(os.path.relpath(filename, root))
+            if kind:
+                with open(filename, 'rU') as f:
+                    yield (kind, filename, f)
+
+
+def _is_jstest_report_line(line):
+    """True if report_jstest_failures() would pay attention to line."""
+    return line.startswith(('\t', 'Finished running ',
+                            'Timeout: tests did not start',
+                            'PhantomJS has crashed.'))
+
+
+def report_worker_failures(roots, jenkins_build_url, hipchat_room,
+                           jstest_basename='jstest_output.txt',
+                           lint_basename='lint_errors.txt',
+                           on_failure=None):
+    """Alert once for the combined failures of several test workers.
+
+    When 'make check' is split across workers, each has its own
+    test-reports, jstest output, and lint output.  roots is a list of
+    those workers' genfiles directories (or tarballs of them).  We
+    send one alert per kind of failure for all of them together.
+
+    A python testcase that fails on several workers is only counted
+    once, as is a lint error reported by several workers.  jstest
+    counts are added up.  As in main(), alternate-test output from a
+    worker's xml reports wins over that worker's jstest/lint file.
+
+    If on_failure is not None, we call it for each failure, as main()
+    does, with the 'source' being the worker's file it came from.
+
+    Returns a map from 'python', 'jstest' and 'lint' to the number of
+    errors of that kind.
+    """
+    jenkins_build_url = jenkins_build_url.rstrip("/")
+    failures_by_id = {}
+    # A list of (source, lines) pairs, one per worker.  lines is a
+    # temp file of the worker's jstest lines, so memory use doesn't
+    # depend on how big the output is, or its alternate-test output.
+    jstest_sources = []
+    # We use a dict as an ordered set: the values are the order seen,
+    # and the source of the line.
+    lint_lines = {}
+
+    for root in roots:
+        alternate_values = {}
+        jstest_file = tempfile.TemporaryFile()
+        jstest_source = lint_source = None
+        worker_lint_lines = []
+        for (kind, name, f) in _worker_report_files(root, jstest_basename,
+                                                    lint_basename):
+            if kind == 'xml':
+                (failures, file_alternate_values, _) = _parse_report(name, f)
+                alternate_values.update(file_alternate_values)
+                for failure in failures:
+                    if testcase_id(failure) in failures_by_id:
+                        continue     # another worker already reported it
+                    failures_by_id[testcase_id(failure)] = failure
+                    if on_failure is not None:
+                        on_failure(_failure_record(jenkins_build_url,
+                                                   failure))
+            elif kind == 'jstest':
+                jstest_file.writelines(l for l in f
+                                       if _is_jstest_report_line(l))
+                jstest_source = name
+            else:
+                worker_lint_lines.extend(f)
+                lint_source = name
+
+        if 'javascript' in alternate_values:
+            jstest_file.close()
+            jstest_sources.append(
+                ('%s:<alternate test>' % root,
+                 alternate_values['javascript'].splitlines(True)))
+        elif jstest_source is not None:
+            jstest_file.seek(0)
+            jstest_sources.append((jstest_source, jstest_file))
+        else:
+            jstest_file.close()
+        if 'lint' in alternate_values:
+            worker_lint_lines = alternate_values['lint'].splitlines(True)
+            lint_source = '%s:<alternate test>' % root
+        for line in worker_lint_lines:
+            lint_lines.setdefault(line, (len(lint_lines), lint_source))
+
+    failures = _test_failure_lines(jenkins_build_url,
+                                   failures_by_id.values())
+    _alert(hipchat_room, failures, 'Python test',
+           num_errors=len(failures_by_id))
+
+    # The report_*_failures() functions call on_failure for a line
+    # right after reading it, so we know which source it came from.
+    current_source = [None]
+    if on_failure is not None:
+        original_on_failure = on_failure
+
+        def on_failure(record):
+            original_on_failure(dict(record, source=current_source[0]))
+
+    def jstest_lines():
+        for (source, lines) in jstest_sources:
+            current_source[0] = source
+            for line in lines:
+                yield line
+
+    def sorted_lint_lines():
+        for line in sorted(lint_lines, key=lint_lines.get):
+            current_source[0] = lint_lines[line][1]
+            yield line
+
+    try:
+        num_jstest_errors = report_jstest_failures(
+            jstest_lines(), hipchat_room, on_failure=on_failure)
+    finally:
+        for (_, lines) in jstest_sources:
+            if hasattr(lines, 'close'):
+                lines.close()
+
+    return {
+        'python': len(failures_by_id),
+        'jstest': num_jstest_errors,
+        'lint': report_lint_failures(sorted_lint_lines(), hipchat_room,
+                                     on_failure=on_failure),
+    }
+
+
+def _analyze_report(report_fn, reports_file, alternate_output, hipchat_room,
+                    on_failure=None):
+    """Call report_fn on the output of an alternate test, or reports_file.
+
+    If we ran the alternate test (the python test that runs lint, say),
+    its output is what we want, so we use it directly.  Otherwise we
+    read the report file, if it exists.  Returns report_fn's retval.
+
+    If on_failure is not None, report_fn calls it for each failure;
+    we add the 'source' of the failure to what it's called with.
+    """
+    if on_failure is not None:
+        source = ('<alternate test>' if alternate_output is not None
+                  else reports_file)
+        original_on_failure = on_failure
+
+        def on_failure(record):
+            original_on_failure(dict(record, source=source))
+
+    if alternate_output is not None:
+        return report_fn(alternate_output.splitlines(True), hipchat_room,
+                         on_failure=on_failure)
+    if not os.path.exists(reports_file):
         return 0
+    with open(reports_file, 'rU') as infile:
+        return report_fn(infile, hipchat_room, on_failure=on_failure)
 
-    with open(lint_reports_file, 'rU') as infile:
-        failures = infile.readlines()
-    _alert(hipchat_room, failures, 'Lint check')
-    return len(failures)
+
+def _ndjson_writer(outfile):
+    """Return a function that writes a failure-record to outfile as json.
+
+    Each record is written as one line, and flushed right away, so
+    folks can tail outfile while we're still working.  Keys that
+    the record doesn't have are written as null.
+    """
+    def write(record):
+        full_record = dict.fromkeys(_JSON_RECORD_KEYS)
+        full_record.update(record)
+        outfile.write(json.dumps(full_record, sort_keys=True) + '\n')
+        outfile.flush()
+    return write
 
 
 def main(jenkins_build_url, test_reports_dir,
-         jstest_reports_file, lint_reports_file, hipchat_room, dry_run):
+         jstest_reports_file, lint_reports_file, hipchat_room, dry_run,
+         jobs=1, cache_file=None, cache_check_contents=False,
+         history_db=None, history_builds=20, flaky_threshold=1,
+         timing_json=None, timing_baseline=None, timing_top_n=10,
+         slower_pct=50.0, json_out=None, worker_reports=None):
+    """Analyze all the output files and alert; return the number of errors.
+
+    If json_out is not None, we also write a json record to that file
+    for every failure, as we find it, one per line.  Each record has
+    these keys (some of which may be null):
+       type: 'python', 'jstest', or 'lint'
+       id: 'module.of.TestCase.test_name' or 'path/to/file.py:12:3'
+       message: the failure message
+       link: the url of the failure in jenkins
+       source: the file the failure was reported in
+       duration: how long the test took, in seconds
+    The last line is a record with type 'summary' and the number of
+    errors of each type, as num_errors, num_python_errors, etc.
+
+    If worker_reports is not None, it's a list of genfiles directories
+    (or tarballs) from several test workers, and we analyze those
+    instead of test_reports_dir etc; see report_worker_failures().
+    We still use the basenames of jstest_reports_file and
+    lint_reports_file to find those files in each worker's genfiles.
+    """
     if dry_run:
         alertlib.enter_test_mode()
+        alert_queue.enter_test_mode()
         logging.getLogger().setLevel(logging.INFO)
 
-    num_errors = 0
+    if json_out:
+        json_outfile = open(json_out, 'w')
+        on_failure = _ndjson_writer(json_outfile)
+    else:
+        json_outfile = None
+        on_failure = None
 
-    if test_reports_dir:
-        num_errors += report_test_failures(test_reports_dir,
-                                           jenkins_build_url,
-                                           hipchat_room)
-
-    # If we ran any of the alternate-tests above, we'll fake having
-    # emitted otuput to the output file.
-
-    if jstest_reports_file:
-        if 'javascript' in _ALTERNATE_TESTS_VALUES:
-            with open(jstest_reports_file, 'w') as f:
-                # TODO(csilvers): send a cStringIO to report_* instead.
-                f.write(_ALTERNATE_TESTS_VALUES['javascript'])
-        num_errors += report_jstest_failures(jstest_reports_file,
-                                             hipchat_room)
-
-    if lint_reports_file:
-        if 'lint' in _ALTERNATE_TESTS_VALUES:
-            with open(lint_reports_file, 'w') as f:
-                f.write(_ALTERNATE_TESTS_VALUES['lint'])
-        num_errors += report_lint_failures(lint_reports_file,
-                                           hipchat_room)
+    try:
+        num_errors = {'python': 0, 'jstest': 0, 'lint': 0}
+        # Maps 'lint' to the alternate-test lint output, etc.
+        alternate_values = {}
+        # The test timings, collected while we look for failures.
+        timings = [] if (timing_json or timing_baseline) else None
 
-    return num_errors
+        if worker_reports:
+            num_errors = report_worker_failures(
+                worker_reports, jenkins_build_url, hipchat_room,
+                os.path.basename(jstest_reports_file or 'jstest_output.txt'),
+                os.path.basename(lint_reports_file or 'lint_errors.txt'),
+                on_failure)
+            # We've seen all the files now, so skip the code below.
+            test_reports_dir = jstest_reports_file = lint_reports_file = None
+
+        if test_reports_dir:
+            cache = None
+            if cache_file:
+                # We don't create the cache's directory: if it's not
+                # there, we're probably not being run from webapp.
+                cache_dir = os.path.dirname(os.path.abspath(cache_file))
+                if os.path.isdir(cache_dir):
+                    cache = ReportCache(cache_file, cache_check_contents)
+                    cache.load()
+                else:
+                    logging.info('Not caching test reports: %s does not '
+                                 'exist' % cache_dir)
+            history = FailureHistory(history_db) if history_db else None
+            try:
+                num_errors['python'] += report_test_failures(
+                    test_reports_dir, jenkins_build_url, hipchat_room,
+                    jobs, cache, alternate_values,
+                    history, history_builds, flaky_threshold, on_failure,
+                    timings)
+            finally:
+                if history is not None:
+                    history.close()
+            if cache is not None:
+                cache.save()
+
+        if timings:
+            baseline = None
+            if timing_baseline and os.path.exists(timing_baseline):
+                with open(timing_baseline) as f:
+                    baseline = json.load(f)['test_times']
+            timing_report = report_test_timings(timings, hipchat_room,
+                                                timing_top_n, baseline,
+                                                slower_pct)
+            if timing_json:
+                with open(timing_json, 'w') as f:
+                    json.dump(timing_report, f, indent=2, sort_keys=True)
+
+        if jstest_reports_file:
+            num_errors['jstest'] += _analyze_report(
+                report_jstest_failures, jstest_reports_file,
+                alternate_values.get('javascript'), hipchat_room, on_failure)
+
+        if lint_reports_file:
+            num_errors['lint'] += _analyze_report(
+                report_lint_failures, lint_reports_file,
+                alternate_values.get('lint'), hipchat_room, on_failure)
+
+        total_errors = sum(num_errors.itervalues())
+        if on_failure is not None:
+            on_failure({'type': 'summary',
+                        'num_errors': total_errors,
+                        'num_python_errors': num_errors['python'],
+                        'num_jstest_errors': num_errors['jstest'],
+                        'num_lint_errors': num_errors['lint']})
+        return total_errors
+    finally:
+        if json_outfile is not None:
+            json_outfile.close()
+
+
+class _AnalyzeRequestHandler(SocketServer.StreamRequestHandler):
+    """Handle one analyze request from analyze_make_output_client.py.
+
+    The request is a single line of json holding the arguments to
+    main().  We reply with a single line of json: either
+    {"num_errors": <int>, "alerts": [<alert html>, ...]}, or
+    {"error": <string>} if the request was bad or the analysis
+    itself failed.
+    """
+    def handle(self):
+        request = None
+        _captured_alerts.texts = []
+        try:
+            request = json.loads(self.rfile.readline())
+            # main()'s dry_run affects the whole server, so for a
+            # dry-run request we just don't send to hipchat: the
+            # alerts still go to the logs, and back to the client.
+            if request.get('dry_run'):
+                hipchat_room = None
+            else:
+                hipchat_room = request.get('hipchat_room')
+            num_errors = main(request.get('build_url'),
+                              request.get('test_reports_dir'),
+                              request.get('jstest_reports_file'),
+                              request.get('lint_reports_file'),
+                              hipchat_room,
+                              False,
+                              request.get('jobs') or self.server.jobs,
+                              request.get('cache_file'),
+                              request.get('cache_check_contents', False),
+                              request.get('history_db'),
+                              json_out=request.get('json_out'))
+            response = {'num_errors': num_errors,
+                        'alerts': _captured_alerts.texts}
+        except Exception, why:
+            logging.exception('Error analyzing %s' % request)
+            response = {'error': '%s: %s' % (why.__class__.__name__, why)}
+        finally:
+            _captured_alerts.texts = None
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class AnalyzeServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    """A long-lived server that runs main() for each client request.
+
+    This saves every jenkins job from paying for python startup and
+    the lxml/alertlib imports.  Each request is handled in its own
+    thread, so analyses for different builds can run concurrently.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, jobs=1):
+        # Clean up after a previous server that didn't exit cleanly.
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _AnalyzeRequestHandler)
+        self.jobs = jobs
+
+
+def serve(socket_path, dry_run, jobs=1):
+    """Answer analyze requests on the unix socket socket_path, forever."""
+    if dry_run:
+        alertlib.enter_test_mode()
+        alert_queue.enter_test_mode()
+    logging.getLogger().setLevel(logging.INFO)
+    server = AnalyzeServer(socket_path, jobs)
+    logging.info('Listening for analyze requests on %s' % socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
 
 
 if __name__ == '__main__':
@@ -283,10 +1352,95 @@ if __name__ == '__main__':
                               "notifications"))
     parser.add_argument('--dry-run', '-n', action='store_true',
                         help='Log instead of sending to hipchat.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help=('How many processes to use to parse the '
+                              'test reports (default %(default)s)'))
+    parser.add_argument('--cache_file',
+                        default='genfiles/.analyze_cache',
+                        help=('Where to cache the parsed test reports, so '
+                              'unchanged files are not re-parsed next time'))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the --cache_file.')
+    parser.add_argument('--cache-check-contents', action='store_true',
+                        help=('Also compare file contents (not just size '
+                              'and mtime) before trusting the cache.'))
+    parser.add_argument('--history_db',
+                        help=('A sqlite file to record test failures in, '
+                              'so we can tell new failures from recurring '
+                              'and flaky ones.  Off by default.'))
+    parser.add_argument('--history-builds', type=int, default=20,
+                        help=('With --history_db, how many past builds to '
+                              'look at (default %(default)s)'))
+    parser.add_argument('--flaky-threshold', type=int, default=1,
+                        help=('With --history_db, call a test flaky if it '
+                              'failed, on and off, in at least this many '
+                              'of the past builds (default %(default)s)'))
+    parser.add_argument('--timing_json',
+                        help=('If set, write the slowest tests and suites '
+                              '(and all test times) to this json file'))
+    parser.add_argument('--timing_baseline',
+                        help=('A --timing_json file from a previous run; '
+                              'alert on tests that have gotten slower '
+                              'since then'))
+    parser.add_argument('--timing-top-n', type=int, default=10,
+                        help=('How many of the slowest tests and suites '
+                              'to report (default %(default)s)'))
+    parser.add_argument('--slower-pct', type=float, default=50.0,
+                        help=('With --timing_baseline, flag tests that got '
+                              'more than this percent slower '
+                              '(default %(default)s)'))
+    parser.add_argument('--balance_shards', type=int, metavar='N',
+                        help=('Instead of analyzing, split the test classes '
+                              'into N shards of about equal run-time, based '
+                              'on --timing_history, and write them to '
+                              '--shard_file'))
+    parser.add_argument('--timing_history', nargs='+', default=[],
+                        help=('With --balance_shards, the test-report dirs '
+                              'or --timing_json files of the last few '
+                              'builds, oldest first'))
+    parser.add_argument('--timing-decay', type=float, default=0.5,
+                        help=('With --balance_shards, how far each build '
+                              'moves the average towards its own times '
+                              '(0 < decay <= 1; default %(default)s)'))
+    parser.add_argument('--shard_file',
+                        default='genfiles/test_shards.txt',
+                        help='With --balance_shards, where to write them')
+    parser.add_argument('--json-out',
+                        help=('Also write every failure, and a final '
+                              'summary, to this file as json, one record '
+                              'per line, as we find them'))
+    parser.add_argument('--worker_reports', nargs='+',
+                        help=('Analyze the genfiles directories (or '
+                              'tarballs of them) of several test workers '
+                              'together, and send one combined alert, '
+                              'instead of --test_reports_dir etc'))
+    parser.add_argument('--serve', action='store_true',
+                        help=('Instead of analyzing, run as a server that '
+                              'analyzes on behalf of '
+                              'analyze_make_output_client.py'))
+    parser.add_argument('--socket',
+                        default='/tmp/analyze_make_output.sock',
+                        help='With --serve, the unix socket to listen on')
     args = parser.parse_args()
 
+    if args.serve:
+        serve(args.socket, args.dry_run, args.jobs)
+        sys.exit(0)
+
+    if args.balance_shards:
+        class_times = decayed_class_times(args.timing_history,
+                                          args.timing_decay)
+        write_shard_file(balance_shards(class_times, args.balance_shards),
+                         args.shard_file)
+        sys.exit(0)
+
     rc = main(args.jenkins_build_url, args.test_reports_dir,
               args.jstest_reports_file, args.lint_reports_file,
-              args.hipchat_room, args.dry_run)
+              args.hipchat_room, args.dry_run, args.jobs,
+              None if args.no_cache else args.cache_file,
+              args.cache_check_contents, args.history_db,
+              args.history_builds, args.flaky_threshold,
+              args.timing_json, args.timing_baseline, args.timing_top_n,
+              args.slower_pct, args.json_out, args.worker_reports)
     # We cap num-errors at 127 because rc >= 128 is reserved for signals.
     sys.exit(min(rc, 127))
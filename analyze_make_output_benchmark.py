@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""Benchmarks for analyze_make_output.py at scale.
+
+analyze_make_output_test.py checks that we get the right answers on
+small inputs; this checks how long it takes, and how much memory it
+uses, on big ones.  We generate a synthetic genfiles directory --
+lots of xml test reports, some failing, with big <system-out> blobs,
+plus big jstest and lint logs -- and time each of:
+   report_test_failures()
+   report_jstest_failures()
+   report_lint_failures()
+   main()   (end to end)
+
+Each benchmark runs in its own process, so its peak RSS is its own.
+We print the results as json (and write them to --output if given).
+
+If you pass in --baseline (the --output of a previous run), we exit
+with rc 1 if any benchmark's wall time or peak RSS got more than
+--threshold-pct percent worse than the baseline.  A typical use:
+   ./analyze_make_output_benchmark.py --output /tmp/before.json
+   <make your change>
+   ./analyze_make_output_benchmark.py --baseline /tmp/before.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import analyze_make_output
+
+
+_TESTCASES_PER_FILE = 50
+
+
+def _write_test_reports(reports_dir, num_testcases, failure_ratio,
+                        system_out_kb, rng):
+    """Write xml test reports holding num_testcases testcases in all."""
+    system_out = 'x' * (system_out_kb * 1024)
+    num_files = 0
+    for file_index in xrange(0, num_testcases, _TESTCASES_PER_FILE):
+        classname = 'bench_%s_test.Bench%sTest' % (file_index, file_index)
+        filename = os.path.join(reports_dir, 'TEST-%s.xml' % classname)
+        with open(filename, 'w') as f:
+            f.write('<?xml version="1.0" ?>\n'
+                    '<testsuite name="%s" tests="%s" time="1.0">\n'
+                    % (classname, _TESTCASES_PER_FILE))
+            for i in xrange(min(_TESTCASES_PER_FILE,
+                                num_testcases - file_index)):
+                f.write('  <testcase classname="%s" name="test_%s" '
+                        'time="%.3f"' % (classname, i, rng.random()))
+                if rng.random() < failure_ratio:
+                    f.write('>\n    <failure message="False is not true" '
+                            'type="AssertionError">Traceback...'
+                            '</failure>\n  </testcase>\n')
+                else:
+                    f.write('/>\n')
+            f.write('  <system-out>%s</system-out>\n'
+                    '  <system-err></system-err>\n'
+                    '</testsuite>\n' % system_out)
+        num_files += 1
+    return num_files
+
+
+def _write_jstest_log(filename, size_mb, failure_ratio, rng):
+    """Write about size_mb of jstest output, ending with a summary line."""
+    num_tests = 0
+    num_failures = 0
+    with open(filename, 'w') as f:
+        while f.tell() < size_mb * 1024 * 1024:
+            num_tests += 1
+            f.write('Running test %s: ok.  This is some chatty output '
+                    'from phantomjs, which goes on a bit.\n' % num_tests)
+            if rng.random() < failure_ratio:
+                num_failures += 1
+                f.write('\tScratchpad Output Exec test %s\n'
+                        '\t\ttimeout of 2000ms exceeded\n' % num_tests)
+        f.write('Finished running %s tests, with %s passes and %s '
+                'failures.\n'
+                % (num_tests, num_tests - num_failures, num_failures))
+
+
+def _write_lint_log(filename, size_mb):
+    """Write about size_mb of lint errors."""
+    with open(filename, 'w') as f:
+        i = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            f.write('some/file_%s.py:%s:1: E302 expected 2 blank lines, '
+                    'found 1\n' % (i // 100, i % 100))
+            i += 1
+
+
+def generate(genfiles_dir, num_testcases, failure_ratio, system_out_kb,
+             log_mb, seed=0):
+    """Create a synthetic genfiles dir; return the number of report files."""
+    rng = random.Random(seed)
+    reports_dir = os.path.join(genfiles_dir, 'test-reports')
+    os.makedirs(reports_dir)
+    num_files = _write_test_reports(reports_dir, num_testcases,
+                                    failure_ratio, system_out_kb, rng)
+    _write_jstest_log(os.path.join(genfiles_dir, 'jstest_output.txt'),
+                      log_mb, failure_ratio, rng)
+    _write_lint_log(os.path.join(genfiles_dir, 'lint_errors.txt'), log_mb)
+    return num_files
+
+
+def _benchmarks(genfiles_dir):
+    """Return a map from benchmark name to a no-argument function to time."""
+    reports_dir = os.path.join(genfiles_dir, 'test-reports')
+    jstest_file = os.path.join(genfiles_dir, 'jstest_output.txt')
+    lint_file = os.path.join(genfiles_dir, 'lint_errors.txt')
+
+    def report_jstest_failures():
+        with open(jstest_file, 'rU') as f:
+            analyze_make_output.report_jstest_failures(f, None)
+
+    def report_lint_failures():
+        with open(lint_file, 'rU') as f:
+            analyze_make_output.report_lint_failures(f, None)
+
+    return {
+        'report_test_failures': lambda: (
+            analyze_make_output.report_test_failures(
+                reports_dir, 'http://www.example.com/', None)),
+        'report_jstest_failures': report_jstest_failures,
+        'report_lint_failures': report_lint_failures,
+        'main': lambda: analyze_make_output.main(
+            'http://www.example.com/', reports_dir, jstest_file, lint_file,
+            None, False),
+    }
+
+
+def _run_one(genfiles_dir, name, result_queue):
+    """Run benchmark name and put (wall_sec, peak_rss_kb) on result_queue."""
+    # We don't want the alerts cluttering up the output.
+    logging.disable(logging.CRITICAL)
+    fn = _benchmarks(genfiles_dir)[name]
+    start = time.time()
+    fn()
+    wall_sec = time.time() - start
+    # On linux, ru_maxrss is in kilobytes.
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put((wall_sec, peak_rss_kb))
+
+
+def _get_result(p, name, result_queue, timeout_sec):
+    """Wait for benchmark process p's result, and for p to exit.
+
+    Raises RuntimeError if p dies without a result (it crashed, say),
+    exits with an error, or takes more than timeout_sec.
+    """
+    deadline = time.time() + timeout_sec
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not p.is_alive():
+                raise RuntimeError('Benchmark %s exited (rc %s) without a '
+                                   'result' % (name, p.exitcode))
+            if time.time() > deadline:
+                p.terminate()
+                p.join()
+                raise RuntimeError('Benchmark %s took more than %s seconds'
+                                   % (name, timeout_sec))
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError('Benchmark %s exited with rc %s'
+                           % (name, p.exitcode))
+    return result
+
+
+def run(genfiles_dir, num_files, log_mb, timeout_sec=3600):
+    """Run every benchmark, each in its own process; return the results."""
+    retval = {}
+    for name in sorted(_benchmarks(genfiles_dir)):
+        result_queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_run_one,
+                                    args=(genfiles_dir, name, result_queue))
+        p.start()
+        (wall_sec, peak_rss_kb) = _get_result(p, name, result_queue,
+                                              timeout_sec)
+        result = {'wall_sec': wall_sec, 'peak_rss_kb': peak_rss_kb}
+        if name in ('report_test_failures', 'main'):
+            result['files_per_sec'] = num_files / max(wall_sec, 1e-6)
+        if name in ('report_jstest_failures', 'report_lint_failures'):
+            result['mb_per_sec'] = log_mb / max(wall_sec, 1e-6)
+        retval[name] = result
+    return retval
+
+
+def regressions(results, baseline, threshold_pct):
+    """Return a list of human-readable regressions of results vs baseline."""
+    retval = []
+    for (name, result) in sorted(results.iteritems()):
+        for metric in ('wall_sec', 'peak_rss_kb'):
+            old = baseline.get(name, {}).get(metric)
+            if old and result[metric] > old * (1 + threshold_pct / 100.0):
+                retval.append('%s: %s went from %s to %s (more than %s%%)'
+                              % (name, metric, old, result[metric],
+                                 threshold_pct))
+    return retval
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--testcases', type=int, default=10000,
+                        help=('How many testcases to put in the xml test '
+                              'reports (default %(default)s)'))
+    parser.add_argument('--failure-ratio', type=float, default=0.01,
+                        help=('What fraction of tests should fail '
+                              '(default %(default)s)'))
+    parser.add_argument('--system-out-kb', type=int, default=64,
+                        help=('How big each <system-out> should be '
+                              '(default %(default)s)'))
+    parser.add_argument('--log-mb', type=int, default=10,
+                        help=('How big the jstest and lint logs should be '
+                              '(default %(default)s)'))
+    parser.add_argument('--timeout-sec', type=int, default=3600,
+                        help=('Fail if a single benchmark takes longer than '
+                              'this (default %(default)s)'))
+    parser.add_argument('--output',
+                        help='Also write the json results to this file.')
+    parser.add_argument('--baseline',
+                        help=('The --output of a previous run; fail if we '
+                              'are much worse than it.'))
+    parser.add_argument('--threshold-pct', type=float, default=20.0,
+                        help=('With --baseline, how much worse is too much '
+                              '(default %(default)s)'))
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='analyze_make_output_benchmark.')
+    try:
+        genfiles_dir = os.path.join(tmpdir, 'genfiles')
+        num_files = generate(genfiles_dir, args.testcases, args.failure_ratio,
+                             args.system_out_kb, args.log_mb)
+        results = run(genfiles_dir, num_files, args.log_mb,
+                      args.timeout_sec)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = regressions(results, json.load(f), args.threshold_pct)
+        if problems:
+            print >>sys.stderr, 'Performance regressions:'
+            for problem in problems:
+                print >>sys.stderr, '   %s' % problem
+            sys.exit(1)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""A thin client for 'analyze_make_output.py --serve'.
+
+This takes the same arguments as analyze_make_output.py, but rather
+than doing the analysis itself, it sends them to a long-running
+analyze_make_output server over a unix socket.  That way we don't pay
+for python startup, and importing lxml and alertlib, on every build.
+
+The server sends the alerts to hipchat (and its logs) as usual; we
+also print them here so they show up in the jenkins console output.
+
+Like analyze_make_output.py, this exits with rc 0 if no errors were
+seen, or a positive rc (the number of errors) if errors were seen.
+If the server isn't running, we fall back to running
+analyze_make_output.py directly.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import sys
+
+
+def analyze(socket_path, request):
+    """Send request (a dict of args for main()) to the server at socket_path.
+
+    Returns the server's response dict, which has either 'num_errors'
+    and 'alerts', or 'error'.  Raises socket.error if we can't talk to
+    the server.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request) + '\n')
+        with contextlib.closing(sock.makefile('r')) as f:
+            return json.loads(f.readline())
+    finally:
+        sock.close()
+
+
+def _abspath(path):
+    """os.path.abspath, but passes through None and ''."""
+    return os.path.abspath(path) if path else path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket',
+                        default='/tmp/analyze_make_output.sock',
+                        help='The unix socket the server is listening on')
+    parser.add_argument('--jenkins_build_url',
+                        help=('$BUILD_URL from the Jenkins environment; '
+                              'e.g. http://jenkins.ka.org/job/run-tests/1/'))
+    parser.add_argument('--test_reports_dir',
+                        default='genfiles/test-reports',
+                        help='Where runtests.py --xml puts the output xml')
+    parser.add_argument('--jstest_reports_file',
+                        default='genfiles/jstest_output.txt',
+                        help='Where "make jstest" puts the output report')
+    parser.add_argument('--lint_reports_file',
+                        default='genfiles/lint_errors.txt',
+                        help='Where "make lint" puts the output report')
+    parser.add_argument('-c', '--hipchat-room',
+                        default="1s and 0s",
+                        help=("What room to send hipchat notifications to; "
+                              "set to the empty string to turn off hipchat "
+                              "notifications"))
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help='Log instead of sending to hipchat.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help=('How many processes to use to parse the '
+                              'test reports (default: whatever the server '
+                              'was started with)'))
+    parser.add_argument('--cache_file',
+                        default='genfiles/.analyze_cache',
+                        help=('Where to cache the parsed test reports, so '
+                              'unchanged files are not re-parsed next time'))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the --cache_file.')
+    parser.add_argument('--history_db',
+                        help=('A sqlite file to record test failures in, '
+                              'so we can tell new failures from recurring '
+                              'and flaky ones.  Off by default.'))
+    parser.add_argument('--json-out',
+                        help=('Also write every failure, and a final '
+                              'summary, to this file as json, one record '
+                              'per line, as we find them'))
+    args = parser.parse_args()
+
+    # The server has its own cwd, so send it absolute paths.
+    request = {
+        'build_url': args.jenkins_build_url,
+        'test_reports_dir': _abspath(args.test_reports_dir),
+        'jstest_reports_file': _abspath(args.jstest_reports_file),
+        'lint_reports_file': _abspath(args.lint_reports_file),
+        'hipchat_room': args.hipchat_room,
+        'cache_file': None if args.no_cache else _abspath(args.cache_file),
+        'history_db': _abspath(args.history_db),
+        'dry_run': args.dry_run,
+        'jobs': args.jobs,
+        'json_out': _abspath(args.json_out),
+    }
+
+    try:
+        response = analyze(args.socket, request)
+    except socket.error, why:
+        print >>sys.stderr, ('Cannot talk to the server at %s (%s); '
+                             'analyzing locally' % (args.socket, why))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'analyze_make_output.py')
+        argv = [sys.executable, script,
+                '--test_reports_dir', args.test_reports_dir,
+                '--jstest_reports_file', args.jstest_reports_file,
+                '--lint_reports_file', args.lint_reports_file,
+                '--hipchat-room', args.hipchat_room,
+                '--cache_file', args.cache_file]
+        if args.jenkins_build_url:
+            argv.extend(['--jenkins_build_url', args.jenkins_build_url])
+        if args.no_cache:
+            argv.append('--no-cache')
+        if args.history_db:
+            argv.extend(['--history_db', args.history_db])
+        if args.dry_run:
+            argv.append('--dry-run')
+        if args.jobs:
+            argv.extend(['--jobs', str(args.jobs)])
+        if args.json_out:
+            argv.extend(['--json-out', args.json_out])
+        os.execv(sys.executable, argv)
+
+    if 'error' in response:
+        print >>sys.stderr, 'Server failed to analyze: %s' % response['error']
+        sys.exit(127)
+
+    for alert in response['alerts']:
+        print alert
+    # We cap num-errors at 127 because rc >= 128 is reserved for signals.
+    sys.exit(min(response['num_errors'], 127))
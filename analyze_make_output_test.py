@@ -2,12 +2,23 @@
 
 """Tests for analyze_make_output.py"""
 
+import contextlib
+import json
 import os
 import shutil
+import socket
+import tarfile
 import tempfile
+import threading
 import unittest
 
 import analyze_make_output
+import analyze_make_output_client
+
+
+# Some tests want the real _alert, but TestBase replaces it.
+_real_alert = analyze_make_output._alert
+_real_send_alert = analyze_make_output._send_alert
 
 
 class TestBase(unittest.TestCase):
@@ -40,7 +51,13 @@ class TestBase(unittest.TestCase):
                              test_reports_dir=None,
                              jstest_reports_file=None,
                              lint_reports_file=None,
-                             dry_run=False):
+                             dry_run=False,
+                             jobs=1,
+                             cache_file=None,
+                             timing_json=None,
+                             timing_baseline=None,
+                             json_out=None,
+                             worker_reports=None):
         """(Sets defaults for params that aren't passed in.)"""
         if jenkins_build_url is None:
             jenkins_build_url = 'http://www.example.com/'
@@ -55,7 +72,11 @@ class TestBase(unittest.TestCase):
 
         return analyze_make_output.main(jenkins_build_url, test_reports_dir,
                                         jstest_reports_file, lint_reports_file,
-                                        None, dry_run)
+                                        None, dry_run, jobs, cache_file,
+                                        timing_json=timing_json,
+                                        timing_baseline=timing_baseline,
+                                        json_out=json_out,
+                                        worker_reports=worker_reports)
 
 
 class TestAlternateTest(TestBase):
@@ -76,6 +97,27 @@ class TestAlternateTest(TestBase):
         actual = self._analyze_make_output()
         self.assertEqual(0, actual)
 
+    def test_report_file_is_not_overwritten(self):
+        lint_file = os.path.join(self.tmpdir, 'lint_errors.txt')
+        with open(lint_file) as f:
+            before = f.read()
+        self._analyze_make_output()
+        with open(lint_file) as f:
+            self.assertEqual(before, f.read())
+
+    def test_reentrant(self):
+        """Alternate-test output from one run doesn't leak into the next."""
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-success.xml'
+                               ))
+        self.assertEqual(1, self._analyze_make_output())
+        empty_reports_dir = os.path.join(self.tmpdir, 'empty-reports')
+        os.mkdir(empty_reports_dir)
+        del self.errors[:]
+        actual = self._analyze_make_output(test_reports_dir=empty_reports_dir)
+        self.assertEqual(1, actual)
+        self.assertIn('E999 lint error from txt-file.', self.errors[0])
+
     def test_do_not_need_alternate(self):
         """The output of the successful run is prefrered over lint_errors."""
         os.unlink(os.path.join(self.reports_dir,
@@ -89,6 +131,549 @@ class TestAlternateTest(TestBase):
         self.assertIn('E999 lint error from txt-file.', self.errors[0])
 
 
+class TestFindBadTestcases(TestBase):
+    def _write_report(self, filename, body):
+        with open(os.path.join(self.reports_dir, filename), 'w') as f:
+            f.write('<?xml version="1.0" ?>\n'
+                    '<testsuite errors="1" failures="1" tests="4" '
+                    'time="0.1">\n%s\n</testsuite>\n' % body)
+
+    def test_failures_and_errors(self):
+        self._write_report(
+            'TEST-foo_test.FooTest-1.xml',
+            '<testcase classname="foo_test.FooTest" name="test_ok"/>'
+            '<testcase classname="foo_test.FooTest" name="test_fail">'
+            '<failure message="no">no</failure></testcase>'
+            '<testcase classname="foo_test.FooTest" name="test_error">'
+            '<error message="boom">boom</error></testcase>'
+            '<testcase classname="foo_test.FooTest" name="test_ok2"/>')
+        actual = self._analyze_make_output()
+        self.assertEqual(3, actual)   # 2 from us, 1 from lint_errors.txt
+        self.assertIn('foo_test.FooTest.test_error', self.errors[0])
+        self.assertIn('foo_test.FooTest.test_fail', self.errors[1])
+
+    def test_large_system_out(self):
+        self._write_report(
+            'TEST-foo_test.FooTest-1.xml',
+            '<testcase classname="foo_test.FooTest" name="test_fail">'
+            '<failure message="no">no</failure></testcase>'
+            '<system-out>%s</system-out>'
+            '<system-err>%s</system-err>' % ('x' * (12 * 1024 * 1024),
+                                             'y' * 1024))
+        reports = list(analyze_make_output.find_bad_testcases(
+            self.reports_dir))
+        self.assertEqual(1, len(reports))
+        self.assertEqual(
+            ('foo_test.FooTest', 'test_fail', 'no', None,
+             os.path.join(self.reports_dir, 'TEST-foo_test.FooTest-1.xml')),
+            reports[0][:5])
+
+    def test_parallel_matches_serial(self):
+        for i in xrange(20):
+            self._write_report(
+                'TEST-foo_test.Foo%sTest-1.xml' % i,
+                '<testcase classname="foo_test.Foo%sTest" name="test_ok"/>'
+                '<testcase classname="foo_test.Foo%sTest" name="test_fail">'
+                '<failure message="no">no</failure></testcase>' % (i, i))
+        serial_rc = self._analyze_make_output()
+        serial_errors = self.errors[:]
+        del self.errors[:]
+        parallel_rc = self._analyze_make_output(jobs=4)
+        self.assertEqual(21, serial_rc)
+        self.assertEqual(serial_rc, parallel_rc)
+        self.assertEqual(serial_errors, self.errors)
+
+
+class TestReportCache(TestBase):
+    def setUp(self):
+        super(TestReportCache, self).setUp()
+        self.cache_file = os.path.join(self.tmpdir, '.analyze_cache')
+
+    def _report_test_failures(self, check_contents=False):
+        cache = analyze_make_output.ReportCache(self.cache_file,
+                                                check_contents)
+        cache.load()
+        rc = analyze_make_output.report_test_failures(
+            self.reports_dir, 'http://www.example.com/', None, cache=cache)
+        cache.save()
+        return (rc, cache)
+
+    def test_unchanged_files_are_hits(self):
+        (rc1, cache) = self._report_test_failures()
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        (rc2, cache) = self._report_test_failures()
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+        self.assertEqual(rc1, rc2)
+
+    def test_changed_file_is_a_miss(self):
+        self._report_test_failures(check_contents=True)
+        fname = os.path.join(self.reports_dir,
+                             'TEST-testutil.manual_test.LintTest-fail.xml')
+        with open(fname, 'a') as f:
+            f.write('\n')
+        (_, cache) = self._report_test_failures(check_contents=True)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_alternate_values_are_cached(self):
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-success.xml'
+                               ))
+        self._analyze_make_output(cache_file=self.cache_file)
+        del self.errors[:]
+        actual = self._analyze_make_output(cache_file=self.cache_file)
+        self.assertEqual(1, actual)
+        self.assertIn('E302 expected 2 blank lines', self.errors[0])
+
+    def test_deleted_files_are_evicted(self):
+        self._report_test_failures()
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-fail.xml'))
+        self._report_test_failures()
+        with open(self.cache_file) as f:
+            self.assertEqual(1, len(json.load(f)['entries']))
+
+    def test_save_failure_is_not_fatal(self):
+        cache = analyze_make_output.ReportCache(
+            os.path.join(self.tmpdir, 'no-such-dir', '.analyze_cache'))
+        cache.save()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     'no-such-dir')))
+
+    def test_default_cache_file_without_genfiles(self):
+        # The default --cache_file is relative to the cwd, which may
+        # not have a genfiles directory.
+        orig_cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            actual = self._analyze_make_output(
+                cache_file='genfiles/.analyze_cache')
+        finally:
+            os.chdir(orig_cwd)
+        self.assertEqual(self._analyze_make_output(), actual)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     'genfiles')))
+
+
+class TestReportLines(TestBase):
+    def test_jstest_from_generator(self):
+        def lines():
+            yield 'Running tests\n'
+            yield '\tScratchpad Output Exec getImage\n'
+            yield '\t\ttimeout of 2000ms exceeded\n'
+            yield ('Finished running 121 tests, with 120 passes '
+                   'and 1 failures.\n')
+        actual = analyze_make_output.report_jstest_failures(lines(), None)
+        self.assertEqual(1, actual)
+        self.assertEqual(['Scratchpad Output Exec getImage\n',
+                          '\ttimeout of 2000ms exceeded\n'], self.errors)
+
+    def test_lint_from_list(self):
+        actual = analyze_make_output.report_lint_failures(
+            ['a.py:1: E1 one\n', 'b.py:2: E2 two\n'], None)
+        self.assertEqual(2, actual)
+
+    def test_only_first_lines_are_kept(self):
+        lines = ('f%s.py:1: E1 lint\n' % i for i in xrange(100000))
+        actual = analyze_make_output.report_lint_failures(lines, None,
+                                                          truncate=5)
+        self.assertEqual(100000, actual)
+        # One extra, so _alert knows to add a '...'.
+        self.assertEqual(6, len(self.errors))
+
+    def test_jstest_counts_past_truncation(self):
+        lines = (['\tfailure %s\n' % i for i in xrange(50)] +
+                 ['PhantomJS has crashed.\n',
+                  'Finished running 60 tests, with 10 passes '
+                  'and 50 failures.\n'])
+        actual = analyze_make_output.report_jstest_failures(iter(lines),
+                                                            None)
+        self.assertEqual(51, actual)
+        self.assertEqual(11, len(self.errors))
+
+
+class TestServer(TestBase):
+    def setUp(self):
+        super(TestServer, self).setUp()
+        analyze_make_output._alert = _real_alert
+        self.socket_path = os.path.join(self.tmpdir, 'analyze.sock')
+        self.server = analyze_make_output.AnalyzeServer(self.socket_path)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        super(TestServer, self).tearDown()
+
+    def _request(self, **kwargs):
+        request = {
+            'build_url': 'http://www.example.com/',
+            'test_reports_dir': self.reports_dir,
+            'jstest_reports_file': os.path.join(self.tmpdir,
+                                                'jstest_output.txt'),
+            'lint_reports_file': os.path.join(self.tmpdir,
+                                              'lint_errors.txt'),
+            'hipchat_room': None,
+        }
+        request.update(kwargs)
+        return analyze_make_output_client.analyze(self.socket_path, request)
+
+    def test_analyze(self):
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-success.xml'
+                               ))
+        response = self._request()
+        self.assertEqual(1, response['num_errors'])
+        self.assertEqual(1, len(response['alerts']))
+        self.assertIn('E302 expected 2 blank lines', response['alerts'][0])
+
+    def test_concurrent_requests(self):
+        responses = []
+        threads = [
+            threading.Thread(target=lambda: responses.append(self._request()))
+            for _ in xrange(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        expected = self._analyze_make_output()
+        self.assertEqual([expected] * 5,
+                         [r['num_errors'] for r in responses])
+
+    def test_error(self):
+        response = self._request(test_reports_dir=None,
+                                 jstest_reports_file=None,
+                                 lint_reports_file=123)
+        self.assertIn('error', response)
+
+    def test_malformed_request(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall('{"build_url": \n')
+            with contextlib.closing(sock.makefile('r')) as f:
+                response = json.loads(f.readline())
+        finally:
+            sock.close()
+        self.assertIn('ValueError', response['error'])
+
+    def test_dry_run_and_json_out(self):
+        json_out = os.path.join(self.tmpdir, 'failures.json')
+        sent = []
+        orig_send_to_hipchat = analyze_make_output.alert_queue.send_to_hipchat
+        analyze_make_output.alert_queue.send_to_hipchat = (
+            lambda *a, **kw: sent.append(a))
+        try:
+            response = self._request(hipchat_room='1s and 0s',
+                                     dry_run=True, jobs=2,
+                                     json_out=json_out)
+        finally:
+            analyze_make_output.alert_queue.send_to_hipchat = (
+                orig_send_to_hipchat)
+        self.assertEqual([], sent)
+        self.assertTrue(response['alerts'])
+        with open(json_out) as f:
+            records = [json.loads(l) for l in f]
+        self.assertEqual('summary', records[-1]['type'])
+        self.assertEqual(response['num_errors'], records[-1]['num_errors'])
+
+
+class TestFailureHistory(TestBase):
+    def setUp(self):
+        super(TestFailureHistory, self).setUp()
+        self.history = analyze_make_output.FailureHistory(
+            os.path.join(self.tmpdir, 'history.db'))
+
+    def tearDown(self):
+        self.history.close()
+        super(TestFailureHistory, self).tearDown()
+
+    def test_classify(self):
+        self.history.record('http://example.com/1', ['a.T.flaky', 'a.T.old'])
+        self.history.record('http://example.com/2', ['a.T.broken'])
+        self.history.record('http://example.com/3', ['a.T.broken'])
+        self.history.record('http://example.com/4',
+                            ['a.T.broken', 'a.T.flaky'])
+        self.history.record('http://example.com/5', ['a.T.broken'])
+        actual = self.history.classify(
+            ['a.T.new', 'a.T.broken', 'a.T.flaky', 'a.T.old'],
+            num_builds=4)
+        self.assertEqual({'a.T.new': ('new', 0),
+                          'a.T.broken': ('recurring', 4),
+                          'a.T.flaky': ('flaky', 1),
+                          # Its failure was before our 4-build window.
+                          'a.T.old': ('new', 0),
+                          }, actual)
+
+    def test_report_marks_failures(self):
+        with open(os.path.join(self.reports_dir,
+                               'TEST-foo_test.FooTest-1.xml'), 'w') as f:
+            f.write('<testsuite><testcase classname="foo_test.FooTest" '
+                    'name="test_fail"><failure message="no">no</failure>'
+                    '</testcase></testsuite>')
+        for _ in xrange(2):
+            del self.errors[:]
+            analyze_make_output.report_test_failures(
+                self.reports_dir, 'http://www.example.com/', None,
+                history=self.history)
+        self.assertIn('foo_test.FooTest.test_fail</a> (recurring: also '
+                      'failed the last 1 build)', self.errors[0])
+
+
+class TestTimings(TestBase):
+    def setUp(self):
+        super(TestTimings, self).setUp()
+        # We don't want the fixture files here, since they have times too.
+        self.timing_dir = os.path.join(self.tmpdir, 'timing-reports')
+        os.mkdir(self.timing_dir)
+        with open(os.path.join(self.timing_dir,
+                               'TEST-foo_test.FooTest-1.xml'), 'w') as f:
+            f.write('<testsuite name="foo_test.FooTest" time="7.5">'
+                    '<testcase classname="foo_test.FooTest" name="test_a" '
+                    'time="1.5"/>'
+                    '<testcase classname="foo_test.FooTest" name="test_b" '
+                    'time="6.0"/>'
+                    '<testcase classname="foo_test.FooTest" name="test_c" '
+                    'time="0.2"/>'
+                    '<system-out>lots of output</system-out>'
+                    '</testsuite>')
+        self.alerts = []
+        analyze_make_output._send_alert = (
+            lambda _, text, *a, **kw: self.alerts.append(text))
+
+    def tearDown(self):
+        analyze_make_output._send_alert = _real_send_alert
+        super(TestTimings, self).tearDown()
+
+    def _timings(self):
+        timings = []
+        list(analyze_make_output.find_bad_testcases(self.timing_dir,
+                                                    timings=timings))
+        return timings
+
+    def test_slowest(self):
+        actual = analyze_make_output.report_test_timings(
+            self._timings(), None, top_n=2)
+        self.assertEqual([['foo_test.FooTest.test_b', 6.0],
+                          ['foo_test.FooTest.test_a', 1.5]],
+                         actual['slowest_tests'])
+        self.assertEqual([['foo_test.FooTest', 7.5]],
+                         actual['slowest_suites'])
+        self.assertEqual(0.2, actual['test_times']['foo_test.FooTest.test_c'])
+        # Nothing got slower, so there's nothing to alert about.
+        self.assertEqual([], self.alerts)
+
+    def test_baseline(self):
+        baseline = {'foo_test.FooTest.test_a': 1.0,    # 50% slower
+                    'foo_test.FooTest.test_b': 2.0,    # 200% slower
+                    'foo_test.FooTest.test_c': 0.01,   # too fast to care
+                    }
+        actual = analyze_make_output.report_test_timings(
+            self._timings(), None, baseline=baseline, slower_pct=40)
+        self.assertEqual([['foo_test.FooTest.test_b', 6.0, 2.0],
+                          ['foo_test.FooTest.test_a', 1.5, 1.0]],
+                         actual['slower_than_baseline'])
+        self.assertIn('2 tests got more than 40% slower', self.alerts[0])
+
+    def test_json_round_trip(self):
+        timing_json = os.path.join(self.tmpdir, 'timings.json')
+        self._analyze_make_output(test_reports_dir=self.timing_dir,
+                                  timing_json=timing_json)
+        self._analyze_make_output(test_reports_dir=self.timing_dir,
+                                  timing_json=timing_json,
+                                  timing_baseline=timing_json)
+        with open(timing_json) as f:
+            self.assertEqual([], json.load(f)['slower_than_baseline'])
+
+    def test_timings_are_cached(self):
+        cache_file = os.path.join(self.tmpdir, '.analyze_cache')
+        timing_json = os.path.join(self.tmpdir, 'timings.json')
+        for _ in xrange(2):
+            self._analyze_make_output(test_reports_dir=self.timing_dir,
+                                      cache_file=cache_file,
+                                      timing_json=timing_json)
+            with open(timing_json) as f:
+                self.assertEqual([['foo_test.FooTest', 7.5]],
+                                 json.load(f)['slowest_suites'])
+
+
+class TestShardBalancing(TestBase):
+    def _write_timings(self, filename, test_times):
+        filename = os.path.join(self.tmpdir, filename)
+        with open(filename, 'w') as f:
+            json.dump({'test_times': test_times}, f)
+        return filename
+
+    def test_decayed_class_times(self):
+        old = self._write_timings('old.json', {'a.A.test_1': 10.0,
+                                               'a.A.test_2': 10.0,
+                                               'b.B.test_1': 4.0})
+        new = self._write_timings('new.json', {'a.A.test_1': 5.0,
+                                               'a.A.test_2': 5.0})
+        actual = analyze_make_output.decayed_class_times([old, new], 0.5)
+        self.assertEqual({'a.A': 15.0, 'b.B': 4.0}, actual)
+
+    def test_class_times_from_reports(self):
+        actual = analyze_make_output.decayed_class_times([self.reports_dir])
+        self.assertEqual(['testutil.manual_test.LintTest'], actual.keys())
+
+    def test_balance_shards(self):
+        class_times = {'a': 7, 'b': 5, 'c': 4, 'd': 3, 'e': 2, 'f': 1}
+        actual = analyze_make_output.balance_shards(class_times, 3)
+        self.assertEqual([(8, ['a', 'f']), (7, ['b', 'e']), (7, ['c', 'd'])],
+                         actual)
+
+    def test_write_shard_file(self):
+        shard_file = os.path.join(self.tmpdir, 'shards.txt')
+        analyze_make_output.write_shard_file(
+            [(8, ['a', 'f']), (7, ['b'])], shard_file)
+        with open(shard_file) as f:
+            lines = [l for l in f.read().splitlines()
+                     if not l.startswith('#')]
+        self.assertEqual(['0 a', '0 f', '1 b'], lines)
+
+
+class TestJsonOut(TestBase):
+    def test_json_out(self):
+        with open(os.path.join(self.reports_dir,
+                               'TEST-foo_test.FooTest-1.xml'), 'w') as f:
+            f.write('<testsuite><testcase classname="foo_test.FooTest" '
+                    'name="test_fail" time="1.5"><failure message="no">no'
+                    '</failure></testcase></testsuite>')
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-success.xml'
+                               ))
+        json_out = os.path.join(self.tmpdir, 'failures.json')
+        self._analyze_make_output(json_out=json_out)
+        with open(json_out) as f:
+            records = [json.loads(l) for l in f]
+
+        self.assertEqual(
+            {'type': 'python',
+             'id': 'foo_test.FooTest.test_fail',
+             'message': 'no',
+             'link': ('http://www.example.com/testReport/junit/foo_test/'
+                      'FooTest/test_fail/'),
+             'source': os.path.join(self.reports_dir,
+                                    'TEST-foo_test.FooTest-1.xml'),
+             'duration': 1.5,
+             'fingerprint': records[0]['fingerprint']},
+            records[0])
+        self.assertEqual('lint', records[1]['type'])
+        self.assertEqual('<alternate test>', records[1]['source'])
+        self.assertEqual('summary', records[-1]['type'])
+        self.assertEqual(len(records) - 1, records[-1]['num_errors'])
+        self.assertEqual(1, records[-1]['num_python_errors'])
+
+
+class TestWorkerReports(TestBase):
+    def _make_worker(self, name, failing_tests, lint_lines, jstest_failures):
+        genfiles = os.path.join(self.tmpdir, name, 'genfiles')
+        os.makedirs(os.path.join(genfiles, 'test-reports'))
+        with open(os.path.join(genfiles, 'test-reports',
+                               'TEST-foo_test.FooTest-1.xml'), 'w') as f:
+            f.write('<testsuite>%s</testsuite>' % ''.join(
+                '<testcase classname="foo_test.FooTest" name="%s">'
+                '<failure message="no">no</failure></testcase>' % t
+                for t in failing_tests))
+        with open(os.path.join(genfiles, 'lint_errors.txt'), 'w') as f:
+            f.writelines(lint_lines)
+        with open(os.path.join(genfiles, 'jstest_output.txt'), 'w') as f:
+            f.write('Lots of output\n')
+            f.write(''.join('\tjstest %s\n' % i
+                            for i in xrange(jstest_failures)))
+            f.write('Finished running 10 tests, with %s passes and '
+                    '%s failures.\n' % (10 - jstest_failures,
+                                        jstest_failures))
+        return genfiles
+
+    def _tar(self, genfiles):
+        tarball = os.path.join(os.path.dirname(genfiles), 'genfiles.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(genfiles, 'genfiles')
+        return tarball
+
+    def test_combine(self):
+        worker1 = self._make_worker('w1', ['test_a', 'test_b'],
+                                    ['a.py:1: E1 bad\n'], 1)
+        worker2 = self._make_worker('w2', ['test_b', 'test_c'],
+                                    ['a.py:1: E1 bad\n',
+                                     'b.py:2: E2 worse\n'], 2)
+        actual = analyze_make_output.report_worker_failures(
+            [worker1, self._tar(worker2)], 'http://www.example.com/', None)
+        self.assertEqual({'python': 3, 'jstest': 3, 'lint': 2}, actual)
+        # One alert per kind, not per worker.  (The python tests all
+        # fail the same way, so they're collapsed into one line.)
+        self.assertEqual(1 + 3 + 2, len(self.errors))
+
+    def test_failure_sources(self):
+        worker1 = self._make_worker('w1', [], ['a.py:1: E1 bad\n'], 1)
+        worker2 = self._make_worker('w2', [], ['a.py:1: E1 bad\n',
+                                               'b.py:2: E2 worse\n'], 2)
+        tarball = self._tar(worker2)
+        records = []
+        analyze_make_output.report_worker_failures(
+            [worker1, tarball], 'http://www.example.com/', None,
+            on_failure=records.append)
+        self.assertEqual(
+            [('jstest', os.path.join(worker1, 'jstest_output.txt')),
+             ('jstest', '%s:genfiles/jstest_output.txt' % tarball),
+             ('jstest', '%s:genfiles/jstest_output.txt' % tarball),
+             ('lint', os.path.join(worker1, 'lint_errors.txt')),
+             ('lint', '%s:genfiles/lint_errors.txt' % tarball)],
+            [(r['type'], r['source']) for r in records])
+
+    def test_main(self):
+        worker1 = self._make_worker('w1', ['test_a'], [], 0)
+        worker2 = self._make_worker('w2', ['test_a'], [], 1)
+        actual = self._analyze_make_output(
+            worker_reports=[self._tar(worker1), self._tar(worker2)])
+        self.assertEqual(2, actual)
+
+
+class TestClustering(TestBase):
+    _TRACEBACK = """Traceback (most recent call last):
+  File "/tmp/tmp%(tmp)s/foo_test.py", line %(line)s, in setUp
+    import broken
+  File "/tmp/tmp%(tmp)s/broken.py", line 3, in &lt;module&gt;
+    x = Thing(&lt;object at %(addr)s&gt;)
+ImportError: cannot import name Thing"""
+
+    def _write_report(self, filename, testcases):
+        with open(os.path.join(self.reports_dir, filename), 'w') as f:
+            f.write('<testsuite>%s</testsuite>' % ''.join(testcases))
+
+    def _testcase(self, name, tmp, line, addr):
+        return ('<testcase classname="foo_test.FooTest" name="%s">'
+                '<error type="ImportError" message="cannot import name Thing">'
+                '%s</error></testcase>'
+                % (name, self._TRACEBACK % {'tmp': tmp, 'line': line,
+                                            'addr': addr}))
+
+    def test_same_failures_are_clustered(self):
+        self._write_report(
+            'TEST-foo_test.FooTest-1.xml',
+            [self._testcase('test_a', 'abc', 10, '0x7f00'),
+             self._testcase('test_b', 'def', 20, '0x7f08'),
+             self._testcase('test_c', 'ghi', 30, '0x7f10'),
+             '<testcase classname="foo_test.FooTest" name="test_d">'
+             '<failure message="no">no</failure></testcase>'])
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-fail.xml'))
+        os.unlink(os.path.join(self.reports_dir,
+                               'TEST-testutil.manual_test.LintTest-success.xml'
+                               ))
+        actual = analyze_make_output.report_test_failures(
+            self.reports_dir, 'http://www.example.com/', None)
+        self.assertEqual(4, actual)
+        self.assertEqual(2, len(self.errors))
+        self.assertIn('3 tests failed with <code>ImportError: cannot import '
+                      'name Thing</code>, e.g. ', self.errors[0])
+        self.assertIn('foo_test.FooTest.test_a', self.errors[0])
+        self.assertIn('foo_test.FooTest.test_d', self.errors[1])
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -10,8 +10,14 @@
 # Environment variables:
 #   WITH_SECRETS - set to 1 to make secrets.py available to Python
 #   NO_DEPS - set to 1 to disable running 'make deps'
+#   TEST_SHARD_FILE, TEST_SHARD - if both are set, TEST_SHARD_CLASSES
+#      is set to the (space-separated) test classes that
+#      'analyze_make_output.py --balance_shards' assigned to shard
+#      number TEST_SHARD, and exported for the make command to use.
 
 : ${WITH_SECRETS:=}
+: ${TEST_SHARD_FILE:=}
+: ${TEST_SHARD:=}
 
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd -P )"
 source "${SCRIPT_DIR}/build.lib"
@@ -23,6 +29,12 @@ fi
 # Run commit build verifications.
 [ -n "$NO_DEPS" ] || ( cd "$WEBSITE_ROOT" && "$MAKE" install_deps )
 
+if [ -n "$TEST_SHARD_FILE" -a -n "$TEST_SHARD" ]; then
+    TEST_SHARD_CLASSES=`awk -v s="$TEST_SHARD" '$1 == s { print $2 }' \
+                        "$TEST_SHARD_FILE" | tr '\n' ' '`
+    export TEST_SHARD_CLASSES
+fi
+
 # Why not have the caller simply run make themselves? Because we may
 # modify the environment, e.g., by adding secrets.py to PYTHONPATH.
 cd "$WEBSITE_ROOT"
@@ -0,0 +1,191 @@
+"""A sqlite database of past deploys, for trends and wait estimates.
+
+deploy_pipeline.py records every deploy when it releases the lock --
+whether the deploy succeeded, failed, was rolled back, or was just
+unlocked -- along with its properties, how long it held the lock,
+when it reached each stage, and how long each action and command took
+(as measured by deploy_pipeline._span()).
+
+The tables are indexed so that questions like "what was the median
+lock-hold time this week?", "what is each deployer's rollback rate?"
+and "what is the p95 time for merge-from-master?" stay fast over
+years of deploys.  acquire_deploy_lock() uses it to estimate how long
+people waiting for the lock will wait.
+"""
+
+import json
+import sqlite3
+import time
+
+
+class DeployHistory(object):
+    """The history of deploys in db_file; see the module docstring.
+
+    Queries take an optional 'since', a unix time; if given, they only
+    consider deploys that finished at or after then.
+    """
+    def __init__(self, db_file):
+        self._db = sqlite3.connect(db_file)
+        # We copy finish_time into timings and stage_starts so we can
+        # restrict queries on them by time without a join.
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS deploys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                finish_time REAL NOT NULL,
+                deployer TEXT,
+                git_revision TEXT,
+                version_name TEXT,
+                outcome TEXT NOT NULL,
+                hold_sec REAL,
+                props TEXT
+            );
+            CREATE INDEX IF NOT EXISTS deploys_by_time
+                ON deploys (finish_time);
+            CREATE INDEX IF NOT EXISTS deploys_by_deployer
+                ON deploys (deployer, finish_time);
+            CREATE TABLE IF NOT EXISTS timings (
+                deploy_id INTEGER NOT NULL,
+                finish_time REAL NOT NULL,
+                name TEXT NOT NULL,
+                sec REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS timings_by_name
+                ON timings (name, finish_time);
+            CREATE TABLE IF NOT EXISTS stage_starts (
+                deploy_id INTEGER NOT NULL,
+                finish_time REAL NOT NULL,
+                stage TEXT NOT NULL,
+                start_sec REAL NOT NULL,
+                sec_left REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS stage_starts_by_stage
+                ON stage_starts (stage, finish_time);
+        """)
+
+    def close(self):
+        self._db.close()
+
+    def record(self, props, outcome, hold_sec, stage_start_sec, span_sec,
+               finish_time=None):
+        """Record a finished deploy.
+
+        Arguments:
+            props: the deploy's properties (from deploy.prop).
+            outcome: how it ended: 'success', 'failure', 'rollback'
+               or 'unlock'.
+            hold_sec: how long the deploy held the lock.
+            stage_start_sec: a map from POSSIBLE_NEXT_STEPS value to
+               how many seconds after acquiring the lock we got there.
+            span_sec: a map from the name of an action, or kind of
+               command, to how many seconds the deploy spent on it.
+            finish_time: when the deploy finished; defaults to now.
+        """
+        if finish_time is None:
+            finish_time = time.time()
+        with self._db:      # a transaction
+            cursor = self._db.execute(
+                'INSERT INTO deploys (finish_time, deployer, git_revision, '
+                '    version_name, outcome, hold_sec, props) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (finish_time, props.get('DEPLOYER_USERNAME'),
+                 props.get('GIT_REVISION'), props.get('VERSION_NAME'),
+                 outcome, hold_sec, json.dumps(props, sort_keys=True)))
+            deploy_id = cursor.lastrowid
+            self._db.executemany(
+                'INSERT INTO timings (deploy_id, finish_time, name, sec) '
+                'VALUES (?, ?, ?, ?)',
+                ((deploy_id, finish_time, name, sec)
+                 for (name, sec) in span_sec.iteritems()))
+            self._db.executemany(
+                'INSERT INTO stage_starts '
+                '    (deploy_id, finish_time, stage, start_sec, sec_left) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((deploy_id, finish_time, stage, start_sec,
+                  hold_sec - start_sec)
+                 for (stage, start_sec) in stage_start_sec.iteritems()))
+
+    def _percentile(self, column, table, where, params, pct):
+        """Return the pct-th percentile of column over matching rows.
+
+        Returns None if no rows match.  We let sqlite do the sorting,
+        using the index for where, rather than loading every row.
+        """
+        (count,) = self._db.execute(
+            'SELECT COUNT(*) FROM %s WHERE %s' % (table, where),
+            params).fetchone()
+        if not count:
+            return None
+        offset = int(round((count - 1) * pct / 100.0))
+        (value,) = self._db.execute(
+            'SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT 1 OFFSET ?'
+            % (column, table, where, column),
+            list(params) + [offset]).fetchone()
+        return value
+
+    def num_deploys(self, since=None):
+        (count,) = self._db.execute(
+            'SELECT COUNT(*) FROM deploys WHERE finish_time >= ?',
+            (since or 0,)).fetchone()
+        return count
+
+    def recent_since(self, num_deploys):
+        """Return a 'since' that covers the last num_deploys deploys."""
+        row = self._db.execute(
+            'SELECT finish_time FROM deploys '
+            'ORDER BY finish_time DESC LIMIT 1 OFFSET ?',
+            (num_deploys - 1,)).fetchone()
+        return row[0] if row else None
+
+    def hold_sec_percentile(self, pct, since=None, longer_than=None):
+        """E.g. hold_sec_percentile(50, since=<a week ago>).
+
+        If longer_than is given, only consider deploys that held the
+        lock for longer than that many seconds.
+        """
+        return self._percentile('hold_sec', 'deploys',
+                                'finish_time >= ? AND hold_sec > ?',
+                                (since or 0, longer_than or 0), pct)
+
+    def timing_percentile(self, name, pct, since=None):
+        """E.g. timing_percentile('merge-from-master', 95)."""
+        return self._percentile('sec', 'timings',
+                                'name = ? AND finish_time >= ?',
+                                (name, since or 0), pct)
+
+    def sec_left_percentile(self, stage, pct, since=None, longer_than=None):
+        """How long deploys held the lock after getting to stage.
+
+        If longer_than is given, only consider deploys that held it
+        for longer than that many seconds after getting to stage.
+        """
+        return self._percentile('sec_left', 'stage_starts',
+                                'stage = ? AND finish_time >= ? '
+                                'AND sec_left > ?',
+                                (stage, since or 0, longer_than or -1), pct)
+
+    def timing_names(self, since=None):
+        """Return every action and kind of command we have timings for."""
+        return [row[0] for row in self._db.execute(
+            'SELECT DISTINCT name FROM timings WHERE finish_time >= ? '
+            'ORDER BY name', (since or 0,))]
+
+    def outcomes_by_deployer(self, since=None):
+        """Return a map from deployer to {outcome: number of deploys}."""
+        retval = {}
+        for (deployer, outcome, count) in self._db.execute(
+                'SELECT deployer, outcome, COUNT(*) FROM deploys '
+                'WHERE finish_time >= ? GROUP BY deployer, outcome',
+                (since or 0,)):
+            retval.setdefault(deployer, {})[outcome] = count
+        return retval
+
+    def rollback_rate_by_deployer(self, since=None):
+        """Return a map from deployer to the fraction of their deploys
+        that were rolled back.
+        """
+        retval = {}
+        for (deployer, outcomes) in (
+                self.outcomes_by_deployer(since).iteritems()):
+            retval[deployer] = (outcomes.get('rollback', 0) /
+                                float(sum(outcomes.itervalues())))
+        return retval
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""Tests for deploy_history.py"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import deploy_history
+
+
+class DeployHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history = deploy_history.DeployHistory(
+            os.path.join(self.tmpdir, 'history.db'))
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _record(self, deployer, outcome, hold_sec, merge_sec=None,
+                days_ago=0):
+        span_sec = {} if merge_sec is None else {'merge-from-master':
+                                                 merge_sec}
+        self.history.record(
+            {'DEPLOYER_USERNAME': deployer, 'GIT_REVISION': 'b'},
+            outcome, hold_sec,
+            {'acquire-lock': 0, 'set-default': hold_sec - 10},
+            span_sec,
+            finish_time=time.time() - days_ago * 86400)
+
+    def test_hold_sec_percentile(self):
+        self.assertEqual(None, self.history.hold_sec_percentile(50))
+        for hold_sec in (100, 300, 200, 5000):
+            self._record('joe', 'success', hold_sec)
+        self._record('joe', 'success', 10000, days_ago=10)
+        self.assertEqual(300, self.history.hold_sec_percentile(50))
+        self.assertEqual(100, self.history.hold_sec_percentile(0))
+        self.assertEqual(10000, self.history.hold_sec_percentile(100))
+        week_ago = time.time() - 7 * 86400
+        self.assertEqual(300, self.history.hold_sec_percentile(50, week_ago))
+        self.assertEqual(5000,
+                         self.history.hold_sec_percentile(100, week_ago))
+        self.assertEqual(4, self.history.num_deploys(week_ago))
+
+    def test_timing_percentile(self):
+        for merge_sec in xrange(1, 101):
+            self._record('joe', 'success', 1000, merge_sec=merge_sec)
+        self._record('joe', 'failure', 1000)
+        self.assertEqual(95, self.history.timing_percentile(
+            'merge-from-master', 95))
+        self.assertEqual(None, self.history.timing_percentile('prime', 95))
+        self.assertEqual(['merge-from-master'], self.history.timing_names())
+
+    def test_sec_left_percentile(self):
+        self._record('joe', 'success', 100)
+        self._record('joe', 'success', 300)
+        self._record('joe', 'success', 200)
+        self.assertEqual(200, self.history.sec_left_percentile(
+            'acquire-lock', 50))
+        self.assertEqual(10, self.history.sec_left_percentile(
+            'set-default', 50))
+        self.assertEqual(None, self.history.sec_left_percentile(
+            'manual-test', 50))
+        # Of the deploys still going 150 seconds after getting the lock...
+        self.assertEqual(300, self.history.sec_left_percentile(
+            'acquire-lock', 50, longer_than=150))
+        self.assertEqual(300, self.history.hold_sec_percentile(
+            50, longer_than=150))
+
+    def test_recent_since(self):
+        self.assertEqual(None, self.history.recent_since(2))
+        for days_ago in (3, 2, 1):
+            self._record('joe', 'success', days_ago * 100, days_ago=days_ago)
+        self.assertEqual(200, self.history.hold_sec_percentile(
+            50, self.history.recent_since(2)))
+
+    def test_rollback_rate(self):
+        self._record('joe', 'success', 100)
+        self._record('joe', 'rollback', 100)
+        self._record('jane', 'success', 100)
+        self._record('jane', 'rollback', 100, days_ago=10)
+        self.assertEqual({'joe': 0.5, 'jane': 0.5},
+                         self.history.rollback_rate_by_deployer())
+        self.assertEqual({'joe': 0.5, 'jane': 0.0},
+                         self.history.rollback_rate_by_deployer(
+                             time.time() - 7 * 86400))
+
+    def test_persistent(self):
+        self._record('joe', 'success', 100)
+        self.history.close()
+        self.history = deploy_history.DeployHistory(
+            os.path.join(self.tmpdir, 'history.db'))
+        self.assertEqual(1, self.history.num_deploys())
+
+
+if __name__ == '__main__':
+    unittest.main()
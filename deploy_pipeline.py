@@ -39,13 +39,16 @@ workspace, which will also hold the lockfile.
 import argparse
 import cStringIO
 import contextlib
-import errno
+import itertools
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import urllib
 import urllib2
@@ -55,6 +58,15 @@ sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)),
                              'alertlib'))
 import alertlib
 
+import alert_queue
+import deploy_history
+import deploy_queue
+import git_refs
+import hipchat_names
+import instance_primer
+import streaming_monitor
+import task_runner
+
 # We assume that webapp is a sibling to the jenkins-tools repo.
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              '..', 'webapp', 'tools'))
@@ -78,11 +90,134 @@ def _alert(props, text, severity=logging.INFO, color=None, html=False,
     """Send the given text to hipchat and the logs."""
     if prefix_with_username:
         text = '%s %s' % (props['DEPLOYER_HIPCHAT_NAME'], text)
-    (alertlib.Alert(text, severity=severity, html=html)
-     .send_to_logs()
-     .send_to_hipchat(room_name=props['HIPCHAT_ROOM'],
-                      sender=props['HIPCHAT_SENDER'],
-                      color=color, notify=True))
+    alertlib.Alert(text, severity=severity, html=html).send_to_logs()
+    # This is sent in the background, in order, so we don't wait on
+    # hipchat.  Queued messages are flushed when we exit.
+    alert_queue.send_to_hipchat(props['HIPCHAT_ROOM'], text,
+                                sender=props['HIPCHAT_SENDER'],
+                                severity=severity, color=color, html=html,
+                                notify=True)
+
+
+# _span() records its timings in the deploy.trace file in the lockdir
+# of these props.  main() sets this, with _start_tracing(), once we
+# know we hold the lock; until then, spans wait in _PENDING_SPANS.
+# release_deploy_lock() unsets it, with _stop_tracing(), after which
+# we drop spans rather than waiting to write them.
+_TRACE_PROPS = None
+_TRACING_STOPPED = False
+_PENDING_SPANS = []
+_SPAN_LOCK = threading.Lock()
+_SPAN_IDS = itertools.count()
+_SPAN_STACK = threading.local()     # the open spans in each thread
+
+
+def _trace_file(lockdir):
+    return os.path.join(lockdir, 'deploy.trace')
+
+
+def _write_spans(spans):
+    with _SPAN_LOCK:
+        if _TRACING_STOPPED:
+            return
+        _PENDING_SPANS.extend(spans)
+        if _TRACE_PROPS is None:
+            return
+        try:
+            # The lockdir moves when the lock is released, so we
+            # look it up every time.
+            with open(_trace_file(_TRACE_PROPS['LOCKDIR']), 'a') as f:
+                for span in _PENDING_SPANS:
+                    f.write(json.dumps(span, sort_keys=True) + '\n')
+        except IOError, why:   # probably: someone removed the lockdir
+            logging.warning('Could not record timings: %s' % why)
+        del _PENDING_SPANS[:]
+
+
+def _start_tracing(props):
+    """Start writing spans to props' lockdir; see _span()."""
+    global _TRACE_PROPS, _TRACING_STOPPED
+    _TRACE_PROPS = props
+    _TRACING_STOPPED = False
+    _write_spans([])
+
+
+def _stop_tracing():
+    """Record the spans still open in this thread, and stop tracing.
+
+    Call this just before releasing the lock, since after that the
+    lockdir isn't ours to write to.  The open spans, e.g. the
+    action's, are recorded as ending now; spans that end later aren't
+    recorded at all.
+    """
+    global _TRACE_PROPS, _TRACING_STOPPED
+    now = time.time()
+    _write_spans([dict(span, end=now)
+                  for span in _SPAN_STACK.__dict__.get('spans', [])])
+    with _SPAN_LOCK:
+        _TRACE_PROPS = None
+        _TRACING_STOPPED = True
+        del _PENDING_SPANS[:]
+
+
+@contextlib.contextmanager
+def _span(name, **attrs):
+    """Record how long the enclosed code takes in the deploy's trace.
+
+    The trace, lockdir/deploy.trace, has a json object per line for
+    each span: its name, attrs, start and end times, and the id of the
+    span it's nested in (its 'parent'), if any.  Each action is a
+    span, as is every command, url-fetch, and set_default step inside
+    it.  The 'report' action summarizes the trace.
+    """
+    stack = _SPAN_STACK.__dict__.setdefault('spans', [])
+    span = {'id': '%s.%s' % (os.getpid(), next(_SPAN_IDS)),
+            'parent': stack[-1]['id'] if stack else None,
+            'name': name,
+            'start': time.time(),
+            }
+    if attrs:
+        span['attrs'] = attrs
+    stack.append(span)
+    try:
+        yield
+    except Exception:
+        span['failed'] = True
+        raise
+    finally:
+        stack.pop()
+        span['end'] = time.time()
+        _write_spans([span])
+
+
+def _in_current_span(fn):
+    """Return fn, made to nest its spans in the current span.
+
+    Spans nest in whatever span is open in their thread, so spans
+    opened in a new thread would otherwise be top-level.  Use this on
+    functions you're going to run in another thread.
+    """
+    parents = list(_SPAN_STACK.__dict__.get('spans', []))
+
+    def wrapped():
+        _SPAN_STACK.spans = list(parents)
+        try:
+            return fn()
+        finally:
+            del _SPAN_STACK.spans
+    return wrapped
+
+
+def _flush_alerts():
+    """Wait for our queued hipchat messages to be sent.
+
+    deploy.set_default sends some hipchat messages of its own,
+    synchronously, to the same room; call this before calling into
+    it, so that our messages come before its messages.
+    """
+    if not alert_queue.flush():
+        logging.warning('Timed out sending hipchat messages; they may '
+                        'arrive out of order')
 
 
 def _safe_urlopen(*args, **kwargs):
@@ -90,7 +225,9 @@ def _safe_urlopen(*args, **kwargs):
     num_tries = 0
     while True:
         try:
-            return urllib2.urlopen(*args, **kwargs)
+            # We leave off the query, which may hold an auth token.
+            with _span('urlopen', url=str(args[0]).split('?')[0]):
+                return urllib2.urlopen(*args, **kwargs)
         except Exception:
             num_tries += 1
             if num_tries == 3:
@@ -100,25 +237,27 @@ def _safe_urlopen(*args, **kwargs):
                                 % (args, kwargs))
 
 
+# Where we cache the map from email to hipchat mention-name.  This is
+# relative to the jenkins workspace, like the default --lockdir.
+_HIPCHAT_NAMES_CACHE_FILE = 'tmp/hipchat_names.json'
+
+_HIPCHAT_NAMES = None
+
+
 def _email_to_hipchat_name(email):
     """Given an email address, turn it into a @mention suitable for hipchat."""
+    global _HIPCHAT_NAMES
     if email is None:
         return '<b>Unknown user:</b>'
-    try:
-        logging.info('Fetching email->hipchat mapping from hipchat')
-        r = _safe_urlopen('https://api.hipchat.com/v1/users/list'
-                          '?auth_token=%s' % ka_secrets.hipchat_deploy_token)
-        user_data = json.load(r)
-        email_to_mention_name = {user['email']: '@%s' % user['mention_name']
-                                 for user in user_data['users']}
-    except Exception, why:
-        # If we don't have secrets, we get back a 401.  Ah well.
-        logging.warning('Fetching email->hipchat mapping failed; will '
-                        'guess. (%s: %s)' % (why.__class__.__name__, why))
-        email_to_mention_name = {}
+    if _HIPCHAT_NAMES is None:
+        _HIPCHAT_NAMES = hipchat_names.MentionNameCache(
+            _HIPCHAT_NAMES_CACHE_FILE,
+            lambda: hipchat_names.fetch_mention_names(
+                ka_secrets.hipchat_deploy_token, urlopen=_safe_urlopen))
     # If we can't map email to hipchat name, just guess that their
     # hipchat name is @<email-name>.
-    return email_to_mention_name.get(email, '@%s' % email.split('@')[0])
+    return (_HIPCHAT_NAMES.mention_name(email) or
+            '@%s' % email.split('@')[0])
 
 
 def _list_with_links(title_url_pairs):
@@ -132,19 +271,37 @@ def _list_with_links(title_url_pairs):
     return '<br>\n'.join(retval)
 
 
+_GIT_REFS = None
+
+
+def _git_refs():
+    """The GitRefs for webapp, for asking cheap questions about refs."""
+    global _GIT_REFS
+    if _GIT_REFS is None:
+        _GIT_REFS = git_refs.GitRefs(_WEBAPP_ROOT)
+    return _GIT_REFS
+
+
 def _run_command(cmd, failure_ok=False):
     """Return True if command succeeded, False else.  May raise on failure."""
     logging.info('Running command: %s' % cmd)
-    if failure_ok:
-        return subprocess.call(cmd, cwd=_WEBAPP_ROOT) == 0
-    else:
-        subprocess.check_call(cmd, cwd=_WEBAPP_ROOT)
-        return True
+    try:
+        with _span('run', cmd=' '.join(cmd)):
+            if failure_ok:
+                return subprocess.call(cmd, cwd=_WEBAPP_ROOT) == 0
+            else:
+                subprocess.check_call(cmd, cwd=_WEBAPP_ROOT)
+                return True
+    finally:
+        # Any git command we run might change refs.
+        if cmd[0] == 'git' and _GIT_REFS is not None:
+            _GIT_REFS.invalidate()
 
 
 def _pipe_command(cmd):
     logging.info('Running pipe-command: %s' % cmd)
-    retval = subprocess.check_output(cmd, cwd=_WEBAPP_ROOT).rstrip()
+    with _span('pipe', cmd=' '.join(cmd)):
+        retval = subprocess.check_output(cmd, cwd=_WEBAPP_ROOT).rstrip()
     logging.info('>>> %s' % retval)
     return retval
 
@@ -183,15 +340,53 @@ def _finish_url(props, **extra_params):
                urllib.urlencode(extra_params)))
 
 
+def _fetch_from_origin(git_revisions):
+    """Bring refs/remotes/origin/<rev> up to date for each branch we need.
+
+    git_revisions are the revisions a stage needs from origin; any of
+    them that are branches there get fetched, all in one 'git fetch'.
+    Fetching from our (large) repo is slow, so we first ask origin
+    where its branches are, with a cheap ls-remote, and don't fetch
+    the ones that are already up to date locally.
+
+    Returns the set of git_revisions that are branches on origin.
+    """
+    # A full sha1 can't be a branch (well, shouldn't be), so don't ask.
+    names = [r for r in git_revisions if not re.match(r'[0-9a-f]{40}$', r)]
+    if not names:
+        return set()
+
+    remote_branches = {}
+    output = _pipe_command(['git', 'ls-remote', '--heads', 'origin'] +
+                           ['refs/heads/%s' % name for name in names])
+    for line in output.splitlines():
+        (sha1, refname) = line.split('\t', 1)
+        remote_branches[refname] = sha1
+
+    local_refs = _git_refs().refs()
+    refspecs = []
+    retval = set()
+    for name in names:
+        sha1 = remote_branches.get('refs/heads/%s' % name)
+        if sha1 is None:        # not a branch on origin
+            continue
+        retval.add(name)
+        if local_refs.get('refs/remotes/origin/%s' % name) != sha1:
+            refspecs.append('+refs/heads/%s:refs/remotes/origin/%s'
+                            % (name, name))
+
+    if refspecs:
+        _run_command(['git', 'fetch', 'origin'] + refspecs)
+    else:
+        logging.info('Already up to date with origin for %s; not fetching'
+                     % ', '.join(sorted(retval)))
+    return retval
+
+
 def _gae_version(git_revision):
     # If git_revision is a branch, make sure it's available locally,
     # so dated_current_git_version can reference it.
-    if _run_command(['git', 'ls-remote', '--exit-code',
-                     '.', 'origin/%s' % git_revision],
-                    failure_ok=True):
-        _run_command(['git', 'fetch', 'origin',
-                      '+refs/heads/%s:refs/remotes/origin/%s'
-                      % (git_revision, git_revision)])
+    if git_revision in _fetch_from_origin([git_revision]):
         git_revision = 'origin/%s' % git_revision
     return deploy.deploy.Git(_WEBAPP_ROOT).dated_current_git_version(
         git_revision)
@@ -286,12 +481,75 @@ def _read_properties(lockdir):
     return retval
 
 
-def _write_properties(props):
-    """Write the given properties dict into lockdir/deploy.prop."""
-    logging.info('Wrote properties to %s: %s' % (props['LOCKDIR'], props))
-    with open(os.path.join(props['LOCKDIR'], 'deploy.prop'), 'w') as f:
-        for (k, v) in sorted(props.iteritems()):
-            print >>f, '%s=%s' % (k, v)
+def _fsync_dir(dirname):
+    """Make sure renames and creates in dirname have hit the disk."""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _append_to_journal(lockdir, changes):
+    """Append a timestamped record of changes to lockdir/deploy.journal.
+
+    The journal is an append-only log, one json object per line, of
+    every change we've made to the properties during this deploy.
+    Unlike deploy.prop, which only has the latest state, it lets you
+    see how (and when) we got there.
+    """
+    record = {'time': time.time(), 'changes': changes}
+    with open(os.path.join(lockdir, 'deploy.journal'), 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Once we release the lock, the lockdir we released may be someone
+# else's at any moment, so we must never write to it again.
+# release_deploy_lock() sets this.
+_RELEASED_LOCKDIR = None
+
+
+def _write_properties(props, changes=None):
+    """Write the given properties dict into lockdir/deploy.prop.
+
+    We first record changes (a dict of the properties that changed,
+    or all of props if None) in the journal, then write the whole
+    thing to a temp file and rename it over deploy.prop.  That way
+    deploy.prop is always either the old version or the new one, even
+    if we crash partway through, so we never corrupt the deploy lock.
+
+    We don't write anything if lockdir is a lock we've released.
+    """
+    lockdir = props['LOCKDIR']
+    if lockdir == _RELEASED_LOCKDIR:
+        logging.info('Not writing properties to %s: we released it'
+                     % lockdir)
+        return
+    _append_to_journal(lockdir, props if changes is None else changes)
+
+    logging.info('Wrote properties to %s: %s' % (lockdir, props))
+    prop_file = os.path.join(lockdir, 'deploy.prop')
+    try:
+        mode = os.stat(prop_file).st_mode & 0777
+    except OSError:        # probably 'file does not exist'
+        mode = 0644
+    (fd, tmpfile) = tempfile.mkstemp(prefix='deploy.prop.', dir=lockdir)
+    try:
+        # mkstemp makes the file 0600; keep deploy.prop's permissions.
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as f:
+            for (k, v) in sorted(props.iteritems()):
+                print >>f, '%s=%s' % (k, v)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, prop_file)
+    except Exception:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+    _fsync_dir(lockdir)
 
 
 def _update_properties(props, new_values):
@@ -334,7 +592,121 @@ def _update_properties(props, new_values):
         new_values['POSSIBLE_NEXT_STEPS'] = ','.join(sorted(next_steps))
 
     props.update(new_values)
-    _write_properties(props)
+    _write_properties(props, new_values)
+
+
+def _history_db(lockdir):
+    """The deploy_history database of past deploys that used lockdir."""
+    return lockdir.rstrip('/') + '.history.db'
+
+
+# How many recent deploys we base our estimates of wait times on.
+_ESTIMATE_FROM_DEPLOYS = 100
+
+
+def _stage_start_times(lockdir):
+    """Return a map from POSSIBLE_NEXT_STEPS value to when we got there.
+
+    This comes from the journal that _write_properties() keeps.
+    """
+    retval = {}
+    try:
+        with open(os.path.join(lockdir, 'deploy.journal')) as f:
+            for line in f:
+                try:
+                    changes = json.loads(line)
+                except ValueError:         # a partial line from a crash
+                    continue
+                stage = changes['changes'].get('POSSIBLE_NEXT_STEPS')
+                if stage is not None:
+                    retval.setdefault(stage, changes['time'])
+    except IOError:                        # probably 'no such file'
+        pass
+    return retval
+
+
+def _record_deploy_history(props, outcome):
+    """Record this deploy in the history database; see deploy_history.py.
+
+    outcome is 'success', 'failure', 'rollback' or 'unlock'.  This
+    must be called while props['LOCKDIR'] still holds the lock.
+    """
+    lockdir = props['LOCKDIR']
+    acquire_time = int(props['LOCK_ACQUIRE_TIME'])
+    history = deploy_history.DeployHistory(_history_db(lockdir))
+    try:
+        history.record(
+            props, outcome,
+            hold_sec=time.time() - acquire_time,
+            stage_start_sec=dict(
+                (stage, start_time - acquire_time)
+                for (stage, start_time)
+                in _stage_start_times(lockdir).iteritems()),
+            # How long each action, command, etc took; see _span().
+            span_sec=_span_sec(_read_trace(lockdir)))
+    finally:
+        history.close()
+
+
+def _estimated_wait_sec(lockdir, current_props, num_ahead):
+    """Guess how long until the deploy behind num_ahead others gets the lock.
+
+    That's however long the current lock-holder has left, plus a
+    typical deploy for each of the num_ahead deploys in line before
+    us.  To guess how long the lock-holder has left, we look at past
+    deploys that were still going as long after getting to the stage
+    it is in now as it has been, and see how much longer they took.
+    Returns None if there are no past deploys to go on.
+    """
+    history = deploy_history.DeployHistory(_history_db(lockdir))
+    try:
+        since = history.recent_since(_ESTIMATE_FROM_DEPLOYS)
+        typical_hold_sec = history.hold_sec_percentile(50, since)
+        if typical_hold_sec is None:
+            return None
+
+        holder_left_sec = 0
+        if current_props:
+            now = time.time()
+            stage = current_props.get('POSSIBLE_NEXT_STEPS')
+            stage_start = _stage_start_times(lockdir).get(stage)
+            acquire_time = int(current_props.get('LOCK_ACQUIRE_TIME', now))
+            sec_left = None
+            if stage_start is not None:
+                sec_left = history.sec_left_percentile(
+                    stage, 50, since, longer_than=now - stage_start)
+                if sec_left is not None:
+                    holder_left_sec = sec_left - (now - stage_start)
+            if sec_left is None:
+                hold_sec = history.hold_sec_percentile(
+                    50, since, longer_than=now - acquire_time)
+                if hold_sec is not None:
+                    holder_left_sec = hold_sec - (now - acquire_time)
+    finally:
+        history.close()
+
+    return holder_left_sec + num_ahead * typical_hold_sec
+
+
+def _place_in_line(num_ahead):
+    if num_ahead == 0:
+        return 'next in line'
+    return '#%s in line' % (num_ahead + 1)
+
+
+def _describe_deploys(current_props, ahead):
+    """Return a string like 'joe (branch foo), then jane (branch bar)'."""
+    deploys = []
+    if current_props:
+        deploys.append(current_props)
+    deploys.extend(ahead)
+    if not deploys:
+        # Someone just got the lock, and hasn't said who they are yet.
+        return 'the current deploy'
+    return ', then '.join('%s (branch %s)'
+                          % (d.get('DEPLOYER_USERNAME', 'Unknown User'),
+                             d.get('GIT_REVISION', 'unknown'))
+                          for d in deploys)
 
 
 def acquire_deploy_lock(props, jenkins_build_url=None,
@@ -347,6 +719,9 @@ def acquire_deploy_lock(props, jenkins_build_url=None,
     properties file, so Jenkins rules can also use this as well:
     the properties file is <lockdir>/deploy.prop.
 
+    If several people are waiting for the lock, they get it in the
+    order they asked for it; see deploy_queue.py.
+
     Once the current lock-holder has held the lock for longer than
     wait_sec, we print an appropriate message to hipchat and exit.
 
@@ -356,41 +731,60 @@ def acquire_deploy_lock(props, jenkins_build_url=None,
            to acquire the lock.  (This is $BUILD_URL inside jenkins,
            and looks something like
            http://jenkins.khanacademy.org/job/testjob/723/).
-        wait_sec: how many seconds to busy-wait for the lock to free up.
+        wait_sec: how many seconds to let the current lock-holder hold
+           the lock before giving up.  We are woken as soon as
+           release_deploy_lock() is called.
         notify_sec: while waiting for the lock, how often to ping
-           hipchat that we're still waiting.
+           hipchat that we're still waiting.  We also ping whenever
+           our place in line changes.
 
     Raises:
         RuntimeError or OSError if we failed to acquire the lock.
     """
-    # Assuming someone is holding the lock, who is it?
+    # Tell the people behind us who we are.
+    info = {'DEPLOYER_USERNAME': props['DEPLOYER_USERNAME'],
+            'GIT_REVISION': props['GIT_REVISION'],
+            'JENKINS_BUILD_URL': jenkins_build_url}
+    with deploy_queue.take_ticket(props['LOCKDIR'], info) as (ticket,
+                                                              notify_fd):
+        _wait_for_lock(props, ticket, notify_fd, jenkins_build_url,
+                       wait_sec, notify_sec)
+
+
+def _wait_for_lock(props, ticket, notify_fd, jenkins_build_url,
+                   wait_sec, notify_sec):
+    """The guts of acquire_deploy_lock, once we have a place in line."""
     lockdir = props['LOCKDIR']
-    try:
-        current_props = _read_properties(lockdir)
-        # How long has the current lock-holder been holding this lock?
-        waited_sec = int(time.time()) - int(current_props['LOCK_ACQUIRE_TIME'])
-    except (IOError, OSError):
-        current_props = {}
-        waited_sec = 0
-
-    done_first_alert = False
-    while waited_sec < wait_sec:
+    start_time = time.time()
+    next_notify_time = start_time + notify_sec
+    last_num_ahead = None
+    # Even without a wakeup, re-check the lock this often, in case
+    # someone removed the lockdir by hand rather than releasing it.
+    max_sleep_sec = 60
+    while True:
+        # Assuming someone is holding the lock, who is it?
         try:
-            os.mkdir(lockdir)
-        except OSError, why:
-            if why.errno != errno.EEXIST:      # file exists
-                raise
-        else:                        # lockdir acquired!
+            current_props = _read_properties(lockdir)
+            # How long has the current lock-holder been holding this lock?
+            held_sec = time.time() - int(current_props['LOCK_ACQUIRE_TIME'])
+        except (IOError, OSError):
+            current_props = {}
+            held_sec = 0
+        if held_sec >= wait_sec:
+            break
+
+        (acquired, ahead) = deploy_queue.try_to_acquire(lockdir, ticket)
+        if acquired:
             # We don't worry with timezones since the lock is always
-            # local to a single machine, which has a consistent timezone.
+            # local to a single machine, which has a consistent
+            # timezone.
             props['LOCK_ACQUIRE_TIME'] = int(time.time())
-            logging.info("Lockdir %s acquired." % lockdir)
             msg = ""
-            if done_first_alert:   # tell them they're no longer in line.
+            if last_num_ahead is not None:   # they're no longer in line
                 msg += "Thank you for waiting! "
-            msg += ("Starting deploy of branch %s.  I'll post to HipChat when "
-                    "both a) tests are done and b) the deploy is finished."
-                    % props['GIT_REVISION'])
+            msg += ("Starting deploy of branch %s.  I'll post to HipChat "
+                    "when both a) tests are done and b) the deploy is "
+                    "finished." % props['GIT_REVISION'])
             if jenkins_build_url and props['AUTO_DEPLOY'] != 'true':
                 msg += ("  If you wish to cancel before then:\n"
                         "(failed) abort: %s/stop"
@@ -403,30 +797,49 @@ def acquire_deploy_lock(props, jenkins_build_url=None,
                        "%s/job/deploy-finish/build, setting STATUS=unlock "
                        "and clicking 'Build'."
                        % (props['JENKINS_URL'].rstrip('/')))
-        if not done_first_alert:
+        eta_sec = _estimated_wait_sec(lockdir, current_props, len(ahead))
+        if eta_sec is None:
+            eta_msg = ''
+        else:
+            eta_msg = ' Estimated wait: %.0f minutes.' % (eta_sec / 60.0)
+
+        if last_num_ahead is None:
+            if ahead:
+                ahead_msg = (' Waiting before you: %s.'
+                             % _describe_deploys({}, ahead))
+            else:
+                ahead_msg = ''
             _alert(props,
-                   "You're next in line to deploy! (branch %s.) "
-                   "Currently deploying (%.0f minutes in so far): "
-                   "%s (branch %s). %s"
-                   % (props['GIT_REVISION'],
-                      waited_sec / 60.0,
-                      current_props.get('DEPLOYER_USERNAME', 'Unknown User'),
-                      current_props.get('GIT_REVISION', 'unknown'),
+                   "You're %s to deploy! (branch %s.) "
+                   "Currently deploying (%.0f minutes in so far): %s.%s%s %s"
+                   % (_place_in_line(len(ahead)),
+                      props['GIT_REVISION'],
+                      held_sec / 60.0,
+                      _describe_deploys(current_props, []),
+                      ahead_msg,
+                      eta_msg,
                       recover_msg),
                    color='yellow')
-            done_first_alert = True
-        elif waited_sec % notify_sec == 0:
+        elif (len(ahead) != last_num_ahead or
+              time.time() >= next_notify_time):
+            next_notify_time = time.time() + notify_sec
             _alert(props,
-                   "You're still next in line to deploy, after %s (branch %s)."
-                   " (Waited %.0f minutes so far). %s"
-                   % (current_props.get('DEPLOYER_USERNAME', 'Unknown User'),
-                      current_props.get('GIT_REVISION', 'unknown'),
-                      waited_sec / 60.0,
+                   "You're %s %s to deploy, after %s. "
+                   "(Waited %.0f minutes so far).%s %s"
+                   % ('still' if len(ahead) == last_num_ahead else 'now',
+                      _place_in_line(len(ahead)),
+                      _describe_deploys(current_props, ahead),
+                      (time.time() - start_time) / 60.0,
+                      eta_msg,
                       recover_msg),
                    color='yellow')
+        last_num_ahead = len(ahead)
 
-        time.sleep(10)     # how often to busy-wait
-        waited_sec += 10
+        timeout = min(next_notify_time, time.time() + max_sleep_sec)
+        if current_props:
+            timeout = min(timeout, int(current_props['LOCK_ACQUIRE_TIME']) +
+                          wait_sec)
+        deploy_queue.wait_for_release(notify_fd, timeout - time.time())
 
     # Figure out where in the pipeline the previous job is, and
     # suggest a course of action based on that.
@@ -454,7 +867,7 @@ def acquire_deploy_lock(props, jenkins_build_url=None,
            "%s\n"
            "Once you done this, you will need to re-start your own deploy."
            % (current_props['DEPLOYER_USERNAME'],
-              waited_sec / 60,
+              int(held_sec) / 60,
               current_props['JENKINS_URL'],
               msg),
            severity=logging.ERROR)
@@ -480,8 +893,13 @@ def _move_lockdir(props, old_lockdir, new_lockdir):
     _update_properties(props, {'LOCKDIR': os.path.abspath(new_lockdir)})
 
 
-def release_deploy_lock(props, backup_lockfile=True):
-    """Raise RuntimeError if the release failed."""
+def release_deploy_lock(props, backup_lockfile=True, outcome='unlock'):
+    """Raise RuntimeError if the release failed.
+
+    outcome says how the deploy ended, for the deploy history: one of
+    'success', 'failure', 'rollback' or 'unlock'.
+    """
+    global _RELEASED_LOCKDIR
     # We move the lockdir to a 'backup' lockdir in case it turns out
     # we want to re-acquire this lock with the same parameters.
     # (This might happen if we released the lockdir in error.)
@@ -493,6 +911,14 @@ def release_deploy_lock(props, backup_lockfile=True):
     except OSError:        # probably 'dir does not exist'
         pass
 
+    _stop_tracing()
+    try:
+        _record_deploy_history(props, outcome)
+    except Exception, why:
+        # This is just for reports and estimating wait times, so don't
+        # let it keep us from releasing the lock.
+        logging.warning('Could not record the deploy history: %s' % why)
+
     try:
         if backup_lockfile:
             _move_lockdir(props, lockdir, old_lockdir)
@@ -505,7 +931,11 @@ def release_deploy_lock(props, backup_lockfile=True):
                severity=logging.ERROR)
         raise RuntimeError('Could not release the deploy-lock (%s)' % why)
 
+    _RELEASED_LOCKDIR = lockdir
     logging.info('Released the deploy lock: %s' % lockdir)
+    # This must come after our last write to lockdir: once they're
+    # awake, the lockdir is up for grabs.
+    deploy_queue.notify_waiters(lockdir)
 
 
 def merge_from_master(props):
@@ -536,9 +966,9 @@ def merge_from_master(props):
         raise ValueError("You must deploy from a branch, you can't deploy "
                          "from master")
 
-    # Make sure our local 'master' matches the remote.
-    _run_command(['git', 'fetch', 'origin',
-                  '+refs/heads/master:refs/remotes/origin/master'])
+    # Make sure our local 'master' matches the remote.  We fetch our
+    # branch at the same time, if it's a branch; see below.
+    origin_branches = _fetch_from_origin(['master', git_revision])
     _run_command(['git', 'checkout', 'master'])
     _run_command(['git', 'reset', '--hard', 'origin/master'])
 
@@ -550,12 +980,7 @@ def merge_from_master(props):
     # Finally, it makes sure the ref exists locally, so we can do
     # 'git rev-parse branch' rather than 'git rev-parse origin/branch'
     # (though only if we're given a branch rather than a commit).
-    if _run_command(['git', 'ls-remote', '--exit-code',
-                     '.', 'origin/%s' % git_revision],
-                    failure_ok=True):
-        _run_command(['git', 'fetch', 'origin',
-                      '+refs/heads/%s:refs/remotes/origin/%s'
-                      % (git_revision, git_revision)])
+    if git_revision in origin_branches:
         # The '--' is needed if git_revision is both a branch and
         # directory, e.g. 'sat'.  '--' says 'treat it as a branch'.
         _run_command(['git', 'checkout', git_revision, '--'])
@@ -563,11 +988,11 @@ def merge_from_master(props):
     else:
         _run_command(['git', 'checkout', git_revision, '--'])
 
-    head_commit = _pipe_command(['git', 'rev-parse', 'HEAD'])
-    master_commit = _pipe_command(['git', 'rev-parse', 'master'])
+    (head_commit, master_commit, revision_commit) = (
+        _git_refs().resolve_many(['HEAD', 'master', git_revision]))
 
     # Sanity check: HEAD should be at the revision we want to deploy from.
-    if head_commit != _pipe_command(['git', 'rev-parse', git_revision]):
+    if head_commit != revision_commit:
         raise RuntimeError('HEAD unexpectedly at %s, not %s'
                            % (head_commit, git_revision))
 
@@ -579,9 +1004,8 @@ def merge_from_master(props):
         return
 
     # Now we need to merge master into our branch.  First, make sure
-    # we *are* a branch.  git show-ref returns line like 'd41eba92 refs/...'
-    all_branches = _pipe_command(['git', 'show-ref']).splitlines()
-    all_branch_names = [l.split()[1] for l in all_branches]
+    # we *are* a branch.
+    all_branch_names = _git_refs().refs().keys()
     if ('refs/remotes/origin/%s' % git_revision) not in all_branch_names:
         raise ValueError('%s is not a branch name on the remote, like these:'
                          '\n  %s' % ('\n  '.join(sorted(all_branch_names))))
@@ -611,7 +1035,7 @@ def _tag_release(props):
     """Tag the github commit that was deployed with the deploy-name."""
     tag_name = 'gae-%s' % props['VERSION_NAME']
     # Don't try to re-create the tag if it already exists.
-    if not _pipe_command(['git', 'tag', '-l', tag_name]):
+    if not _git_refs().has_ref('refs/tags/%s' % tag_name):
         _run_command(
             ['git', 'tag',
              '-m',
@@ -624,7 +1048,7 @@ def _tag_as_bad_version(props):
     """Tag the currently deployed github commit as having problems."""
     tag_name = 'gae-%s-bad' % props['VERSION_NAME']
     # Don't try to re-create the tag if it already exists.
-    if not _pipe_command(['git', 'tag', '-l', tag_name]):
+    if not _git_refs().has_ref('refs/tags/%s' % tag_name):
         _run_command(
             ['git', 'tag',
              '-m', 'Bad version (%s): rolled back' % props['VERSION_NAME'],
@@ -660,11 +1084,10 @@ def merge_to_master(props):
     # local (jenkins) master to commit X, but subsequent commits have
     # moved the remote (github) version of master to commit Y.  It
     # also makes sure the ref exists locally, so we can do the merge.
-    _run_command(['git', 'fetch', 'origin',
-                  '+refs/heads/master:refs/remotes/origin/master'])
+    _fetch_from_origin(['master'])
     _run_command(['git', 'checkout', 'master'])
     _run_command(['git', 'reset', '--hard', 'origin/master'])
-    head_commit = _pipe_command(['git', 'rev-parse', 'HEAD'])
+    head_commit = _git_refs().resolve('HEAD')
 
     # The merge exits with rc > 0 if there were conflicts
     logging.info("Merging %s into master" % branch_name)
@@ -710,18 +1133,19 @@ def _rollback_deploy(props):
         _run_command(['git', 'push', '--tags'])
 
         logging.info('Calling set_default to %s' % props['ROLLBACK_TO'])
-        with _password_on_stdin(props['DEPLOY_PW_FILE']):
-            deploy.set_default.main(props['ROLLBACK_TO'],
-                                    email=props['DEPLOY_EMAIL'],
-                                    passin=True,
-                                    num_instances_to_prime=None,
-                                    monitor_minutes=0,
-                                    hipchat_room=props['HIPCHAT_ROOM'],
-                                    dry_run=_DRY_RUN)
+        _flush_alerts()
+        with _span('rollback_set_default'):
+            with _password_on_stdin(props['DEPLOY_PW_FILE']):
+                deploy.set_default.main(props['ROLLBACK_TO'],
+                                        email=props['DEPLOY_EMAIL'],
+                                        passin=True,
+                                        num_instances_to_prime=None,
+                                        monitor_minutes=0,
+                                        hipchat_room=props['HIPCHAT_ROOM'],
+                                        dry_run=_DRY_RUN)
 
         # If the version we rolled back *to* is marked bad, warn about that.
-        if _pipe_command(['git', 'tag', '-l',
-                          '%s-bad' % props['ROLLBACK_TO']]):
+        if _git_refs().has_ref('refs/tags/%s-bad' % props['ROLLBACK_TO']):
             _alert(props,
                    "(poo) WARNING: Rolled back to %s, but that version "
                    "has itself been marked as bad.  You may need to manually "
@@ -740,9 +1164,13 @@ def _rollback_deploy(props):
     return True
 
 
+def _version_hostname(version):
+    return '%s-dot-khan-academy.appspot.com' % version
+
+
 def manual_test(props):
     """Send a message to hipchat saying to do pre-set-default manual tests."""
-    hostname = '%s-dot-khan-academy.appspot.com' % props['VERSION_NAME']
+    hostname = _version_hostname(props['VERSION_NAME'])
     _alert(props,
            "https://%s/ (branch %s) is uploaded to appengine! "
            "Do some manual testing on it, then either:\n"
@@ -753,7 +1181,6 @@ def manual_test(props):
               _set_default_url(props, AUTO_DEPLOY=props['AUTO_DEPLOY']),
               _finish_url(props, STATUS='failure', WHY='aborted')),
            color='green')
-    time.sleep(1)   # to help the two hipchat alerts be ordered properly
 
     # Suggest some urls to do for manual testing, as both links and a
     # commandline tool.
@@ -768,11 +1195,148 @@ def manual_test(props):
            html=True, prefix_with_username=False)
 
 
-def set_default(props, monitoring_time=10, jenkins_build_url=None):
+# How many instances we prime if the monitoring data doesn't say how
+# much traffic the site is getting (and until it does).
+_DEFAULT_INSTANCES_TO_PRIME = 100
+
+
+def _instances_to_prime(pre_monitoring_data):
+    """How many instances to prime for the site's current traffic.
+
+    pre_monitoring_data is what get_predeploy_monitoring_data()
+    returned.  Returns None, with a warning, if it doesn't have the
+    request rate.
+    """
+    requests_per_sec = instance_primer.requests_per_sec_from_monitoring_data(
+        pre_monitoring_data)
+    if requests_per_sec is None:
+        return None
+    return instance_primer.instances_for_traffic(requests_per_sec)
+
+
+def _log_priming_progress(stats):
+    if stats['recent_median_sec'] is None:
+        latency = 'no responses yet'
+    else:
+        latency = ('median latency %.0fms'
+                   % (stats['recent_median_sec'] * 1000))
+    logging.info("Priming %s instances: sent %s requests (%s errors) "
+                 "in %.0f seconds, %s%s"
+                 % (stats['num_instances'], stats['num_requests'],
+                    stats['num_errors'], stats['elapsed_sec'], latency,
+                    ('; done (%s)' % stats['stopped_because']
+                     if stats['stopped_because'] else '')))
+
+
+class _StreamingRegressionError(deploy.set_default.MonitoringError):
+    """The streaming comparison found the new version is worse."""
+
+
+def _log_monitor(props, monitoring_time, pre_monitoring_data):
+    """Have set_default.py monitor the logs for monitoring_time minutes."""
+    # set_default.py sends its own hipchat messages.
+    _flush_alerts()
+    deploy.set_default.monitor(props['VERSION_NAME'], monitoring_time,
+                               pre_monitoring_data,
+                               hipchat_room=props['HIPCHAT_ROOM'])
+
+
+# In streaming mode, set_default.py monitors the logs for this many
+# minutes (or for --monitoring_time, if that's less), rather than for
+# all of --monitoring_time; see _streaming_monitor().
+_STREAMING_LOG_MONITORING_TIME = 5
+
+# The pages we probe, on both the new and the old version, in
+# streaming mode.
+_STREAMING_PROBE_PATHS = ('/', '/math', '/login',
+                          '/api/internal/dev/version')
+
+
+def _streaming_monitor(props, monitoring_time, pre_monitoring_data):
+    """Monitor the logs, and meanwhile compare the new default to the old.
+
+    We probe both versions, for up to monitoring_time minutes, until
+    we can tell if the new one is worse or not (see
+    streaming_monitor.py).  Meanwhile, set_default.py monitors the
+    logs as usual, but only for _STREAMING_LOG_MONITORING_TIME minutes.
+
+    If the comparison finds the new version is worse, we raise right
+    away, without waiting for the log monitor.  We only finish early
+    once the log monitor has passed *and* the comparison has found the
+    new version healthy, since probing a few pages can't catch every
+    problem.  If the comparison still can't tell when monitoring_time
+    is up, the new version never looked worse, and its logs looked
+    fine, so we pass.
+
+    Raises:
+        _StreamingRegressionError if the new version has significantly
+        more errors, or is significantly slower, than the old.
+        deploy.set_default.MonitoringError if the log monitor finds a
+        problem.
+    """
+    log_monitor_done = threading.Event()
+    log_monitor_failed = threading.Event()
+    log_monitor_failures = []
+
+    def log_monitor():
+        try:
+            _log_monitor(props,
+                         min(monitoring_time, _STREAMING_LOG_MONITORING_TIME),
+                         pre_monitoring_data)
+        except Exception:
+            log_monitor_failures.append(sys.exc_info())
+            log_monitor_failed.set()
+        finally:
+            log_monitor_done.set()
+
+    # We can't interrupt set_default.py, so this is a daemon thread:
+    # if we find a regression, we roll back without waiting for it.
+    thread = threading.Thread(target=_in_current_span(log_monitor),
+                              name='log-monitor')
+    thread.daemon = True
+    thread.start()
+
+    monitor = streaming_monitor.StreamingMonitor(
+        streaming_monitor.http_probe_fn(
+            'https://%s/' % _version_hostname(props['VERSION_NAME']),
+            'https://%s/' % _version_hostname(props['ROLLBACK_TO']),
+            _STREAMING_PROBE_PATHS),
+        max_sec=monitoring_time * 60,
+        progress_fn=lambda stats: logging.info(
+            "Comparing to %s (%.0f seconds): %s"
+            % (props['ROLLBACK_TO'], stats['elapsed_sec'], stats['reason'])),
+        # If the logs look bad, there's no point comparing any more.
+        stop_event=log_monitor_failed)
+    decision = monitor.run()
+    if decision == 'regression':
+        raise _StreamingRegressionError(
+            "%s looks worse than %s: %s"
+            % (props['VERSION_NAME'], props['ROLLBACK_TO'], monitor.reason()))
+    logging.info("Done comparing to %s after %.0f seconds (%s): %s"
+                 % (props['ROLLBACK_TO'], monitor.stats()['elapsed_sec'],
+                    decision, monitor.reason()))
+
+    # We wait with a timeout because, in python2, an untimed wait
+    # can't be interrupted by a signal.
+    while not log_monitor_done.wait(1):
+        pass
+    if log_monitor_failures:
+        (exc_type, exc_value, exc_traceback) = log_monitor_failures[0]
+        raise exc_type, exc_value, exc_traceback
+
+
+def set_default(props, monitoring_time=10, jenkins_build_url=None,
+                monitoring_mode='fixed'):
     """Call set_default.py to make a specified deployed version live.
 
     If the user asked for monitoring, also do the monitoring, potentially
-    rolling back if there's a problem.
+    rolling back if there's a problem.  set_default.py monitors the
+    logs for monitoring_time minutes.  With monitoring_mode
+    'streaming', we instead compare the new version to the old one, for
+    up to monitoring_time minutes, while set_default.py monitors the
+    logs for a shorter time; we roll back as soon as we're sure the
+    new one is worse, and finish as soon as the logs look fine and
+    we're sure it isn't.  See _streaming_monitor().
 
     Raises:
         RuntimeError or deploy.set_default.MonitoringError if we
@@ -785,38 +1349,85 @@ def set_default(props, monitoring_time=10, jenkins_build_url=None):
     """
     logging.info("Changing default from %s to %s"
                  % (props['ROLLBACK_TO'], props['VERSION_NAME']))
-    # I do the deploy steps one at a time so I can intersperse some
-    # hipchat mesasges.
-    did_priming = False
-    try:
-        pre_monitoring_data = deploy.set_default.get_predeploy_monitoring_data(
-            monitoring_time)
-
-        logging.info("Priming 100 instances")
-        deploy.set_default.prime(version=props['VERSION_NAME'],
-                                 num_instances_to_prime=100,
-                                 dry_run=_DRY_RUN)
-        did_priming = True
-
+    # Collecting pre-deploy monitoring data and priming don't depend
+    # on each other, so we do them at the same time.  The runner
+    # records which steps finished, e.g. whether we did the priming.
+    # set-default and monitoring come after both, and we run them
+    # here in the main thread: they're webapp code that may use
+    # signals or expect to see a ctrl-C.
+    runner = task_runner.TaskRunner()
+
+    # We start priming before we know how much traffic there is, and
+    # resize it once the monitoring data tells us.
+    primer = instance_primer.Primer(
+        'https://%s/' % _version_hostname(props['VERSION_NAME']),
+        _DEFAULT_INSTANCES_TO_PRIME,
+        progress_fn=_log_priming_progress,
+        # If getting the monitoring data fails, stop priming.
+        stop_event=runner.stop_event)
+
+    def get_predeploy_monitoring_data():
+        with _span('get_predeploy_monitoring_data'):
+            pre_monitoring_data = (
+                deploy.set_default.get_predeploy_monitoring_data(
+                    monitoring_time))
+        num_instances = _instances_to_prime(pre_monitoring_data)
+        if num_instances is not None:
+            logging.info("Priming %s instances, based on current traffic"
+                         % num_instances)
+            primer.set_num_instances(num_instances)
+        return pre_monitoring_data
+
+    def prime():
+        """Return True if we primed, False if we were stopped early."""
+        logging.info("Priming instances")
+        with _span('prime'):
+            if _DRY_RUN:
+                logging.info("Not priming: this is a dry run")
+                return True
+            stats = primer.run()
+            if stats['stopped_because'] == 'cancelled':
+                # The runner will raise whatever made it stop us.
+                return False
+            if stats['num_errors'] == stats['num_requests']:
+                raise RuntimeError('Every priming request to %s failed'
+                                   % props['VERSION_NAME'])
+            return True
+
+    def set_new_default():
         logging.info("Setting default")
-        with _password_on_stdin(props['DEPLOY_PW_FILE']):
-            deploy.set_default.set_default(version=props['VERSION_NAME'],
-                                           email=props['DEPLOY_EMAIL'],
-                                           passin=True,
-                                           dry_run=_DRY_RUN)
-
+        _flush_alerts()
+        with _span('set_default'):
+            with _password_on_stdin(props['DEPLOY_PW_FILE']):
+                deploy.set_default.set_default(
+                    version=props['VERSION_NAME'],
+                    email=props['DEPLOY_EMAIL'],
+                    passin=True,
+                    dry_run=_DRY_RUN)
+
+    def monitor():
         if (monitoring_time and jenkins_build_url and
                 props['AUTO_DEPLOY'] != 'true'):
+            if monitoring_mode == 'streaming':
+                what = ('it for up to %s minutes: the logs for %s '
+                        'minutes, and how it compares to %s (I\'ll roll '
+                        'back right away if it looks worse, and finish '
+                        'early once it clearly isn\'t)'
+                        % (monitoring_time,
+                           min(monitoring_time,
+                               _STREAMING_LOG_MONITORING_TIME),
+                           props['ROLLBACK_TO']))
+            else:
+                what = 'logs for %s minutes' % monitoring_time
             _alert(props,
                    "I've deployed to %s, and will be monitoring "
-                   "logs for %s minutes.  After that, I'll post "
+                   "%s.  After that, I'll post "
                    "next steps to HipChat.  If you detect a problem in "
                    "the meantime you can cancel the deploy (note: this "
                    "link will only work for the next %s minutes):\n"
                    "(failed) abort and rollback: %s/stop"
-                   % (props['VERSION_NAME'], monitoring_time, monitoring_time,
+                   % (props['VERSION_NAME'], what, monitoring_time,
                       jenkins_build_url.rstrip('/')))
-            time.sleep(1)  # to help the two hipchat alerts be ordered properly
             _alert(props,
                    ("While that's going on, manual-test on the live site!<br>"
                     "%s<br>\n"
@@ -828,15 +1439,31 @@ def set_default(props, monitoring_time=10, jenkins_build_url=None):
                        'default', 'default')),
                    html=True, prefix_with_username=False)
 
-        deploy.set_default.monitor(props['VERSION_NAME'], monitoring_time,
-                                   pre_monitoring_data,
-                                   hipchat_room=props['HIPCHAT_ROOM'])
+        with _span('monitor'):
+            pre_monitoring_data = runner.results[
+                'get_predeploy_monitoring_data']
+            if monitoring_mode == 'streaming' and monitoring_time:
+                _streaming_monitor(props, monitoring_time,
+                                   pre_monitoring_data)
+            else:
+                _log_monitor(props, monitoring_time, pre_monitoring_data)
+
+    runner.add('get_predeploy_monitoring_data',
+               _in_current_span(get_predeploy_monitoring_data))
+    runner.add('prime', _in_current_span(prime))
 
+    try:
+        runner.run()
+        set_new_default()
+        monitor()
     except deploy.set_default.MonitoringError, why:
-        # Wait a little to make sure this hipchat message comes after
-        # the "I've deployed to ..." message we emitted above above.
-        time.sleep(10)
-        if props['AUTO_DEPLOY'] == 'true':
+        # (We flushed the alert queue before monitoring, so the "I've
+        # deployed to ..." message we emitted above, and whatever
+        # monitor() itself sent to hipchat, come before this one.)
+        # The streaming comparison only complains when it's sure
+        # there's a problem, so we don't ask before rolling back.
+        if (props['AUTO_DEPLOY'] == 'true' or
+                isinstance(why, _StreamingRegressionError)):
             _alert(props,
                    "(sadpanda) %s." % why,
                    severity=logging.WARNING)
@@ -864,6 +1491,7 @@ def set_default(props, monitoring_time=10, jenkins_build_url=None):
                    severity=logging.ERROR)
             raise
 
+        did_priming = runner.results.get('prime', False)
         if did_priming:
             priming_flag = '--no-priming '
         else:
@@ -947,10 +1575,10 @@ def finish_with_success(props):
            "Time for a happy dance!"
            % (props['VERSION_NAME'], props['GIT_REVISION']),
            color='green')
-    release_deploy_lock(props, backup_lockfile=False)
+    release_deploy_lock(props, backup_lockfile=False, outcome='success')
 
 
-def finish_with_failure(props):
+def finish_with_failure(props, outcome='failure'):
     """Release the deploy lock after a failed deploy, or raise if we can't."""
     if props['LAST_ERROR']:
         why = ": %s" % props['LAST_ERROR']
@@ -960,7 +1588,7 @@ def finish_with_failure(props):
            "(pokerface) Deploy of %s (branch %s) failed%s"
            % (props['VERSION_NAME'], props['GIT_REVISION'], why),
            severity=logging.ERROR)
-    release_deploy_lock(props)
+    release_deploy_lock(props, outcome=outcome)
 
 
 def finish_with_rollback(props):
@@ -976,7 +1604,7 @@ def finish_with_rollback(props):
                "lock: %s" % _finish_url(props, STATUS='unlock'),
                severity=logging.ERROR)
         raise RuntimeError('Failed to roll back to the previous deploy.')
-    finish_with_failure(props)
+    finish_with_failure(props, outcome='rollback')
 
 
 def relock(props):
@@ -1007,9 +1635,152 @@ def relock(props):
     _move_lockdir(props, old_lockdir, new_lockdir)
 
 
+def _read_trace(lockdir):
+    """Return the spans that _span() recorded in lockdir, in order."""
+    retval = []
+    try:
+        with open(_trace_file(lockdir)) as f:
+            for line in f:
+                try:
+                    retval.append(json.loads(line))
+                except ValueError:         # a partial line from a crash
+                    continue
+    except IOError:                        # probably 'no such file'
+        pass
+    retval.sort(key=lambda span: span['start'])
+    return retval
+
+
+def _span_key(span):
+    """What we group spans by, across deploys: the action, 'git fetch'..."""
+    attrs = span.get('attrs', {})
+    if 'cmd' in attrs:
+        return ' '.join(attrs['cmd'].split()[:2])
+    if 'url' in attrs:
+        return 'urlopen %s' % attrs['url']
+    return span['name']
+
+
+def _span_sec(spans):
+    """Return a map from _span_key() to the total seconds spent in it."""
+    retval = {}
+    for span in spans:
+        key = _span_key(span)
+        retval[key] = retval.get(key, 0) + span['end'] - span['start']
+    return retval
+
+
+def _critical_path(span, children):
+    """Return the children of span on its critical path, in time order.
+
+    That's the child that finished last, then the child that finished
+    last before that one started, and so on.  Without any concurrency,
+    that is just all the children.
+    """
+    retval = []
+    cursor = span['end']
+    for child in sorted(children.get(span['id'], []),
+                        key=lambda s: s['end'], reverse=True):
+        if child['end'] <= cursor:
+            retval.append(child)
+            cursor = child['start']
+    return retval[::-1]
+
+
+def _format_sec(sec):
+    if sec >= 120:
+        return '%.1fm' % (sec / 60.0)
+    return '%.1fs' % sec
+
+
+def _print_critical_path(span, children, total_sec, depth, out):
+    sec = span['end'] - span['start']
+    label = ' '.join([span['name']] +
+                     [str(v) for (_, v)
+                      in sorted(span.get('attrs', {}).iteritems())])
+    width = 60 - 2 * depth
+    if len(label) > width:
+        label = label[:width - 3] + '...'
+    print >>out, '%s%-*s %7s %3.0f%%%s' % (
+        '  ' * depth, width, label, _format_sec(sec),
+        100.0 * sec / total_sec, ' (failed)' if span.get('failed') else '')
+
+    path = _critical_path(span, children)
+    for child in path:
+        # Don't bother with the little stuff.
+        if child['end'] - child['start'] >= 0.01 * total_sec:
+            _print_critical_path(child, children, total_sec, depth + 1, out)
+    untraced_sec = sec - sum(c['end'] - c['start'] for c in path)
+    if path and untraced_sec >= 0.01 * total_sec:
+        print >>out, '%s%-*s %7s %3.0f%%' % (
+            '  ' * (depth + 1), width - 2, '(untraced)',
+            _format_sec(untraced_sec), 100.0 * untraced_sec / total_sec)
+
+
+def print_report(lockdir, out=sys.stdout, report_days=30):
+    """Print where the time went in the latest deploy, and recent ones.
+
+    For the latest deploy -- the one holding the lock, or else the
+    last one to hold it -- we print the critical path through each
+    action, and the time between actions, which is time spent waiting
+    on people.  For the deploys in the last report_days days, we print
+    percentiles of how long each action and kind of command took, and
+    how often each deployer's deploys were rolled back.
+    """
+    trace_lockdir = lockdir
+    if not os.path.exists(_trace_file(trace_lockdir)):
+        trace_lockdir = lockdir + '.last'
+    spans = _read_trace(trace_lockdir)
+    if spans:
+        print >>out, 'Latest deploy (%s):' % _trace_file(trace_lockdir)
+        children = {}
+        for span in spans:
+            children.setdefault(span['parent'], []).append(span)
+        top_level = children.get(None, [])
+        total_sec = (max(s['end'] for s in top_level) - top_level[0]['start'])
+        prev_end = top_level[0]['start']
+        for span in top_level:
+            if span['start'] - prev_end >= 1:
+                print >>out, '  [waited %s]' % _format_sec(
+                    span['start'] - prev_end)
+            _print_critical_path(span, children, total_sec, 1, out)
+            prev_end = max(prev_end, span['end'])
+        print >>out
+
+    history = deploy_history.DeployHistory(_history_db(lockdir))
+    try:
+        since = time.time() - report_days * 86400
+        num_deploys = history.num_deploys(since)
+        if not num_deploys:
+            return
+        print >>out, ('Over the last %s days (%s deploys):'
+                      % (report_days, num_deploys))
+        row_format = '  %-40s %7s %7s %7s %7s'
+        print >>out, row_format % ('', 'p50', 'p90', 'p95', 'max')
+
+        def row(name, percentile_fn):
+            return row_format % ((name[:40],) +
+                                 tuple(_format_sec(percentile_fn(pct))
+                                       for pct in (50, 90, 95, 100)))
+
+        print >>out, row('(lock held)', lambda pct: (
+            history.hold_sec_percentile(pct, since)))
+        for name in history.timing_names(since):
+            print >>out, row(name, lambda pct: (
+                history.timing_percentile(name, pct, since)))
+        print >>out
+
+        print >>out, 'Rollback rate by deployer:'
+        rates = history.rollback_rate_by_deployer(since)
+        for deployer in sorted(rates, key=lambda d: (-rates[d], d)):
+            print >>out, '  %-40s %6.1f%%' % (deployer, rates[deployer] * 100)
+    finally:
+        history.close()
+
+
 def main(action, lockdir, acquire_lock_args=(),
-         token=None, monitoring_time=None, jenkins_build_url=None,
-         caller_email=None):
+         token=None, monitoring_time=None, monitoring_mode='fixed',
+         jenkins_build_url=None, caller_email=None):
     """action is one of:
     * acquire-lock: acquire the deploy lock.
     * merge-from-master: merge master into current branch if necessary.
@@ -1020,11 +1791,12 @@ def main(action, lockdir, acquire_lock_args=(),
     * finish-with-failure: ditto, but because the deploy failed (pre-set-dflt)
     * finish-with-rollback: ditto, because the deploy failed (post-set-default)
     * relock: re-acquire the lock from lockdir.last, if possible.
+    * report: print where the time went in recent deploys.
 
     If action is acquire-lock, then acquire_lock_args should be
     specified as a list of the arguments to _create_properties().
 
-    monitoring_time is ignored except by set_default.
+    monitoring_time and monitoring_mode are ignored except by set_default.
 
     caller_email is ignored except by finish-with-unlock (and also
     if we can't acquire the lock).
@@ -1044,6 +1816,10 @@ def main(action, lockdir, acquire_lock_args=(),
     hand, if the command does not raise an exception, we return True,
     which will cause the Jenkins job to say that this step succeeded.
     """
+    if action == 'report':
+        print_report(lockdir)
+        return True
+
     if action == 'acquire-lock':
         props = _create_properties(*acquire_lock_args)
     else:
@@ -1100,67 +1876,14 @@ def main(action, lockdir, acquire_lock_args=(),
         # We just ignore this action, so we don't release the lock.
         return True
 
-    try:
-        if action == 'acquire-lock':
-            acquire_deploy_lock(props, jenkins_build_url)
-            _write_properties(props)
-            _update_properties(props,
-                               {'POSSIBLE_NEXT_STEPS': 'merge-from-master'})
-
-        elif action == 'merge-from-master':
-            merge_from_master(props)
-            # Now we need to update the props file to indicate the new
-            # GIT_SHA1 after merging.  (This also updates VERSION_NAME.)
-            sha1 = _pipe_command(['git', 'rev-parse', props['GIT_REVISION']])
-            # We can go straight to set-default if the user ran with
-            # AUTO_DEPLOY, and straight to finish if they ran with DEPLOY=no.
-            if props['AUTO_DEPLOY'] == 'true':
-                next_steps = 'set-default'
-            else:
-                next_steps = 'manual-test'
-            # We don't know if the user ran with DEPLOY=no, so always allow it.
-            next_steps += ',finish-with-success'
-            _update_properties(props,
-                               {'GIT_SHA1': sha1,
-                                'POSSIBLE_NEXT_STEPS': next_steps})
-
-        elif action == 'manual-test':
-            manual_test(props)
-            _update_properties(props,
-                               {'POSSIBLE_NEXT_STEPS': 'set-default'})
-
-        elif action == 'set-default':
-            set_default(props, monitoring_time=monitoring_time,
-                        jenkins_build_url=jenkins_build_url)
-            # If set_default didn't raise an exception, all is happy.
-            if props['AUTO_DEPLOY'] == 'true':
-                finish_with_success(props)
-            else:
-                _update_properties(props,
-                                   {'POSSIBLE_NEXT_STEPS':
-                                    'finish-with-success'})
-
-        elif action == 'finish-with-unlock':
-            finish_with_unlock(props, _email_to_hipchat_name(caller_email))
-
-        elif action == 'finish-with-success':
-            finish_with_success(props)
-
-        elif action == 'finish-with-failure':
-            finish_with_failure(props)
+    # We own the lock (or are about to), so can record timings in it.
+    if action != 'acquire-lock':
+        _start_tracing(props)
 
-        elif action == 'finish-with-rollback':
-            finish_with_rollback(props)
-
-        elif action == 'relock':
-            relock(props)
-            # You relock when something went wrong, so any step could
-            # legitimately go next.
-            _update_properties(props,
-                               {'POSSIBLE_NEXT_STEPS': '<all>'})
-
-        else:
-            raise RuntimeError("Unknown action '%s'" % action)
+    try:
+        with _span(action):
+            _run_action(action, props, monitoring_time, monitoring_mode,
+                        jenkins_build_url, caller_email)
 
         if os.path.exists(os.path.join(props['LOCKDIR'], 'deploy.prop')):
             _update_properties(props, {'LAST_ERROR': ''})
@@ -1175,6 +1898,73 @@ def main(action, lockdir, acquire_lock_args=(),
         return False
 
 
+def _run_action(action, props, monitoring_time, monitoring_mode,
+                jenkins_build_url, caller_email):
+    """The guts of main(): do action.  Raises on failure."""
+    if action == 'acquire-lock':
+        acquire_deploy_lock(props, jenkins_build_url)
+        _start_tracing(props)
+        _write_properties(props)
+        _update_properties(props,
+                           {'POSSIBLE_NEXT_STEPS': 'merge-from-master'})
+
+    elif action == 'merge-from-master':
+        merge_from_master(props)
+        # Now we need to update the props file to indicate the new
+        # GIT_SHA1 after merging.  (This also updates VERSION_NAME.)
+        sha1 = _git_refs().resolve(props['GIT_REVISION'])
+        # We can go straight to set-default if the user ran with
+        # AUTO_DEPLOY, and straight to finish if they ran with DEPLOY=no.
+        if props['AUTO_DEPLOY'] == 'true':
+            next_steps = 'set-default'
+        else:
+            next_steps = 'manual-test'
+        # We don't know if the user ran with DEPLOY=no, so always allow it.
+        next_steps += ',finish-with-success'
+        _update_properties(props,
+                           {'GIT_SHA1': sha1,
+                            'POSSIBLE_NEXT_STEPS': next_steps})
+
+    elif action == 'manual-test':
+        manual_test(props)
+        _update_properties(props,
+                           {'POSSIBLE_NEXT_STEPS': 'set-default'})
+
+    elif action == 'set-default':
+        set_default(props, monitoring_time=monitoring_time,
+                    jenkins_build_url=jenkins_build_url,
+                    monitoring_mode=monitoring_mode)
+        # If set_default didn't raise an exception, all is happy.
+        if props['AUTO_DEPLOY'] == 'true':
+            finish_with_success(props)
+        else:
+            _update_properties(props,
+                               {'POSSIBLE_NEXT_STEPS':
+                                'finish-with-success'})
+
+    elif action == 'finish-with-unlock':
+        finish_with_unlock(props, _email_to_hipchat_name(caller_email))
+
+    elif action == 'finish-with-success':
+        finish_with_success(props)
+
+    elif action == 'finish-with-failure':
+        finish_with_failure(props)
+
+    elif action == 'finish-with-rollback':
+        finish_with_rollback(props)
+
+    elif action == 'relock':
+        relock(props)
+        # You relock when something went wrong, so any step could
+        # legitimately go next.
+        _update_properties(props,
+                           {'POSSIBLE_NEXT_STEPS': '<all>'})
+
+    else:
+        raise RuntimeError("Unknown action '%s'" % action)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('action',
@@ -1187,6 +1977,7 @@ if __name__ == '__main__':
                                  'finish-with-failure',
                                  'finish-with-rollback',
                                  'relock',
+                                 'report',
                                  ),
                         help='Action to perform')
     parser.add_argument('--lockdir',
@@ -1237,6 +2028,17 @@ if __name__ == '__main__':
                         default=10,
                         help=("How long to monitor in set-default, in "
                               "minutes (0 to disable monitoring)."))
+    parser.add_argument('--monitoring_mode', choices=('fixed', 'streaming'),
+                        default='fixed',
+                        help=("fixed: monitor the logs for "
+                              "--monitoring_time.  streaming: compare the "
+                              "new version to the old for up to "
+                              "--monitoring_time, and monitor the logs for "
+                              "the first %s minutes; roll back as soon as "
+                              "the new one is clearly worse, and finish as "
+                              "soon as the logs look fine and it's clearly "
+                              "not (default %%(default)s)."
+                              % _STREAMING_LOG_MONITORING_TIME))
     # This is used to cancel running jobs
     parser.add_argument('--jenkins-build-url',
                         help=("The url of the job that is calling this: "
@@ -1250,20 +2052,28 @@ if __name__ == '__main__':
     logging.basicConfig(format="[%(levelname)s] %(message)s")
     logging.getLogger().setLevel(logging.INFO)
 
+    if args.action == 'acquire-lock':
+        # _current_gae_version() asks appengine, so we only call it
+        # when we need to (and not, say, for 'report').
+        acquire_lock_args = (os.path.abspath(args.lockdir),
+                             args.deployer_email,
+                             args.git_revision,
+                             args.auto_deploy == 'true',
+                             _current_gae_version(),
+                             args.jenkins_url,
+                             args.hipchat_room,
+                             args.hipchat_sender,
+                             args.deploy_email,
+                             args.deploy_pw_file,
+                             args.token)
+    else:
+        acquire_lock_args = ()
+
     rc = main(args.action, os.path.abspath(args.lockdir),
-              acquire_lock_args=(os.path.abspath(args.lockdir),
-                                 args.deployer_email,
-                                 args.git_revision,
-                                 args.auto_deploy == 'true',
-                                 _current_gae_version(),
-                                 args.jenkins_url,
-                                 args.hipchat_room,
-                                 args.hipchat_sender,
-                                 args.deploy_email,
-                                 args.deploy_pw_file,
-                                 args.token),
+              acquire_lock_args=acquire_lock_args,
               token=args.token,
               monitoring_time=args.monitoring_time,
+              monitoring_mode=args.monitoring_mode,
               jenkins_build_url=args.jenkins_build_url,
               caller_email=args.deployer_email)
     sys.exit(0 if rc else 1)
@@ -0,0 +1,233 @@
+"""A first-come, first-served line for the deploy lock.
+
+The deploy lock is a directory (the "lockdir"): whoever creates it
+holds the lock.  Deployers waiting for it used to poll, every so
+often, and whoever happened to poll first after a release got the
+lock.  Instead, each waiter takes a ticket, and only the waiter with
+the lowest live ticket may create the lockdir; and whoever releases
+the lock wakes everyone up, so they needn't poll.
+
+A ticket is a fifo in queue_dir(lockdir), named by a sequence number
+so tickets sort in the order they were taken.  Next to it is
+<ticket>.json, which says who is waiting, for the benefit of the
+people behind them.  The waiter holds its fifo open for reading
+while it waits, so notify_waiters() can wake it by writing to the
+fifo -- and a fifo that nobody is reading belongs to a waiter that
+died without cleaning up after itself, which we skip.
+
+A typical waiter does:
+    with deploy_queue.take_ticket(lockdir, {'who': ...}) as (my_ticket,
+                                                            notify_fd):
+        while True:
+            (acquired, ahead) = deploy_queue.try_to_acquire(lockdir,
+                                                            my_ticket)
+            if acquired:
+                break
+            deploy_queue.wait_for_release(notify_fd, 60)
+and, once it's done with the lock, it removes the lockdir and calls
+notify_waiters(lockdir).
+"""
+
+import contextlib
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import time
+
+
+# A ticket younger than this may not have opened its fifo yet, so we
+# don't decide its waiter is gone just because nobody is reading it.
+_TICKET_GRACE_SEC = 10
+
+
+def queue_dir(lockdir):
+    """Where deployers waiting on lockdir keep their tickets.
+
+    This is a sibling of lockdir, rather than inside it, since lockdir
+    gets renamed away when the lock is released.
+    """
+    return lockdir.rstrip('/') + '.queue'
+
+
+def _queue_tickets(queue_dir):
+    """Return the tickets in queue_dir, in the order they were taken."""
+    try:
+        return sorted(f for f in os.listdir(queue_dir) if f.isdigit())
+    except OSError:        # probably 'dir does not exist'
+        return []
+
+
+def _remove_ticket(queue_dir, ticket):
+    for filename in (ticket, ticket + '.json'):
+        try:
+            os.unlink(os.path.join(queue_dir, filename))
+        except OSError:    # probably 'file does not exist'
+            pass
+
+
+@contextlib.contextmanager
+def take_ticket(lockdir, info):
+    """Take a place in line for lockdir; yield (ticket, notify_fd).
+
+    info is a json-able dict saying who we are; tickets_ahead_of()
+    returns it to the people behind us.  notify_fd becomes readable
+    whenever someone calls notify_waiters(); see wait_for_release().
+
+    The ticket is removed when we leave the context, including when
+    we're killed with a SIGTERM (which is how jenkins aborts a job),
+    and we wake up the people behind us so they can see they moved up.
+    This must be called from the main thread, since it handles
+    SIGTERM.
+    """
+    dirname = queue_dir(lockdir)
+    try:
+        os.makedirs(dirname)
+    except OSError, why:
+        if why.errno != errno.EEXIST:
+            raise
+
+    # mkfifo fails if the name is taken, so we get a unique ticket
+    # even if several deployers race for the same number.
+    while True:
+        tickets = _queue_tickets(dirname)
+        my_ticket = '%010d' % (int(tickets[-1]) + 1 if tickets else 1)
+        try:
+            os.mkfifo(os.path.join(dirname, my_ticket))
+            break
+        except OSError, why:
+            if why.errno != errno.EEXIST:
+                raise
+
+    def on_sigterm(signum, frame):
+        raise SystemExit('Aborted while waiting for the deploy lock')
+
+    fifo = os.path.join(dirname, my_ticket)
+    old_sigterm = signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        # We hold the write end open ourselves: otherwise, once
+        # notify_waiters() closed its end, the fifo would read as EOF
+        # (and so select() as readable) forever after.
+        read_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        write_fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            with open(fifo + '.json', 'w') as f:
+                json.dump(info, f)
+            yield (my_ticket, read_fd)
+        finally:
+            os.close(write_fd)
+            os.close(read_fd)
+    finally:
+        _remove_ticket(dirname, my_ticket)
+        signal.signal(signal.SIGTERM, old_sigterm)
+        # Everyone behind us just moved up a place.
+        notify_waiters(lockdir)
+
+
+def _ticket_is_live(queue_dir, ticket):
+    """True if some process is still waiting on ticket.
+
+    A waiter holds its fifo open for reading the whole time it waits,
+    so if nobody is reading, the waiter died without cleaning up after
+    itself (e.g. it was kill -9'ed).
+    """
+    fifo = os.path.join(queue_dir, ticket)
+    try:
+        if time.time() - os.stat(fifo).st_mtime < _TICKET_GRACE_SEC:
+            return True
+        fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError, why:
+        if why.errno in (errno.ENXIO, errno.ENOENT):
+            return False
+        raise
+    os.close(fd)
+    return True
+
+
+def tickets_ahead_of(lockdir, ticket):
+    """Return info about the live tickets ahead of ticket, in order.
+
+    Each is the info dict that was passed to take_ticket().  Tickets
+    whose waiter has died are removed as we go.
+    """
+    dirname = queue_dir(lockdir)
+    retval = []
+    for other in _queue_tickets(dirname):
+        if other >= ticket:
+            break
+        if not _ticket_is_live(dirname, other):
+            logging.info('Removing stale deploy-queue ticket %s' % other)
+            _remove_ticket(dirname, other)
+            continue
+        try:
+            with open(os.path.join(dirname, other + '.json')) as f:
+                retval.append(json.load(f))
+        except (IOError, ValueError):      # they're still writing it
+            retval.append({})
+    return retval
+
+
+def try_to_acquire(lockdir, ticket):
+    """Create lockdir, and so take the lock, if it's ticket's turn.
+
+    Returns (True, []) if we got the lock.  Otherwise, returns (False,
+    tickets_ahead_of(lockdir, ticket)): if that's empty, we're next,
+    and someone else still holds the lock.
+    """
+    ahead = tickets_ahead_of(lockdir, ticket)
+    if ahead:
+        return (False, ahead)
+    try:
+        os.mkdir(lockdir)
+    except OSError, why:
+        if why.errno != errno.EEXIST:      # file exists
+            raise
+        return (False, [])
+    logging.info("Lockdir %s acquired." % lockdir)
+    return (True, [])
+
+
+def wait_for_release(notify_fd, timeout_sec):
+    """Wait until notify_fd says the lock was released, or timeout_sec.
+
+    Returns True if we were woken up by a release, False on timeout.
+    """
+    (readable, _, _) = select.select([notify_fd], [], [],
+                                     max(timeout_sec, 0))
+    if not readable:
+        return False
+    try:
+        while os.read(notify_fd, 4096):     # drain all the wakeups
+            pass
+    except OSError, why:
+        if why.errno != errno.EAGAIN:
+            raise
+    return True
+
+
+def notify_waiters(lockdir):
+    """Wake up everyone in line for lockdir, so they re-check the lock.
+
+    Call this after releasing the lock, once you've stopped writing
+    to lockdir: whoever is next in line may take it right away.
+    """
+    dirname = queue_dir(lockdir)
+    for ticket in _queue_tickets(dirname):
+        fifo = os.path.join(dirname, ticket)
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, why:
+            # ENXIO means nobody is reading: the waiter is gone, or
+            # hasn't opened its fifo yet.  Either way, nobody to wake.
+            if why.errno not in (errno.ENXIO, errno.ENOENT):
+                logging.warning('Could not wake up %s: %s' % (fifo, why))
+            continue
+        try:
+            os.write(fd, '\n')
+        except OSError, why:
+            if why.errno != errno.EAGAIN:   # EAGAIN: they're already awake
+                logging.warning('Could not wake up %s: %s' % (fifo, why))
+        finally:
+            os.close(fd)
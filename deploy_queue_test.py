@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""Tests for deploy_queue.py"""
+
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+import deploy_queue
+
+
+def _waiter(lockdir, name, log_file, ready):
+    """Wait in line for lockdir, log that we got it, then release it."""
+    with deploy_queue.take_ticket(lockdir, {'name': name}) as (ticket,
+                                                               notify_fd):
+        ready.set()
+        while not deploy_queue.try_to_acquire(lockdir, ticket)[0]:
+            deploy_queue.wait_for_release(notify_fd, 60)
+    with open(log_file, 'a') as f:
+        f.write(name + '\n')
+    time.sleep(0.05)
+    os.rmdir(lockdir)
+    deploy_queue.notify_waiters(lockdir)
+
+
+class DeployQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lockdir = os.path.join(self.tmpdir, 'deploy.lockdir')
+        self.queue_dir = deploy_queue.queue_dir(self.lockdir)
+        self.log_file = os.path.join(self.tmpdir, 'log')
+        self.waiters = []
+        # We hold the lock to start with.
+        os.mkdir(self.lockdir)
+
+    def tearDown(self):
+        for waiter in self.waiters:
+            if waiter.is_alive():
+                waiter.terminate()
+            waiter.join()
+        shutil.rmtree(self.tmpdir)
+
+    def _start_waiter(self, name):
+        """Start a waiter, and wait until it has its ticket."""
+        ready = multiprocessing.Event()
+        waiter = multiprocessing.Process(
+            target=_waiter, args=(self.lockdir, name, self.log_file, ready))
+        waiter.start()
+        self.waiters.append(waiter)
+        self.assertTrue(ready.wait(10))
+        return waiter
+
+    def _release(self):
+        os.rmdir(self.lockdir)
+        deploy_queue.notify_waiters(self.lockdir)
+
+    def _tickets(self):
+        return sorted(f for f in os.listdir(self.queue_dir) if f.isdigit())
+
+    def _age_tickets(self):
+        """Make every ticket older than the grace period."""
+        long_ago = time.time() - 3600
+        for filename in os.listdir(self.queue_dir):
+            os.utime(os.path.join(self.queue_dir, filename),
+                     (long_ago, long_ago))
+
+    def _join_all(self):
+        for waiter in self.waiters:
+            waiter.join(10)
+            self.assertFalse(waiter.is_alive())
+
+    def _log(self):
+        with open(self.log_file) as f:
+            return f.read().split()
+
+    def test_fifo_order(self):
+        for name in ('a', 'b', 'c', 'd'):
+            self._start_waiter(name)
+        self.assertEqual(['a', 'b', 'c'],
+                         [info['name'] for info in
+                          deploy_queue.tickets_ahead_of(self.lockdir,
+                                                        self._tickets()[-1])])
+        self._release()
+        # They don't poll, so if nobody woke them, this would time out.
+        self._join_all()
+        self.assertEqual(['a', 'b', 'c', 'd'], self._log())
+        self.assertEqual([], self._tickets())
+
+    def test_dead_waiter_is_skipped(self):
+        dead = self._start_waiter('dead')
+        self._start_waiter('alive')
+        os.kill(dead.pid, signal.SIGKILL)
+        dead.join()
+        self.waiters.remove(dead)
+        # It died without cleaning up after itself.
+        self.assertEqual(2, len(self._tickets()))
+
+        # Nobody reads a dead waiter's fifo, but its ticket counts as
+        # live until the grace period is over: it may still be
+        # starting up.
+        (dead_ticket, alive_ticket) = self._tickets()
+        self.assertEqual(1, len(deploy_queue.tickets_ahead_of(
+            self.lockdir, alive_ticket)))
+        self._age_tickets()
+        self.assertEqual([], deploy_queue.tickets_ahead_of(
+            self.lockdir, alive_ticket))
+        self.assertEqual([alive_ticket, alive_ticket + '.json'],
+                         sorted(os.listdir(self.queue_dir)))
+
+        self._release()
+        self._join_all()
+        self.assertEqual(['alive'], self._log())
+
+    def test_sigterm_removes_ticket(self):
+        aborted = self._start_waiter('aborted')
+        self._start_waiter('next')
+        aborted.terminate()      # this is how jenkins aborts a job
+        aborted.join(10)
+        self.assertEqual(1, aborted.exitcode)
+        # Only 'next' is left in line.
+        self.assertEqual(['next'],
+                         [info['name'] for info in
+                          deploy_queue.tickets_ahead_of(self.lockdir,
+                                                        '9999999999')])
+        self._release()
+        self._join_all()
+        self.assertEqual(['next'], self._log())
+
+    def test_try_to_acquire(self):
+        with deploy_queue.take_ticket(self.lockdir, {}) as (ticket, _):
+            # We're first in line, but someone holds the lock.
+            self.assertEqual((False, []),
+                             deploy_queue.try_to_acquire(self.lockdir,
+                                                         ticket))
+            os.rmdir(self.lockdir)
+            self.assertEqual((True, []),
+                             deploy_queue.try_to_acquire(self.lockdir,
+                                                         ticket))
+            self.assertTrue(os.path.isdir(self.lockdir))
+        self.assertEqual([], self._tickets())
+
+    def test_wait_for_release(self):
+        with deploy_queue.take_ticket(self.lockdir, {}) as (_, notify_fd):
+            self.assertFalse(deploy_queue.wait_for_release(notify_fd, 0.01))
+            deploy_queue.notify_waiters(self.lockdir)
+            deploy_queue.notify_waiters(self.lockdir)
+            self.assertTrue(deploy_queue.wait_for_release(notify_fd, 1))
+            # We drained both wakeups.
+            self.assertFalse(deploy_queue.wait_for_release(notify_fd, 0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
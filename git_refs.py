@@ -0,0 +1,99 @@
+"""A cheap way to ask git lots of little questions about refs.
+
+Our deploy scripts ask git a lot of little questions -- what is the
+sha1 of HEAD, of master, of this branch; does this branch exist on
+origin; does this tag exist -- and used to start a new git process to
+answer each one.  GitRefs answers them with a handful of processes:
+
+* one long-lived 'git cat-file --batch-check', which resolves any
+  revision we send it, like 'git rev-parse' does;
+* one 'git for-each-ref', which lists every ref at once.
+
+Answers are memoized until invalidate() is called, which you must do
+after running anything that changes refs (fetch, checkout, reset,
+merge, tag, ...).  cat-file itself keeps running: it reads refs from
+disk for every lookup, so it sees such changes.
+"""
+
+import logging
+import subprocess
+
+
+class GitRefs(object):
+    """Answers questions about the refs in the git repo at git_root."""
+    def __init__(self, git_root):
+        self.git_root = git_root
+        self._batch_check = None
+        self._shas = {}
+        self._refs = None
+
+    def invalidate(self):
+        """Forget everything we know; call this after refs change."""
+        self._shas.clear()
+        self._refs = None
+
+    def close(self):
+        """Stop our long-lived git process, if it's running."""
+        if self._batch_check is not None:
+            self._batch_check.stdin.close()
+            self._batch_check.wait()
+            self._batch_check = None
+
+    def resolve_many(self, revs):
+        """Return the sha1s that revs name, like 'git rev-parse' would.
+
+        We send every revision we don't already know to cat-file at
+        once, so this is a single round-trip however many revs there
+        are.
+
+        Raises:
+            ValueError if some rev does not name any object.
+        """
+        unknown = [rev for rev in set(revs) if rev not in self._shas]
+        if unknown:
+            for rev in unknown:
+                if '\n' in rev:
+                    raise ValueError('Bad revision %r' % rev)
+            if self._batch_check is None:
+                logging.info('Starting git cat-file --batch-check')
+                self._batch_check = subprocess.Popen(
+                    ['git', 'cat-file', '--batch-check'],
+                    cwd=self.git_root,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._batch_check.stdin.write(''.join('%s\n' % rev
+                                                  for rev in unknown))
+            self._batch_check.stdin.flush()
+            for rev in unknown:
+                line = self._batch_check.stdout.readline()
+                if not line:
+                    raise RuntimeError('git cat-file exited unexpectedly')
+                # The line is '<sha1> <type> <size>' or '<rev> missing'.
+                fields = line.split()
+                self._shas[rev] = fields[0] if len(fields) == 3 else None
+
+        retval = [self._shas[rev] for rev in revs]
+        if None in retval:
+            raise ValueError('Unknown revision %s'
+                             % revs[retval.index(None)])
+        return retval
+
+    def resolve(self, rev):
+        """Return the sha1 that rev names; see resolve_many()."""
+        return self.resolve_many([rev])[0]
+
+    def refs(self):
+        """Return a map from every refname (e.g. refs/tags/foo) to its sha1."""
+        if self._refs is None:
+            logging.info('Running git for-each-ref')
+            output = subprocess.check_output(
+                ['git', 'for-each-ref', '--format=%(objectname) %(refname)'],
+                cwd=self.git_root)
+            self._refs = {}
+            for line in output.splitlines():
+                (sha1, refname) = line.split(' ', 1)
+                self._refs[refname] = sha1
+        return self._refs
+
+    def has_ref(self, refname):
+        """True if refname, e.g. refs/remotes/origin/master, exists."""
+        return refname in self.refs()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Counts the git processes a deploy stage starts to look up refs.
+
+deploy_pipeline.py asks git lots of little questions about refs.  It
+used to start a git process (rev-parse, ls-remote, show-ref, tag -l)
+for each; now it asks git_refs.GitRefs.  This replays the questions
+that the merge-from-master stage asks -- first the old way, then
+with GitRefs -- against a synthetic repo, and reports how many
+processes each way started, and how long it took.
+
+The git commands that change the repo (fetch, checkout, merge, ...)
+are the same either way, so we leave them out, but we do call
+GitRefs.invalidate() where the stage would run them.
+
+If you pass in --max-processes, we exit with rc 1 if the GitRefs way
+starts more processes than that.
+"""
+
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import git_refs
+import git_refs_test
+
+
+def _old_way(git_root, branch):
+    def run(cmd):
+        return subprocess.call(cmd, cwd=git_root, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE) == 0
+
+    def pipe(cmd):
+        return subprocess.check_output(cmd, cwd=git_root).rstrip()
+
+    # merge_from_master()
+    run(['git', 'ls-remote', '--exit-code', '.', 'origin/%s' % branch])
+    head_commit = pipe(['git', 'rev-parse', 'HEAD'])
+    master_commit = pipe(['git', 'rev-parse', 'master'])
+    pipe(['git', 'rev-parse', branch])
+    pipe(['git', 'merge-base', branch, master_commit])
+    pipe(['git', 'show-ref']).splitlines()
+    # main(), after merging: the new GIT_SHA1.
+    sha1 = pipe(['git', 'rev-parse', branch])
+    # _update_properties() -> _gae_version(), for the new GIT_SHA1.
+    run(['git', 'ls-remote', '--exit-code', '.', 'origin/%s' % sha1])
+    return head_commit
+
+
+def _new_way(git_root, branch):
+    refs = git_refs.GitRefs(git_root)
+    try:
+        # merge_from_master()
+        refs.has_ref('refs/remotes/origin/%s' % branch)
+        refs.invalidate()            # fetch, checkout, reset
+        (head_commit, master_commit, _) = refs.resolve_many(
+            ['HEAD', 'master', branch])
+        subprocess.check_output(['git', 'merge-base', branch, master_commit],
+                                cwd=git_root)
+        sorted(refs.refs())
+        refs.invalidate()            # merge, push
+        # main(), after merging: the new GIT_SHA1.
+        sha1 = refs.resolve(branch)
+        # _update_properties() -> _gae_version(), for the new GIT_SHA1.
+        refs.has_ref('refs/remotes/origin/%s' % sha1)
+        return head_commit
+    finally:
+        refs.close()
+
+
+def run(git_root, branch):
+    retval = {}
+    orig_popen = subprocess.Popen
+    subprocess.Popen = git_refs_test.CountingPopen
+    try:
+        for (name, fn) in (('old', _old_way), ('git_refs', _new_way)):
+            git_refs_test.CountingPopen.count = 0
+            start = time.time()
+            fn(git_root, branch)
+            retval[name] = {'wall_sec': time.time() - start,
+                            'num_processes': git_refs_test.CountingPopen.count}
+    finally:
+        subprocess.Popen = orig_popen
+    return retval
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--branches', type=int, default=200,
+                        help=('How many branches and tags to put in the '
+                              'synthetic repo (default %(default)s)'))
+    parser.add_argument('--max-processes', type=int,
+                        help=('Fail if the GitRefs way starts more git '
+                              'processes than this.'))
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='git_refs_benchmark.')
+    try:
+        git_refs_test.make_repo(tmpdir, args.branches)
+        results = run(tmpdir, 'branch0')
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print json.dumps(results, indent=2, sort_keys=True)
+    if (args.max_processes is not None and
+            results['git_refs']['num_processes'] > args.max_processes):
+        print >>sys.stderr, ('GitRefs started %s git processes, more than %s'
+                             % (results['git_refs']['num_processes'],
+                                args.max_processes))
+        sys.exit(1)
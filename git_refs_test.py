@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Tests for git_refs.py"""
+
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import git_refs
+
+
+def make_repo(git_root, num_branches=3):
+    """Make a git repo with a commit on master and some branches and tags."""
+    def git(*args):
+        subprocess.check_call(('git', '-c', 'user.name=Test',
+                               '-c', 'user.email=test@example.com') + args,
+                              cwd=git_root)
+
+    git('init', '-q')
+    git('checkout', '-q', '-b', 'master')
+    git('commit', '-q', '--allow-empty', '-m', 'first')
+    for i in xrange(num_branches):
+        git('branch', 'branch%s' % i)
+        git('update-ref', 'refs/remotes/origin/branch%s' % i, 'HEAD')
+        git('tag', '-m', 'a tag', 'gae-%s' % i)
+    git('commit', '-q', '--allow-empty', '-m', 'second')
+    return git
+
+
+class CountingPopen(subprocess.Popen):
+    """A Popen that counts how many processes it starts."""
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.count += 1
+        super(CountingPopen, self).__init__(*args, **kwargs)
+
+
+class GitRefsTest(unittest.TestCase):
+    def setUp(self):
+        self.git_root = tempfile.mkdtemp()
+        self.git = make_repo(self.git_root)
+        self.refs = git_refs.GitRefs(self.git_root)
+
+        self.orig_popen = subprocess.Popen
+        subprocess.Popen = CountingPopen
+        CountingPopen.count = 0
+
+    def tearDown(self):
+        subprocess.Popen = self.orig_popen
+        self.refs.close()
+        shutil.rmtree(self.git_root)
+
+    def _rev_parse(self, rev):
+        return self.orig_popen(['git', 'rev-parse', rev], cwd=self.git_root,
+                               stdout=subprocess.PIPE).communicate()[0].strip()
+
+    def test_resolve(self):
+        for rev in ('HEAD', 'master', 'branch0', 'HEAD^', 'gae-1',
+                    'origin/branch2'):
+            self.assertEqual(self._rev_parse(rev), self.refs.resolve(rev))
+        # That was all one process.
+        self.assertEqual(1, CountingPopen.count)
+
+    def test_resolve_many(self):
+        self.assertEqual([self._rev_parse('HEAD'), self._rev_parse('HEAD^'),
+                          self._rev_parse('HEAD')],
+                         self.refs.resolve_many(['HEAD', 'branch1', 'HEAD']))
+
+    def test_unknown_revision(self):
+        with self.assertRaises(ValueError):
+            self.refs.resolve_many(['HEAD', 'no-such-branch'])
+        # We can keep going after an unknown revision.
+        self.assertEqual(self._rev_parse('master'),
+                         self.refs.resolve('master'))
+
+    def test_refs(self):
+        self.assertTrue(self.refs.has_ref('refs/remotes/origin/branch1'))
+        self.assertTrue(self.refs.has_ref('refs/tags/gae-2'))
+        self.assertFalse(self.refs.has_ref('refs/tags/gae-2-bad'))
+        self.assertFalse(self.refs.has_ref('refs/remotes/origin/master'))
+        self.assertEqual(self._rev_parse('branch0'),
+                         self.refs.refs()['refs/heads/branch0'])
+        self.assertEqual(1, CountingPopen.count)
+
+    def test_invalidate(self):
+        old_head = self.refs.resolve('HEAD')
+        self.assertFalse(self.refs.has_ref('refs/tags/new'))
+
+        self.git('commit', '-q', '--allow-empty', '-m', 'third')
+        self.git('tag', 'new')
+        # We remember the old answers until we're told otherwise.
+        self.assertEqual(old_head, self.refs.resolve('HEAD'))
+        self.assertFalse(self.refs.has_ref('refs/tags/new'))
+
+        self.refs.invalidate()
+        self.assertEqual(self._rev_parse('HEAD'), self.refs.resolve('HEAD'))
+        self.assertNotEqual(old_head, self.refs.resolve('HEAD'))
+        self.assertTrue(self.refs.has_ref('refs/tags/new'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""A cached map from email address to hipchat @mention name.
+
+The only way to get someone's hipchat mention-name is to download the
+list of every hipchat user, which is slow, and our deploy scripts used
+to do it every time they wanted to @mention someone.  Instead, we keep
+the map in a json file on disk, and:
+
+* if the file is younger than ttl_sec, we just use it.
+* if it is older than that, but younger than max_stale_sec, we use it
+  anyway, but start a refresh in a background thread, so the next
+  caller gets an up-to-date map ("stale-while-revalidate").
+* if there is no file, or it is older than max_stale_sec, we refresh
+  it before answering.
+
+Refreshes are single-flight: only one refresh runs at a time, even
+across processes (we flock <cache_file>.lock), and everyone else
+waits for, or just uses, its result.  If a refresh fails we keep using
+whatever map we had, and don't try again for a while.
+"""
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib2
+
+
+def fetch_mention_names(auth_token, base_url='https://api.hipchat.com',
+                        urlopen=urllib2.urlopen, timeout_sec=10):
+    """Download the map from email to '@mention_name' from hipchat.
+
+    We give up after timeout_sec, so a stalled hipchat can't keep a
+    background refresh -- and so the process -- from exiting.
+    """
+    logging.info('Fetching email->hipchat mapping from hipchat')
+    r = urlopen('%s/v1/users/list?auth_token=%s'
+                % (base_url.rstrip('/'), auth_token),
+                timeout=timeout_sec)
+    user_data = json.load(r)
+    return {user['email']: '@%s' % user['mention_name']
+            for user in user_data['users']}
+
+
+class MentionNameCache(object):
+    """An on-disk cache of fetch_fn(); see the module docstring.
+
+    fetch_fn takes no arguments and returns a map from email to
+    mention-name.  It should raise on failure.  After a failure, we
+    don't try again for retry_after_failure_sec, so a hipchat outage
+    doesn't make every caller wait on a fetch that will fail too.
+    """
+    def __init__(self, cache_file, fetch_fn, ttl_sec=24 * 3600,
+                 max_stale_sec=7 * 24 * 3600, retry_after_failure_sec=300):
+        self.cache_file = cache_file
+        self.fetch_fn = fetch_fn
+        self.ttl_sec = ttl_sec
+        self.max_stale_sec = max_stale_sec
+        self.retry_after_failure_sec = retry_after_failure_sec
+        self.num_fetches = 0
+
+        # The map we're using, when it was fetched, and when we last
+        # failed to fetch it.  All protected by self._lock, which we
+        # never hold while fetching.
+        self._names = None
+        self._fetch_time = None
+        self._failure_time = None
+        self._refresh_thread = None
+        self._lock = threading.Lock()
+        # Held by whichever of our threads is refreshing.
+        self._refresh_lock = threading.Lock()
+
+    def _read_file(self):
+        """Return (names, fetch_time) from the cache file, or (None, None)."""
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+            return (data['names'], data['time'])
+        except (IOError, ValueError, KeyError):
+            return (None, None)
+
+    def _save(self, names, fetch_time):
+        (fd, tmpfile) = tempfile.mkstemp(
+            prefix=os.path.basename(self.cache_file) + '.',
+            dir=os.path.dirname(os.path.abspath(self.cache_file)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'time': fetch_time, 'names': names}, f)
+        os.rename(tmpfile, self.cache_file)
+
+    @contextlib.contextmanager
+    def _file_lock(self, blocking):
+        """Hold a lock shared by every process using our cache_file.
+
+        Yields True if we got the lock, or False if blocking is False
+        and someone else has it.
+        """
+        with open(self.cache_file + '.lock', 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+            except IOError, why:
+                if why.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _use(self, names, fetch_time):
+        """Start using names, fetched at fetch_time, if it's newer."""
+        with self._lock:
+            if self._fetch_time is None or fetch_time > self._fetch_time:
+                (self._names, self._fetch_time) = (names, fetch_time)
+
+    def _refresh(self, blocking):
+        """Fetch a new map, unless someone else just did.
+
+        If blocking is False and another thread or process is already
+        fetching, we let them do it and return right away.  Must be
+        called *without* holding self._lock: fetching is slow, and
+        callers of names() shouldn't have to wait for it.
+        """
+        if not self._refresh_lock.acquire(blocking):
+            return
+        try:
+            with self._lock:
+                if self._is_fresh():       # another thread just refreshed
+                    return
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(
+                    self.cache_file)))
+            except OSError, why:
+                if why.errno != errno.EEXIST:
+                    raise
+            with self._file_lock(blocking) as got_lock:
+                if not got_lock:
+                    return
+                # Maybe whoever had the lock before us just refreshed.
+                (names, fetch_time) = self._read_file()
+                if fetch_time is not None:
+                    self._use(names, fetch_time)
+                    if time.time() - fetch_time < self.ttl_sec:
+                        return
+                self.num_fetches += 1
+                names = self.fetch_fn()
+                fetch_time = time.time()
+                self._save(names, fetch_time)
+            self._use(names, fetch_time)
+        except Exception, why:
+            with self._lock:
+                self._failure_time = time.time()
+            # If we don't have secrets, we get back a 401.  Ah well.
+            logging.warning('Fetching email->hipchat mapping failed; will '
+                            'use what we have. (%s: %s)'
+                            % (why.__class__.__name__, why))
+        finally:
+            self._refresh_lock.release()
+
+    def _background_refresh(self):
+        self._refresh(blocking=False)
+
+    def _age(self):
+        if self._fetch_time is None:
+            return None
+        return time.time() - self._fetch_time
+
+    def _is_fresh(self):
+        age = self._age()
+        return age is not None and age < self.ttl_sec
+
+    def _failed_recently(self):
+        return (self._failure_time is not None and
+                time.time() - self._failure_time <
+                self.retry_after_failure_sec)
+
+    def names(self):
+        """Return the map from email to mention-name.
+
+        The map may be empty if we have never been able to fetch it.
+        """
+        with self._lock:
+            if self._names is None:
+                (self._names, self._fetch_time) = self._read_file()
+            age = self._age()
+            if self._failed_recently():
+                return self._names or {}
+            if age is not None and age < self.max_stale_sec:
+                if (age >= self.ttl_sec and
+                        (self._refresh_thread is None or
+                         not self._refresh_thread.is_alive())):
+                    # We leave this non-daemon so the fresh map gets
+                    # saved even if our process is about to exit.
+                    self._refresh_thread = threading.Thread(
+                        target=self._background_refresh,
+                        name='hipchat-names-refresh')
+                    self._refresh_thread.start()
+                return self._names or {}
+
+        # We have no map, or it's too stale to use: we have to wait.
+        self._refresh(blocking=True)
+        with self._lock:
+            return self._names or {}
+
+    def mention_name(self, email):
+        """Return email's hipchat '@mention' name, or None if not known."""
+        return self.names().get(email)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""Tests for hipchat_names.py"""
+
+import BaseHTTPServer
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+import hipchat_names
+
+
+class FakeHipchatServer(BaseHTTPServer.HTTPServer):
+    """Serves /v1/users/list, with the users in self.users.
+
+    The first self.num_failures requests get a 500 instead.  Each
+    request takes self.stall_sec to answer.
+    """
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           _FakeHipchatHandler)
+        self.users = []
+        self.num_requests = 0
+        self.num_failures = 0
+        self.stall_sec = 0
+
+    @property
+    def url(self):
+        return 'http://localhost:%s' % self.server_port
+
+
+class _FakeHipchatHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.num_requests += 1
+        time.sleep(self.server.stall_sec)
+        if self.server.num_failures > 0:
+            self.server.num_failures -= 1
+            self.send_error(500)
+            return
+        url = urlparse.urlparse(self.path)
+        assert url.path == '/v1/users/list', url.path
+        assert urlparse.parse_qs(url.query) == {'auth_token': ['sekret']}
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({'users': self.server.users}))
+
+    def log_message(self, *args):
+        pass
+
+
+class MentionNameCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHipchatServer()
+        self.server.users = [{'email': 'joe@khanacademy.org',
+                              'mention_name': 'Joe'}]
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'tmp', 'names.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def _cache(self, **kwargs):
+        return hipchat_names.MentionNameCache(
+            self.cache_file,
+            lambda: hipchat_names.fetch_mention_names('sekret',
+                                                      self.server.url),
+            **kwargs)
+
+    def _age_cache_file(self, age_sec):
+        with open(self.cache_file) as f:
+            data = json.load(f)
+        data['time'] -= age_sec
+        with open(self.cache_file, 'w') as f:
+            json.dump(data, f)
+
+    def test_fetch(self):
+        cache = self._cache()
+        self.assertEqual('@Joe', cache.mention_name('joe@khanacademy.org'))
+        self.assertEqual(None, cache.mention_name('jane@khanacademy.org'))
+        self.assertEqual(1, self.server.num_requests)
+
+    def test_persistent(self):
+        self._cache().names()
+        self.assertEqual('@Joe',
+                         self._cache().mention_name('joe@khanacademy.org'))
+        self.assertEqual(1, self.server.num_requests)
+
+    def test_stale_while_revalidate(self):
+        self._cache().names()
+        self._age_cache_file(100)
+        self.server.users[0]['mention_name'] = 'JoeNew'
+
+        cache = self._cache(ttl_sec=10)
+        # We get the old value right away, and refresh in the background.
+        self.assertEqual('@Joe', cache.mention_name('joe@khanacademy.org'))
+        cache._refresh_thread.join()
+        self.assertEqual(2, self.server.num_requests)
+        self.assertEqual('@JoeNew',
+                         cache.mention_name('joe@khanacademy.org'))
+        self.assertEqual('@JoeNew',
+                         self._cache().mention_name('joe@khanacademy.org'))
+
+    def test_too_stale(self):
+        self._cache().names()
+        self._age_cache_file(100)
+        self.server.users[0]['mention_name'] = 'JoeNew'
+        cache = self._cache(ttl_sec=10, max_stale_sec=50)
+        self.assertEqual('@JoeNew',
+                         cache.mention_name('joe@khanacademy.org'))
+        self.assertEqual(2, self.server.num_requests)
+
+    def test_fetch_failure(self):
+        self.server.num_failures = 1
+        self.assertEqual({}, self._cache().names())
+
+        self._cache().names()
+        self._age_cache_file(100)
+        self.server.num_failures = 1
+        cache = self._cache(ttl_sec=10, max_stale_sec=50)
+        # We keep using the old map if we can't get a new one.
+        self.assertEqual('@Joe', cache.mention_name('joe@khanacademy.org'))
+
+    def test_fetch_timeout(self):
+        self.server.stall_sec = 1
+        start_time = time.time()
+        with self.assertRaises(Exception):
+            hipchat_names.fetch_mention_names('sekret', self.server.url,
+                                              timeout_sec=0.1)
+        self.assertLess(time.time() - start_time, 1)
+
+    def test_failure_backoff(self):
+        self.server.num_failures = 1
+        cache = self._cache()
+        self.assertEqual({}, cache.names())
+        # We don't try again right away, even though we have no map.
+        self.assertEqual({}, cache.names())
+        self.assertEqual(1, self.server.num_requests)
+
+        cache.retry_after_failure_sec = 0
+        self.assertEqual('@Joe', cache.mention_name('joe@khanacademy.org'))
+        self.assertEqual(2, self.server.num_requests)
+
+    def test_refresh_does_not_block_readers(self):
+        self._cache().names()
+        self._age_cache_file(100)
+        fetch_started = threading.Event()
+        finish_fetch = threading.Event()
+
+        def slow_fetch():
+            fetch_started.set()
+            finish_fetch.wait(10)
+            return {'joe@khanacademy.org': '@JoeNew'}
+
+        cache = hipchat_names.MentionNameCache(self.cache_file, slow_fetch,
+                                               ttl_sec=10)
+        self.assertEqual('@Joe', cache.mention_name('joe@khanacademy.org'))
+        self.assertTrue(fetch_started.wait(10))
+        # The refresh is still going, but we don't wait for it.
+        start = time.time()
+        self.assertEqual('@Joe', cache.mention_name('joe@khanacademy.org'))
+        self.assertLess(time.time() - start, 1)
+        finish_fetch.set()
+        cache._refresh_thread.join()
+        self.assertEqual('@JoeNew',
+                         cache.mention_name('joe@khanacademy.org'))
+
+    def test_single_flight(self):
+        fetches = []
+
+        def slow_fetch():
+            fetches.append(1)
+            time.sleep(0.2)
+            return {'joe@khanacademy.org': '@Joe'}
+
+        caches = [hipchat_names.MentionNameCache(self.cache_file, slow_fetch)
+                  for _ in xrange(5)]
+        threads = [threading.Thread(target=c.names) for c in caches]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(fetches))
+        for c in caches:
+            self.assertEqual('@Joe', c.mention_name('joe@khanacademy.org'))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.ERROR)
+    unittest.main()
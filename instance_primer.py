@@ -0,0 +1,281 @@
+"""Prime a new version's instances by sending it warmup requests.
+
+Before we make a version the default, we send it requests so that
+appengine starts up ("primes") instances for it; otherwise the first
+users after set-default would wait on cold instances.  Each request
+that arrives while every instance is busy makes appengine start
+another one, so to prime N instances we keep N requests in flight.
+
+How many instances to prime depends on how much traffic the site is
+getting: instances_for_traffic() estimates it.  Priming too few hurts
+users after the switch-over; priming too many wastes deploy time.
+
+Primer sends the requests from a fixed pool of worker threads, each
+with its own keep-alive connection, with at most num_instances
+requests in flight.  It stops when either:
+
+* every instance has had max_requests_per_instance requests, or
+* latency has stabilized: each instance has had a request, and the
+  median latency of the last few windows of requests hardly changed.
+  Once instances are warm, new requests stop paying for cold starts,
+  so latency drops and then holds steady.
+
+It also stops, without waiting for the requests in flight, if its
+stop_event is set: say, because some deploy step running alongside
+priming failed, so there's no point priming any more.
+
+It calls progress_fn every progress_interval_sec with a stats dict
+(see Primer.stats()), so the caller can report progress.
+"""
+
+import httplib
+import logging
+import math
+import threading
+import time
+import urlparse
+
+
+def instances_for_traffic(requests_per_sec, sec_per_request=0.3,
+                          requests_per_instance=8, headroom=1.5,
+                          min_instances=10, max_instances=200):
+    """Estimate how many instances it takes to serve requests_per_sec.
+
+    By Little's law, requests_per_sec * sec_per_request requests are
+    in flight at a time; each instance serves requests_per_instance of
+    them at once.  We add some headroom for spikes, and clamp the
+    result to [min_instances, max_instances].
+    """
+    in_flight = requests_per_sec * sec_per_request
+    num_instances = int(math.ceil(in_flight * headroom /
+                                  requests_per_instance))
+    return max(min_instances, min(max_instances, num_instances))
+
+
+def requests_per_sec_from_monitoring_data(monitoring_data):
+    """Return the request rate in deploy/set_default.py's monitoring data.
+
+    monitoring_data is what get_predeploy_monitoring_data() returned.
+    If it doesn't say how much traffic there is -- say, an older
+    set_default.py that doesn't report the request rate -- we log a
+    warning, so it's clear why we're priming the default number of
+    instances, and return None.
+    """
+    try:
+        return float(monitoring_data['requests_per_sec'])
+    except (TypeError, KeyError, IndexError, ValueError), why:
+        logging.warning("Can't find the request rate in the pre-deploy "
+                        "monitoring data (%s: %s); it's %s"
+                        % (why.__class__.__name__, why,
+                           _describe_shape(monitoring_data)))
+        return None
+
+
+def _describe_shape(value):
+    """Describe value's type (and keys, for a dict) without its data."""
+    if isinstance(value, dict):
+        return 'a dict with keys %s' % sorted(value)
+    return 'a %s' % type(value).__name__
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+class Primer(object):
+    """Sends warmup requests to url; see the module docstring.
+
+    Arguments:
+        url: the url to send GET requests to, e.g.
+           https://<version>-dot-khan-academy.appspot.com/
+        num_instances: how many instances to prime.  You can change
+           this while we're running with set_num_instances(), e.g. once
+           you know how much traffic there is.
+        max_concurrency: the most requests we ever have in flight
+           (and so the number of worker threads), whatever
+           num_instances is.
+        max_requests_per_instance: we stop after sending this many
+           requests per instance, even if latency never stabilizes.
+        window_size, stable_windows, tolerance: latency has stabilized
+           when the medians of the last stable_windows windows of
+           window_size requests are within tolerance (a fraction) of
+           each other.
+        timeout_sec: the timeout for each request.
+        progress_fn: called with self.stats() every
+           progress_interval_sec, and when we're done.
+        stop_event: if not None, a threading.Event; once it's set, we
+           stop (with stopped_because 'cancelled') within a second.
+           See task_runner.TaskRunner.stop_event.
+    """
+    def __init__(self, url, num_instances, max_concurrency=100,
+                 max_requests_per_instance=5, window_size=10,
+                 stable_windows=3, tolerance=0.2, timeout_sec=60,
+                 progress_fn=None, progress_interval_sec=10,
+                 stop_event=None):
+        parsed_url = urlparse.urlparse(url)
+        self._connection_class = (httplib.HTTPSConnection
+                                  if parsed_url.scheme == 'https'
+                                  else httplib.HTTPConnection)
+        self._host = parsed_url.netloc
+        self._path = parsed_url.path or '/'
+        if parsed_url.query:
+            self._path += '?' + parsed_url.query
+
+        self.max_concurrency = max_concurrency
+        self.max_requests_per_instance = max_requests_per_instance
+        self.window_size = window_size
+        self.stable_windows = stable_windows
+        self.tolerance = tolerance
+        self.timeout_sec = timeout_sec
+        self.progress_fn = progress_fn
+        self.progress_interval_sec = progress_interval_sec
+        self.stop_event = stop_event
+
+        # All of the below is protected by self._cond.
+        self._cond = threading.Condition()
+        self._num_instances = num_instances
+        self._num_sent = 0
+        self._num_in_flight = 0
+        self._num_errors = 0
+        self._latencies = []      # of successful requests, in finish order
+        self._stopped_because = None
+        self._start_time = None
+
+    def set_num_instances(self, num_instances):
+        """Change how many instances to prime, even while we're running."""
+        with self._cond:
+            self._num_instances = num_instances
+            self._cond.notify_all()
+
+    def _is_stable(self):
+        """True if latency has stabilized; see the class docstring."""
+        if len(self._latencies) < self._num_instances:
+            return False
+        num_windows = len(self._latencies) // self.window_size
+        if num_windows < self.stable_windows:
+            return False
+        medians = [_median(self._latencies[i * self.window_size:
+                                           (i + 1) * self.window_size])
+                   for i in xrange(num_windows - self.stable_windows,
+                                   num_windows)]
+        return max(medians) <= min(medians) * (1 + self.tolerance)
+
+    def _check_done(self):
+        """Set self._stopped_because if it's time to stop."""
+        if self._stopped_because is None:
+            num_finished = len(self._latencies) + self._num_errors
+            if self.stop_event is not None and self.stop_event.is_set():
+                self._stopped_because = 'cancelled'
+            elif self._is_stable():
+                self._stopped_because = 'stable'
+            elif num_finished >= (self._num_instances *
+                                  self.max_requests_per_instance):
+                self._stopped_because = 'max-requests'
+        if self._stopped_because is not None:
+            self._cond.notify_all()
+
+    def _send_one(self, connection):
+        """Send a request on connection; return its latency in seconds.
+
+        Raises an exception if the request fails.
+        """
+        start = time.time()
+        connection.request('GET', self._path,
+                           headers={'User-Agent': 'deploy-pipeline-primer'})
+        response = connection.getresponse()
+        response.read()
+        if response.status >= 500:
+            raise httplib.HTTPException('HTTP status %s' % response.status)
+        return time.time() - start
+
+    def _worker(self):
+        connection = None
+        while True:
+            with self._cond:
+                while (self._stopped_because is None and
+                       (self._num_in_flight >= min(self._num_instances,
+                                                   self.max_concurrency) or
+                        self._num_sent >= (self._num_instances *
+                                           self.max_requests_per_instance))):
+                    self._cond.wait(1)
+                if self._stopped_because is not None:
+                    break
+                self._num_sent += 1
+                self._num_in_flight += 1
+
+            try:
+                if connection is None:
+                    connection = self._connection_class(
+                        self._host, timeout=self.timeout_sec)
+                latency = self._send_one(connection)
+            except Exception, why:
+                logging.debug('Priming request failed: %s' % why)
+                latency = None
+                # Start over with a new connection.
+                if connection is not None:
+                    connection.close()
+                    connection = None
+
+            with self._cond:
+                self._num_in_flight -= 1
+                if latency is None:
+                    self._num_errors += 1
+                else:
+                    self._latencies.append(latency)
+                self._check_done()
+                self._cond.notify_all()
+
+        if connection is not None:
+            connection.close()
+
+    def stats(self):
+        """Return a dict describing how priming is going."""
+        with self._cond:
+            recent = self._latencies[-self.window_size:]
+            return {
+                'num_instances': self._num_instances,
+                'num_requests': len(self._latencies) + self._num_errors,
+                'num_errors': self._num_errors,
+                'recent_median_sec': _median(recent) if recent else None,
+                'elapsed_sec': (time.time() - self._start_time
+                                if self._start_time else 0),
+                'stopped_because': self._stopped_because,
+            }
+
+    def run(self):
+        """Send warmup requests until it's time to stop; return stats()."""
+        self._start_time = time.time()
+        threads = [threading.Thread(target=self._worker,
+                                    name='primer-%s' % i)
+                   for i in xrange(self.max_concurrency)]
+        for thread in threads:
+            # We don't want a hung request to keep the process alive.
+            thread.daemon = True
+            thread.start()
+
+        next_progress_time = time.time() + self.progress_interval_sec
+        while True:
+            with self._cond:
+                # set_num_instances() or stop_event may have made us
+                # done.
+                self._check_done()
+                if self._stopped_because is not None:
+                    break
+                # We wait with a timeout because, in python2, an
+                # untimed wait can't be interrupted by a signal.
+                self._cond.wait(min(1, self.progress_interval_sec))
+            if self.progress_fn and time.time() >= next_progress_time:
+                next_progress_time += self.progress_interval_sec
+                self.progress_fn(self.stats())
+
+        if self._stopped_because != 'cancelled':
+            for thread in threads:
+                thread.join()
+        # else we don't wait for the requests in flight: they may take
+        # up to timeout_sec, and whoever cancelled us wants us gone.
+
+        stats = self.stats()
+        if self.progress_fn:
+            self.progress_fn(stats)
+        return stats
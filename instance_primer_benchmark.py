@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Compares fixed-size priming with instance_primer's adaptive priming.
+
+deploy_pipeline.py used to prime 100 instances, with 5 requests
+each, whatever the traffic.  Now it sizes priming from the traffic,
+and stops once latency stabilizes.  This runs both against a fake
+appengine (see instance_primer_test.FakeAppengineServer) and reports,
+for each, how long priming took, how many requests it sent, and how
+many instances ended up primed.
+"""
+
+import argparse
+import json
+
+import instance_primer
+import instance_primer_test
+
+
+def run(requests_per_sec, cold_sec, warm_sec):
+    retval = {}
+    adaptive_num_instances = instance_primer.instances_for_traffic(
+        requests_per_sec)
+    for (name, num_instances, stable_windows) in (
+            # With stable_windows so big, latency never "stabilizes".
+            ('fixed', 100, 1000000),
+            ('adaptive', adaptive_num_instances, 3)):
+        server = instance_primer_test.FakeAppengineServer(cold_sec, warm_sec)
+        try:
+            stats = instance_primer.Primer(
+                server.url, num_instances,
+                stable_windows=stable_windows).run()
+        finally:
+            server.close()
+        retval[name] = {'wall_sec': stats['elapsed_sec'],
+                        'num_requests': stats['num_requests'],
+                        'num_instances_primed': server.num_instances}
+    return retval
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests-per-sec', type=float, default=300,
+                        help=('How much traffic the site is getting '
+                              '(default %(default)s)'))
+    parser.add_argument('--cold-sec', type=float, default=2,
+                        help=('How long a request that starts a new '
+                              'instance takes (default %(default)s)'))
+    parser.add_argument('--warm-sec', type=float, default=0.1,
+                        help=('How long a request to a warm instance '
+                              'takes (default %(default)s)'))
+    args = parser.parse_args()
+
+    print json.dumps(run(args.requests_per_sec, args.cold_sec,
+                         args.warm_sec),
+                     indent=2, sort_keys=True)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""Tests for instance_primer.py"""
+
+import BaseHTTPServer
+import SocketServer
+import logging
+import threading
+import time
+import unittest
+
+import instance_primer
+import task_runner
+
+
+class FakeAppengineServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """Serves requests the way appengine instances do, roughly.
+
+    A request that arrives while an instance is idle takes warm_sec.
+    If every instance is busy, we "start a new instance", so the
+    request takes cold_sec, and then there's one more instance.
+
+    After each request, warm_sec goes up by slowdown_sec.  A request
+    whose number is in self.failures gets a 500.  self.paths is the
+    paths we were asked for, in order.
+    """
+    daemon_threads = True
+    request_queue_size = 128     # the listen() backlog; the default is 5
+
+    def __init__(self, cold_sec=0.2, warm_sec=0.01):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           _FakeAppengineHandler)
+        self.cold_sec = cold_sec
+        self.warm_sec = warm_sec
+        self.slowdown_sec = 0
+        self.failures = set()
+        self.lock = threading.Lock()
+        self.num_instances = 0
+        self.num_idle = 0
+        self.num_requests = 0
+        self.paths = []
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://localhost:%s/' % self.server_port
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeAppengineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # so we support keep-alive
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.num_requests += 1
+            request_num = server.num_requests
+            server.paths.append(self.path)
+            server.num_in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.num_in_flight)
+            if server.num_idle:
+                server.num_idle -= 1
+                sec = server.warm_sec
+            else:
+                server.num_instances += 1
+                sec = server.cold_sec
+        time.sleep(sec)
+        with server.lock:
+            server.num_idle += 1
+            server.num_in_flight -= 1
+            server.warm_sec += server.slowdown_sec
+
+        status = 500 if request_num in server.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class InstancesForTrafficTest(unittest.TestCase):
+    def test_littles_law(self):
+        # 1000 qps * 0.4 sec = 400 in flight, * 1.5 / 8 = 75 instances.
+        self.assertEqual(75, instance_primer.instances_for_traffic(
+            1000, sec_per_request=0.4))
+
+    def test_clamped(self):
+        self.assertEqual(10, instance_primer.instances_for_traffic(1))
+        self.assertEqual(200, instance_primer.instances_for_traffic(1e6))
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class RequestsPerSecTest(unittest.TestCase):
+    def setUp(self):
+        self.handler = _ListHandler()
+        logging.getLogger().addHandler(self.handler)
+        self.warnings = self.handler.messages
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+
+    def test_rate(self):
+        self.assertEqual(250.0,
+                         instance_primer.requests_per_sec_from_monitoring_data(
+                             {'requests_per_sec': '250', 'errors': []}))
+        self.assertEqual([], self.warnings)
+
+    def test_no_rate(self):
+        # E.g. monitoring data with error counts, but no request rate.
+        for data in ({'errors': {}, 'log_counts': {}},
+                     ({'errors': {}}, {}),
+                     {'requests_per_sec': None},
+                     None):
+            self.assertEqual(
+                None,
+                instance_primer.requests_per_sec_from_monitoring_data(data))
+        self.assertEqual(4, len(self.warnings))
+        self.assertIn("a dict with keys ['errors', 'log_counts']",
+                      self.warnings[0])
+        self.assertIn('a tuple', self.warnings[1])
+
+
+class PrimerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAppengineServer()
+        self.progress = []
+
+    def tearDown(self):
+        self.server.close()
+
+    def _primer(self, num_instances, **kwargs):
+        kwargs.setdefault('progress_interval_sec', 0.1)
+        return instance_primer.Primer(self.server.url, num_instances,
+                                      progress_fn=self.progress.append,
+                                      **kwargs)
+
+    def test_primes_num_instances(self):
+        stats = self._primer(20).run()
+        self.assertEqual('stable', stats['stopped_because'])
+        self.assertEqual(20, self.server.num_instances)
+        self.assertEqual(stats['num_requests'], self.server.num_requests)
+        self.assertEqual(0, stats['num_errors'])
+
+    def test_stops_early_once_latency_is_stable(self):
+        stats = self._primer(20, max_requests_per_instance=20).run()
+        self.assertEqual('stable', stats['stopped_because'])
+        # 20 cold requests, then 3 windows of 10 warm ones, give or
+        # take the requests in flight when we decided to stop.
+        self.assertLess(stats['num_requests'], 20 + 30 + 20)
+        self.assertLess(stats['recent_median_sec'], self.server.cold_sec)
+
+    def test_max_requests(self):
+        # Latency keeps getting worse, so it never stabilizes.
+        self.server.slowdown_sec = 0.005
+        stats = self._primer(5, max_requests_per_instance=8,
+                             window_size=5).run()
+        self.assertEqual('max-requests', stats['stopped_because'])
+        self.assertEqual(40, self.server.num_requests)
+
+    def test_max_concurrency(self):
+        self._primer(50, max_concurrency=5).run()
+        self.assertEqual(5, self.server.max_in_flight)
+        self.assertEqual(5, self.server.num_instances)
+
+    def test_set_num_instances(self):
+        primer = self._primer(5)
+        threading.Timer(0.05, primer.set_num_instances, [30]).start()
+        stats = primer.run()
+        self.assertEqual(30, stats['num_instances'])
+        self.assertEqual(30, self.server.num_instances)
+
+    def test_errors(self):
+        self.server.failures = set(xrange(1, 6))
+        stats = self._primer(10).run()
+        self.assertEqual(5, stats['num_errors'])
+        self.assertEqual('stable', stats['stopped_because'])
+
+    def test_failing_sibling_task_stops_priming(self):
+        # Each cold request takes 5 seconds, so priming would take a
+        # while if we let it.
+        self.server.cold_sec = 5
+        runner = task_runner.TaskRunner()
+        primer = self._primer(20, stop_event=runner.stop_event)
+
+        def fail():
+            time.sleep(0.1)
+            raise KeyError('oops')
+        runner.add('prime', primer.run)
+        runner.add('fail', fail)
+        start = time.time()
+        with self.assertRaises(KeyError):
+            runner.run()
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual('cancelled',
+                         runner.results['prime']['stopped_because'])
+
+    def test_progress(self):
+        self.server.cold_sec = 0.5
+        stats = self._primer(10).run()
+        self.assertGreater(len(self.progress), 2)
+        self.assertEqual(None, self.progress[0]['stopped_because'])
+        self.assertEqual(stats, self.progress[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+"""Decide, as early as the evidence allows, if a new version is worse.
+
+After set-default, we monitor the new version's logs for a fixed
+time (10 minutes, by default), and only decide at the end.  A
+StreamingMonitor, which can run alongside that, decides as soon as it
+can: every interval it sends probe requests to the new version and,
+at the same time, to the version it replaced -- cycling through a
+few pages, so one fast page can't vouch for the rest -- and feeds the
+results to two sequential tests:
+
+* errors: of the pairs of probes where the new version failed and the
+  old one didn't, does the new version fail more than it should?
+  (Failures that both versions see, like network blips, don't count.)
+* latency: of the pairs where both succeeded, is the new version the
+  slower one more often than chance would have it?  (A sign test.)
+
+Each is a Wald sequential probability ratio test (SequentialTest),
+which we can check after every interval without inflating the
+chances of a false alarm: it decides 'regression' as soon as the
+evidence against the new version is significant, and 'healthy' as
+soon as there is enough evidence that it's fine.  The monitor stops
+when either test finds a regression, or both find the new version
+healthy, or max_sec runs out or its stop_event is set
+('inconclusive').
+
+The old version stops getting traffic at set-default, so its
+instances go idle, and a probe that has to wait for a cold instance
+makes the old version look slow -- and the new version look good.
+So we send a few warmup probes, whose results we ignore, first; after
+that, our probes keep an instance of each version warm.
+"""
+
+import httplib
+import itertools
+import logging
+import math
+import time
+import urlparse
+
+
+class SequentialTest(object):
+    """Wald's SPRT: is the rate of some event p0 (healthy) or p1?
+
+    Call add() with each batch of trials; decision is None until the
+    test decides, and then 'healthy' (the rate is p0) or 'regression'
+    (it's p1).  alpha is the chance of deciding 'regression' when the
+    rate is really p0, and beta of deciding 'healthy' when it's p1.
+    Once the test decides, it ignores further trials.
+    """
+    def __init__(self, p0, p1, alpha=0.05, beta=0.05):
+        assert 0 < p0 < p1 < 1, (p0, p1)
+        self.p0 = p0
+        self.p1 = p1
+        self._hit_llr = math.log(p1 / p0)
+        self._miss_llr = math.log((1 - p1) / (1 - p0))
+        self._upper = math.log((1 - beta) / alpha)
+        self._lower = math.log(beta / (1 - alpha))
+        self.llr = 0.0          # the log likelihood ratio so far
+        self.num_trials = 0
+        self.num_hits = 0
+        self.decision = None
+
+    def add(self, num_trials, num_hits):
+        if self.decision is not None:
+            return
+        self.num_trials += num_trials
+        self.num_hits += num_hits
+        self.llr += (num_hits * self._hit_llr +
+                     (num_trials - num_hits) * self._miss_llr)
+        if self.llr >= self._upper:
+            self.decision = 'regression'
+        elif self.llr <= self._lower:
+            self.decision = 'healthy'
+
+
+def _time_request(url, timeout_sec):
+    """Return how long a GET of url took, or None if it failed."""
+    parsed_url = urlparse.urlparse(url)
+    connection_class = (httplib.HTTPSConnection
+                        if parsed_url.scheme == 'https'
+                        else httplib.HTTPConnection)
+    path = parsed_url.path or '/'
+    if parsed_url.query:
+        path += '?' + parsed_url.query
+    start = time.time()
+    connection = connection_class(parsed_url.netloc, timeout=timeout_sec)
+    try:
+        connection.request('GET', path,
+                           headers={'User-Agent': 'deploy-pipeline-monitor'})
+        response = connection.getresponse()
+        response.read()
+        if response.status >= 500:
+            return None
+        return time.time() - start
+    except Exception, why:
+        logging.debug('Probe of %s failed: %s' % (url, why))
+        return None
+    finally:
+        connection.close()
+
+
+def http_probe_fn(new_url, old_url, paths=('/',), timeout_sec=30):
+    """Return a probe_fn, for StreamingMonitor, that GETs the two urls.
+
+    Each probe fetches the next of paths, in turn, from both versions;
+    paths are relative to new_url and old_url.  We alternate which
+    version we fetch first, so neither is always the one that sees
+    the other's effects.
+    """
+    state = {'new_first': True, 'paths': itertools.cycle(paths)}
+
+    def probe():
+        path = next(state['paths']).lstrip('/')
+        new_path_url = urlparse.urljoin(new_url, path)
+        old_path_url = urlparse.urljoin(old_url, path)
+        state['new_first'] = not state['new_first']
+        if state['new_first']:
+            new = _time_request(new_path_url, timeout_sec)
+            old = _time_request(old_path_url, timeout_sec)
+        else:
+            old = _time_request(old_path_url, timeout_sec)
+            new = _time_request(new_path_url, timeout_sec)
+        return (new, old)
+    return probe
+
+
+class StreamingMonitor(object):
+    """Monitors a new version against an old one; see module docstring.
+
+    Arguments:
+        probe_fn: sends a probe to each version, and returns
+           (new_latency, old_latency), each in seconds, or None if
+           that probe failed.  See http_probe_fn().
+        interval_sec: we send probes_per_interval pairs of probes,
+           evenly spaced, each interval, and then update the tests.
+        max_sec: give up, with 'inconclusive', after this long.
+        error_test, latency_test: SequentialTests; see the module
+           docstring.  By default, it's a regression if the new
+           version fails 5% of probes that the old version doesn't (1%
+           is healthy), or is the slower one in 70% of pairs (50%).
+        progress_fn: called with stats() after each interval.
+        warmup_probes: how many pairs of probes to send, and ignore,
+           before we start counting; see the module docstring.
+        stop_event: if not None, a threading.Event; once it's set, we
+           stop, with whatever decision we've come to so far, within
+           a probe or so.
+    """
+    def __init__(self, probe_fn, interval_sec=30, max_sec=600,
+                 probes_per_interval=20, error_test=None, latency_test=None,
+                 progress_fn=None, warmup_probes=5, stop_event=None):
+        self.probe_fn = probe_fn
+        self.interval_sec = interval_sec
+        self.max_sec = max_sec
+        self.probes_per_interval = probes_per_interval
+        self.error_test = error_test or SequentialTest(0.01, 0.05)
+        self.latency_test = latency_test or SequentialTest(0.5, 0.7)
+        self.progress_fn = progress_fn
+        self.warmup_probes = warmup_probes
+        self.stop_event = stop_event
+        self.num_intervals = 0
+        self.num_probes = 0
+
+    def _stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def _sleep(self, sec):
+        """Sleep for sec, or until stop_event is set."""
+        sec = max(0, sec)
+        if self.stop_event is not None:
+            self.stop_event.wait(sec)
+        else:
+            time.sleep(sec)
+
+    def _probe_interval(self):
+        """Probe for an interval, and count what happened.
+
+        Returns (the number of pairs where the old version's probe
+        succeeded, how many of those the new version's probe failed,
+        how many it succeeded, how many of *those* it was slower).
+        """
+        num_pairs = num_new_only_errors = num_both_ok = num_slower = 0
+        start = time.time()
+        for i in xrange(self.probes_per_interval):
+            # Space the probes out evenly over the interval.
+            self._sleep(start + i * self.interval_sec /
+                        float(self.probes_per_interval) - time.time())
+            if self._stopped():
+                break
+            (new, old) = self.probe_fn()
+            self.num_probes += 1
+            if old is not None:
+                num_pairs += 1
+                if new is None:
+                    num_new_only_errors += 1
+                else:
+                    num_both_ok += 1
+                    if new > old:
+                        num_slower += 1
+        self._sleep(start + self.interval_sec - time.time())
+        return (num_pairs, num_new_only_errors, num_both_ok, num_slower)
+
+    def decision(self):
+        """'regression', 'healthy', or None if we can't tell yet."""
+        decisions = (self.error_test.decision, self.latency_test.decision)
+        if 'regression' in decisions:
+            return 'regression'
+        if decisions == ('healthy', 'healthy'):
+            return 'healthy'
+        return None
+
+    def reason(self):
+        """A human-readable explanation of the decision so far."""
+        return ('the new version failed %s of %s probes that the old '
+                'version passed, and was slower in %s of %s pairs'
+                % (self.error_test.num_hits, self.error_test.num_trials,
+                   self.latency_test.num_hits,
+                   self.latency_test.num_trials))
+
+    def stats(self):
+        return {'elapsed_sec': self.num_intervals * self.interval_sec,
+                'num_probes': self.num_probes,
+                'error_decision': self.error_test.decision,
+                'latency_decision': self.latency_test.decision,
+                'decision': self.decision(),
+                'reason': self.reason(),
+                }
+
+    def run(self):
+        """Probe until we can decide; return the decision.
+
+        That's 'regression', 'healthy', or 'inconclusive' if max_sec
+        ran out, or stop_event was set, first.
+        """
+        for _ in xrange(self.warmup_probes):
+            if self._stopped():
+                break
+            self.probe_fn()
+        max_intervals = max(1, int(self.max_sec / self.interval_sec))
+        while self.num_intervals < max_intervals and not self._stopped():
+            (num_pairs, num_new_only_errors, num_both_ok, num_slower) = (
+                self._probe_interval())
+            self.num_intervals += 1
+            self.error_test.add(num_pairs, num_new_only_errors)
+            self.latency_test.add(num_both_ok, num_slower)
+            if self.progress_fn:
+                self.progress_fn(self.stats())
+            if self.decision() is not None:
+                return self.decision()
+        return 'inconclusive'
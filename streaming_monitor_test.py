@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""Tests for streaming_monitor.py"""
+
+import itertools
+import random
+import threading
+import time
+import unittest
+
+import instance_primer_test
+import streaming_monitor
+
+
+class SequentialTestTest(unittest.TestCase):
+    def test_regression(self):
+        test = streaming_monitor.SequentialTest(0.01, 0.05)
+        test.add(20, 0)
+        self.assertEqual(None, test.decision)
+        # Three failures out of 25 is a lot more likely at 5% than 1%.
+        test.add(5, 3)
+        self.assertEqual('regression', test.decision)
+
+    def test_healthy(self):
+        test = streaming_monitor.SequentialTest(0.01, 0.05)
+        test.add(60, 0)
+        self.assertEqual(None, test.decision)
+        test.add(20, 0)
+        self.assertEqual('healthy', test.decision)
+
+    def test_decision_is_final(self):
+        test = streaming_monitor.SequentialTest(0.5, 0.7)
+        test.add(10, 10)
+        self.assertEqual('regression', test.decision)
+        test.add(1000, 0)
+        self.assertEqual('regression', test.decision)
+        self.assertEqual(10, test.num_trials)
+
+    def test_false_alarm_rate(self):
+        # With alpha=0.05, a test of a healthy rate should rarely call
+        # it a regression.
+        rng = random.Random(1)
+        num_regressions = 0
+        for _ in xrange(200):
+            test = streaming_monitor.SequentialTest(0.5, 0.7)
+            while test.decision is None:
+                test.add(1, int(rng.random() < 0.5))
+            num_regressions += test.decision == 'regression'
+        self.assertLess(num_regressions, 20)
+
+
+class StreamingMonitorTest(unittest.TestCase):
+    def _monitor(self, probe_fn, **kwargs):
+        self.progress = []
+        kwargs.setdefault('interval_sec', 0.001)
+        kwargs.setdefault('max_sec', 1)
+        kwargs.setdefault('warmup_probes', 0)
+        return streaming_monitor.StreamingMonitor(
+            probe_fn, progress_fn=self.progress.append, **kwargs)
+
+    def test_healthy(self):
+        rng = random.Random(2)
+        monitor = self._monitor(lambda: (rng.random(), rng.random()))
+        self.assertEqual('healthy', monitor.run())
+        # We decided well before max_sec (1000 intervals).
+        self.assertLess(monitor.num_intervals, 10)
+        self.assertEqual('healthy', self.progress[-1]['decision'])
+
+    def test_errors(self):
+        rng = random.Random(3)
+        monitor = self._monitor(
+            lambda: (None if rng.random() < 0.2 else 0.1, 0.1))
+        self.assertEqual('regression', monitor.run())
+        self.assertEqual(1, monitor.num_intervals)
+        self.assertEqual('regression', monitor.error_test.decision)
+
+    def test_shared_errors_dont_count(self):
+        rng = random.Random(4)
+
+        def probe():
+            if rng.random() < 0.2:
+                return (None, None)    # e.g. the network is flaky
+            return (rng.random(), rng.random())
+        self.assertEqual('healthy', self._monitor(probe).run())
+
+    def test_slower(self):
+        rng = random.Random(5)
+        monitor = self._monitor(
+            lambda: (rng.random() + 0.3, rng.random()))
+        self.assertEqual('regression', monitor.run())
+        self.assertEqual('regression', monitor.latency_test.decision)
+        self.assertLess(monitor.num_intervals, 3)
+
+    def test_inconclusive(self):
+        # The new version is slower exactly 60% of the time: between
+        # healthy (50%) and regression (70%), so it takes a while.
+        slower = itertools.cycle([True, True, True, False, False])
+        monitor = self._monitor(lambda: (2 if next(slower) else 0, 1),
+                                max_sec=0.003)
+        self.assertEqual('inconclusive', monitor.run())
+        self.assertEqual(3, monitor.num_intervals)
+
+    def test_warmup_probes_dont_count(self):
+        # The first probes of the old version hit a cold instance.
+        probes = itertools.chain([(0.1, 5)] * 5, itertools.repeat((2, 1)))
+        monitor = self._monitor(lambda: next(probes), warmup_probes=5)
+        self.assertEqual('regression', monitor.run())
+        self.assertEqual(0, monitor.latency_test.num_trials -
+                         monitor.latency_test.num_hits)
+
+    def test_stop_event(self):
+        stop_event = threading.Event()
+        threading.Timer(0.1, stop_event.set).start()
+        # As in test_inconclusive, this would take a while to decide.
+        slower = itertools.cycle([True, True, True, False, False])
+        monitor = self._monitor(lambda: (2 if next(slower) else 0, 1),
+                                interval_sec=0.01, max_sec=60,
+                                stop_event=stop_event)
+        start = time.time()
+        self.assertEqual('inconclusive', monitor.run())
+        self.assertLess(time.time() - start, 1)
+
+
+class HttpProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.new_server = instance_primer_test.FakeAppengineServer(
+            cold_sec=0, warm_sec=0)
+        self.old_server = instance_primer_test.FakeAppengineServer(
+            cold_sec=0, warm_sec=0)
+
+    def tearDown(self):
+        self.new_server.close()
+        self.old_server.close()
+
+    def test_probe(self):
+        probe = streaming_monitor.http_probe_fn(self.new_server.url,
+                                                self.old_server.url)
+        self.new_server.warm_sec = self.new_server.cold_sec = 0.05
+        self.new_server.failures = set([2])
+        (new, old) = probe()
+        self.assertGreater(new, old)
+        self.assertEqual(None, probe()[0])
+        self.assertEqual(2, self.old_server.num_requests)
+
+    def test_paths(self):
+        probe = streaming_monitor.http_probe_fn(self.new_server.url,
+                                                self.old_server.url,
+                                                ('/', '/math', 'login'))
+        for _ in xrange(4):
+            probe()
+        self.assertEqual(['/', '/math', '/login', '/'],
+                         self.new_server.paths)
+        self.assertEqual(self.new_server.paths, self.old_server.paths)
+
+    def test_regression(self):
+        self.new_server.failures = set(xrange(1, 1000, 3))
+        monitor = streaming_monitor.StreamingMonitor(
+            streaming_monitor.http_probe_fn(self.new_server.url,
+                                            self.old_server.url),
+            interval_sec=0.01, max_sec=1)
+        self.assertEqual('regression', monitor.run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Run tasks in threads, each as soon as the tasks it depends on finish.
+
+Some deploy steps don't depend on each other -- we can prime
+instances while we collect pre-deploy monitoring data, say -- but we
+used to run every step in series anyway.  A TaskRunner runs each task
+in its own thread as soon as every task it depends on has finished
+(and a worker is free), so independent tasks overlap.
+
+If a task raises an exception, we start no more tasks, wait for the
+ones that are already running, and then re-raise the first exception,
+with its original traceback, from run().  So a caller sees the same
+exception it would have seen if it had run the tasks in series.
+
+We can't interrupt a thread, so to stop a long-running task early
+when some other task fails, the task has to cooperate: we set
+stop_event when a task fails, and the task should check it every so
+often and return once it's set.
+"""
+
+import collections
+import logging
+import sys
+import threading
+
+
+class TaskRunner(object):
+    """Runs tasks that depend on each other; see the module docstring.
+
+    Add tasks with add(), then call run().  Afterwards, self.results
+    maps the name of every task that finished to what it returned --
+    even if run() raised because some other task failed.
+
+    With max_workers=1, the tasks run one at a time, in the order they
+    were added.
+
+    self.stop_event is a threading.Event that we set as soon as any
+    task fails; long-running tasks should stop when it's set.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.results = {}
+        self.stop_event = threading.Event()
+        self._tasks = collections.OrderedDict()    # name -> (fn, deps)
+
+    def add(self, name, fn, deps=()):
+        """Add a task that calls fn() once the tasks in deps have finished.
+
+        fn takes no arguments; it can find what the tasks it depends
+        on returned in self.results.  deps must already have been
+        added, which means there can't be any cycles.
+        """
+        if name in self._tasks:
+            raise ValueError('Duplicate task %s' % name)
+        for dep in deps:
+            if dep not in self._tasks:
+                raise ValueError('Task %s depends on unknown task %s'
+                                 % (name, dep))
+        self._tasks[name] = (fn, tuple(deps))
+
+    def run(self):
+        """Run every task, and return self.results.
+
+        Raises:
+            Whatever the first task to fail raised.
+        """
+        cond = threading.Condition()
+        not_started = collections.OrderedDict(self._tasks)
+        running = set()
+        failures = []          # the sys.exc_info() of each failed task
+
+        def run_task(name, fn):
+            try:
+                result = fn()
+            except Exception:
+                with cond:
+                    failures.append(sys.exc_info())
+                # Tell the other running tasks to give up.
+                self.stop_event.set()
+            else:
+                with cond:
+                    self.results[name] = result
+            finally:
+                with cond:
+                    running.remove(name)
+                    cond.notify()
+
+        with cond:
+            while True:
+                if not failures:
+                    for (name, (fn, deps)) in not_started.items():
+                        if len(running) >= self.max_workers:
+                            break
+                        if all(dep in self.results for dep in deps):
+                            del not_started[name]
+                            running.add(name)
+                            thread = threading.Thread(target=run_task,
+                                                      args=(name, fn),
+                                                      name=name)
+                            thread.daemon = True
+                            thread.start()
+                if not running:
+                    break
+                # We wait with a timeout because, in python2, an
+                # untimed wait can't be interrupted by a signal.
+                cond.wait(1)
+
+        if failures:
+            if not_started:
+                logging.warning('Not running %s, since a task failed'
+                                % ', '.join(not_started))
+            (exc_type, exc_value, exc_traceback) = failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+        return self.results
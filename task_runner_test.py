@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""Tests for task_runner.py"""
+
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+import task_runner
+
+
+class TaskRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = task_runner.TaskRunner()
+        self.log = []
+        self.log_lock = threading.Lock()
+
+    def _task(self, name, sec=0, result=None, exception=None):
+        """Return a fn that logs when it starts and ends, for add()."""
+        def fn():
+            with self.log_lock:
+                self.log.append('start %s' % name)
+            time.sleep(sec)
+            with self.log_lock:
+                self.log.append('end %s' % name)
+            if exception:
+                raise exception
+            return result
+        return fn
+
+    def test_results(self):
+        self.runner.add('a', self._task('a', result=1))
+        self.runner.add('b', lambda: self.runner.results['a'] + 1, ['a'])
+        self.assertEqual({'a': 1, 'b': 2}, self.runner.run())
+
+    def test_independent_tasks_overlap(self):
+        self.runner.add('a', self._task('a', sec=0.5))
+        self.runner.add('b', self._task('b', sec=0.5))
+        self.runner.add('c', self._task('c'), ['a', 'b'])
+        start = time.time()
+        self.runner.run()
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(['start a', 'start b'], sorted(self.log[:2]))
+        self.assertEqual(['start c', 'end c'], self.log[-2:])
+
+    def test_max_workers(self):
+        self.runner.max_workers = 1
+        for name in ('a', 'b', 'c'):
+            self.runner.add(name, self._task(name, sec=0.1))
+        self.runner.run()
+        self.assertEqual(['start a', 'end a', 'start b', 'end b',
+                          'start c', 'end c'], self.log)
+
+    def test_failure(self):
+        self.runner.add('a', self._task('a', exception=KeyError('oops')))
+        self.runner.add('b', self._task('b', sec=0.5, result='b'))
+        self.runner.add('c', self._task('c'), ['a'])
+        self.runner.add('d', self._task('d'), ['b'])
+        try:
+            self.runner.run()
+            self.fail('run() should have raised')
+        except KeyError:
+            # We get the traceback from the task, not from the runner.
+            self.assertEqual('fn',
+                             traceback.extract_tb(sys.exc_info()[2])[-1][2])
+        # b was already running when a failed, so we let it finish,
+        # but we didn't start anything else.
+        self.assertEqual({'b': 'b'}, self.runner.results)
+        self.assertNotIn('start c', self.log)
+        self.assertNotIn('start d', self.log)
+
+    def test_failure_stops_running_tasks(self):
+        def long_task():
+            # A task that would run for a minute, if nothing stopped it.
+            if self.runner.stop_event.wait(60):
+                return 'stopped'
+            return 'finished'
+        self.runner.add('a', long_task)
+        self.runner.add('b', self._task('b', sec=0.1,
+                                        exception=KeyError('oops')))
+        start = time.time()
+        with self.assertRaises(KeyError):
+            self.runner.run()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual({'a': 'stopped'}, self.runner.results)
+
+    def test_bad_deps(self):
+        self.runner.add('a', self._task('a'))
+        with self.assertRaises(ValueError):
+            self.runner.add('a', self._task('a'))
+        with self.assertRaises(ValueError):
+            self.runner.add('b', self._task('b'), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()